@@ -11,6 +11,8 @@ from adacore import *
 
 import fits
 import uvfits
+import archive
+import imaging
 from uvfits import Uvfits
 import data
 
@@ -727,7 +727,7 @@ def parse_linelist(linelist, out='brief'):
         return [names, freqs]
     else:
         print('Did not parse!')
-def get_indices (arr,vals,disp=False):
+def get_indices (arr,vals,disp=False,order=None):
     """
 
     Get the indices of all the elements between vals[0] and vals[1].
@@ -742,6 +742,9 @@ def get_indices (arr,vals,disp=False):
         disp : Bolean parameter, if True it displays start and end
                index and the number of channels inbetween. Only works
                for value lists of length 2.
+        order : the order of arr, 1 (increasing), -1 (decreasing) or
+               0 (neither), see _monotonic. Found from arr if not given,
+               pass it when arr is searched many times.
 
     Assumes the values in 'arr' is the mid values and that it is evenly
     spaced for all values.
@@ -766,20 +769,31 @@ def get_indices (arr,vals,disp=False):
         Funciton created
     """
 
-    from scipy import concatenate, where, array, diff
-    dx = abs(.5*diff(arr)[0])
+    from scipy import concatenate, where, array, diff, arange
+    dx = abs(.5*diff(arr[:2])[0])
     if len(vals)==4:
         v1,v2,v3,v4 = vals + array([-1,1,-1,1])*dx
         # if the user wants two velocity areas to calculate noise
-        low = where((arr>=v1)*(arr<=v2))[0]
-        high = where((arr>=v3)*(arr<=v4))[0]
+        if order is None:
+            order = _monotonic(arr)
+        low = _channel_range(arr, v1, v2, order)
+        high = _channel_range(arr, v3, v4, order)
+        if low is None or high is None:
+            low = where((arr>=v1)*(arr<=v2))[0]
+            high = where((arr>=v3)*(arr<=v4))[0]
+        else:
+            low, high = arange(*low), arange(*high)
         channels = concatenate((low,high))
     elif len(vals)==2:
         v1,v2 = vals + array([-1,1])*dx
         #channels = where((arr>=v1)*(arr<v2))[0]+1
         # this is because if +1 it is FITS/Fortran safe
         # changed: removed +1 for consistency in program
-        channels = where((arr>=v1)*(arr<=v2))[0]
+        rng = _channel_range(arr, v1, v2, order)
+        if rng is None:
+            channels = where((arr>=v1)*(arr<=v2))[0]
+        else:
+            channels = arange(*rng)
     #
     if disp and len(vals)==2:
         first, last = channels.min(), channels.max()
@@ -787,6 +801,50 @@ def get_indices (arr,vals,disp=False):
         print '\nFirst: %d,\n Last: %d\n Nchan: %d\n' % (first, last, n)
     return channels
 
+def _monotonic(arr):
+    # 1 if arr is increasing, -1 if decreasing, 0 if neither
+    from scipy import diff
+    step = diff(arr)
+    if (step >= 0).all():
+        return 1
+    elif (step <= 0).all():
+        return -1
+    return 0
+
+def _channel_range(arr, v1, v2, order=None):
+    # (start, stop) of the elements of arr in [v1, v2], with a binary
+    # search instead of a scan of arr. None if arr is not monotonic.
+    from scipy import searchsorted, asarray
+    arr = asarray(arr)
+    if order is None:
+        order = _monotonic(arr)
+    if order > 0:
+        return searchsorted(arr, v1, 'left'), searchsorted(arr, v2, 'right')
+    elif order < 0:
+        # decreasing, search the reversed array
+        n = len(arr)
+        rev = arr[::-1]
+        return n - searchsorted(rev, v2, 'right'), n - searchsorted(rev, v1, 'left')
+    return None
+
+def get_slice(arr, vals, order=None):
+    """
+    As get_indices, but returns a slice for two values (vals = [v1, v2])
+    and a monotonic arr, so that indexing the data with it gives a view
+    and not a copy, e.g. Fits.d[get_slice(Fits.v_arr, [v1, v2])].
+    Otherwise (four values, or arr not monotonic) the indices from
+    get_indices are returned. The order of arr is passed on to
+    get_indices.
+    """
+    from scipy import diff, array
+    if len(vals)==2:
+        dx = abs(.5*diff(arr[:2])[0])
+        v1,v2 = vals + array([-1,1])*dx
+        rng = _channel_range(arr, v1, v2, order)
+        if rng is not None:
+            return slice(*rng)
+    return get_indices(arr, vals, order=order)
+
 
 #
 # Help functions for fitting
@@ -1438,12 +1496,17 @@ def gauss2d_convolve ((bmaj1, bmin1, theta1, bmaj2, bmin2, theta2), ang='deg'):
     #
     # send back the results
     return (bmaj, bmin, bpa, fac, success)
+# array versions of gauss2d_decon and gauss2d_convolve, see helpers
+from .helpers import gauss2d_decon_arr, gauss2d_convolve_arr
 ########################################################################
 # DATA HANDLING
 # to adacore.py
 # classes etc
 #
 
+# the sums of the moments, as in data.py
+from .helpers import moment_sums, moment_sums_tiled
+
 # MOMENTS DATA CLASS
 # to adacore.py
 # Calculates moment 0 and 1, to use in
@@ -1469,11 +1532,20 @@ class Moments:
 
     ### not shure if it is allowed to use "FITS" as input here.
     # perhaps need some other input name, for clarity
-    def __init__ (self, Fits, chvals, nsig):
+    def __init__ (self, Fits, chvals, nsig, tile=None, nthreads=1):
         """
         moment class initialiser
 
         input :
+            tile, nthreads : compute the maps in tiles of tile x tile
+                pixels, divided over nthreads threads (when tile is
+                given or nthreads > 1). Each tile only reads its part
+                of the cube, use it for (memory mapped) big cubes.
+
+        output :
+            zero, one, two : moments 0, 1 and 2
+            peak : the peak intensity (moment 8)
+            vpeak : velocity of the peak (moment 9)
 
 
         DONE : Check if I take enough levels, i.e. that the self.maximum
@@ -1481,21 +1553,39 @@ class Moments:
                 -> Yes it is
 
         """
-        from scipy import sqrt, alen, flipud, arange, array, ones, nan
+        from scipy import sqrt, alen, arange, nan, isnan
         # -> never use binned array
         # -> never use velocities from/with the v_sys corrected data
         # get the data from the cube
         # copy header for easy acess to stuff
         self.hdr = Fits.hdr
-        self.channels = get_indices(Fits.v_arr, chvals)
-        imgs = Fits.d[self.channels]
+        ch = get_slice(Fits.v_arr, chvals)
+        self.channels = arange(alen(Fits.v_arr))[ch]
+        # the velocities relative to their mean, v0
+        velocities = Fits.v_arr[ch]
+        v0 = velocities.mean()
+        # the sums over the channels, read one channel at a time, from
+        # a view of the cube if the channels are a slice
+        if isinstance(ch, slice):
+            cube, ch = Fits.d[ch], arange(alen(velocities))
+        else:
+            cube = Fits.d
+        if tile is None and nthreads == 1:
+            sums = moment_sums(cube, ch, velocities - v0)
+        else:
+            sums = moment_sums_tiled(cube, ch, velocities - v0,
+                                    tile=512 if tile is None else tile,
+                                    nthreads=nthreads)
+        Isum, Ivsum, Iv2sum, self.peak, ipeak = sums
+        ## PEAK INTENSITY AND ITS VELOCITY (moments 8 and 9)
+        self.vpeak = velocities[ipeak]
+        self.vpeak[isnan(self.peak)] = nan
         ## MOMENT 0
         # calculate the moment 0
-        self.zero = imgs.sum(axis=0) * abs(Fits.v_cdeltkms)
-        #Isum = imgs.sum(axis=0)*abs(Fits.v_cdeltkms) # make a copy for masking <3sigma values in mom1 map̈́
+        self.zero = Isum * abs(Fits.v_cdeltkms)
         ## STATISTICS of MOMENT 0 (sigma, min, max, levels)
         # other statistics
-        self.sigma = sqrt(alen(imgs)) * Fits.rms * abs(Fits.v_cdeltkms)
+        self.sigma = sqrt(alen(self.channels)) * Fits.rms * abs(Fits.v_cdeltkms)
         self.minimum = self.zero.min()
         self.maximum = self.zero.max()
         # calculate levels, start at 1 sigma, jump 1 sigma
@@ -1505,24 +1595,17 @@ class Moments:
         self.levels_pos = arange(self.sigma, self.maximum + 2 * self.sigma, self.sigma)
         #levels = arange(nsig*moment0_sigma,moment0_max+moment0_sigma,nsjump*moment0_sigma)
         ## MOMENT 1
-        # create array that matches imgs array
-        # only the velocities that we want, i.e. Fits.v_arr[self.channels]
-        velocities_matrix = array([ones(imgs.shape[1:]) * i for i in Fits.v_arr[self.channels]] )
-        # removed where(), because a boolean array works fine
         # find out where we calculate the moment 1, i.e. 3 sigma level
-        Isum = imgs.sum(axis=0)
         lt_3sigma = (self.zero < (nsig * self.sigma)) * (self.zero > (-1.0 * nsig * self.sigma))
         Isum[ lt_3sigma ] = nan
-        Ivsum = (imgs * velocities_matrix).sum(axis=0)
-        # calculate the denominator, the sum of all images
-        # in our velocity interval
 
         # MOMENT 1
         #
         # M1 = V(x,y)
         # = sum( v_i * I(x,y,v_i)) / sum(I(x,y,v_i))
         #
-        self.one = Ivsum / Isum
+        mean = Ivsum / Isum
+        self.one = v0 + mean
 
         # MOMENT 2
         #
@@ -1530,8 +1613,10 @@ class Moments:
         #
         # M2 = sqrt[ sum( I(x,y,v_i) * (v_i - M1)**2 ) / sum(I(x,y,v_i)) ]
         #
-        top = imgs * (velocities_matrix - self.one)**2
-        division = abs(top.sum(axis=0) / Isum)
+        # expanded, with the sums of I*v and I*v**2 (v relative to v0)
+        # M2 = sqrt[ sum(I*v**2) / sum(I) - (M1 - v0)**2 ]
+        #
+        division = abs(Iv2sum / Isum - mean**2)
         self.two = sqrt(division)
 
 #
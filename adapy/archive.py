@@ -0,0 +1,266 @@
+"""
+Index of the FITS and UV-FITS data products in a directory tree
+
+The headers of all files are parsed in parallel (process pool) and
+the header derived attributes (data type, rest frequency, frequency and
+velocity range, beam, phase center, telescope diameter) are stored in a
+local SQLite database. Searching the database is then much faster than
+opening every file again.
+
+Usage :
+    crawl('/data/alma', 'archive.db', nprocs=8)
+    idx = ArchiveIndex('archive.db')
+    rows = idx.covers(230.5e9, ra=52.2379, dec=31.2436, radius=10)
+
+"""
+import os as _os
+import sqlite3 as _sqlite3
+from fnmatch import fnmatch as _fnmatch
+from multiprocessing import Pool as _Pool
+
+import numpy as _np
+
+from .helpers import *
+from .fits import Fits
+
+__all__ = ['crawl', 'ArchiveIndex']
+
+########################################################################
+# TABLE DEFINITION
+# frequencies in Hz, velocities in km/s, beam in asec and deg,
+# phase center in degrees (and as strings)
+_COLUMNS = [('path',      'TEXT PRIMARY KEY'),
+            ('mtime',     'REAL'),
+            ('kind',      'TEXT'),      # 'fits' or 'uvfits'
+            ('datatype',  'TEXT'),
+            ('object',    'TEXT'),
+            ('telescope', 'TEXT'),
+            ('diameter',  'REAL'),
+            ('restfreq',  'REAL'),
+            ('freq_min',  'REAL'),
+            ('freq_max',  'REAL'),
+            ('v_min',     'REAL'),
+            ('v_max',     'REAL'),
+            ('bmaj',      'REAL'),
+            ('bmin',      'REAL'),
+            ('bpa',       'REAL'),
+            ('ra',        'REAL'),
+            ('dec',       'REAL'),
+            ('ra_str',    'TEXT'),
+            ('dec_str',   'TEXT')]
+_NAMES = [i[0] for i in _COLUMNS]
+
+PATTERNS = ('*.fits', '*.FITS', '*.fit', '*.uvfits', '*.UVFITS')
+
+########################################################################
+# HEADER PARSING (runs in the worker processes)
+def _fits_info(path, hdr):
+    """ Header derived attributes of an image/cube, through Fits """
+    obj = Fits.from_header(hdr)
+    info = dict(kind='fits',
+                datatype=obj.datatype[0],
+                object=obj.obj,
+                telescope=obj.telescope,
+                diameter=float(obj.diameter),
+                ra=obj.ra_crval,
+                dec=obj.dec_crval)
+    info['ra_str'], info['dec_str'] = obj.phase_center_string()
+    if hasattr(obj, 'restfreq'):
+        info['restfreq'] = float(obj.restfreq)
+    if hasattr(obj, 'f_arr'):
+        info['freq_min'] = float(obj.f_arr.min())
+        info['freq_max'] = float(obj.f_arr.max())
+    elif hasattr(obj, 'freq'):
+        # continuum image, the frequency and width of the 3rd axis
+        half = abs(obj.freqwidth) / 2.
+        info['freq_min'], info['freq_max'] = obj.freq - half, obj.freq + half
+    elif hasattr(obj, 'restfreq'):
+        info['freq_min'] = info['freq_max'] = info['restfreq']
+    if hasattr(obj, 'v_arr'):
+        info['v_min'] = float(obj.v_arr.min())
+        info['v_max'] = float(obj.v_arr.max())
+    if hasattr(obj, 'bmaj'):
+        info['bmaj'] = float(obj.bmaj)
+        info['bmin'] = float(obj.bmin)
+        info['bpa'] = float(obj.bpa)
+    return info
+
+def _uvfits_info(path, hdr):
+    """ Header derived attributes of a uv-fits file (random groups) """
+    axes = dict([(str(hdr['CTYPE{0}'.format(i)]).strip(), i)
+                    for i in range(2, hdr['NAXIS'] + 1)
+                    if 'CTYPE{0}'.format(i) in hdr])
+    info = dict(kind='uvfits', object=hdr.get('OBJECT'))
+    # same definition as in Uvfits
+    if hdr['NAXIS'] > 3 and hdr['NAXIS4'] > 1:
+        info['datatype'] = 'CUBE'
+    else:
+        info['datatype'] = 'IMAGE'
+    if 'TELESCOP' in hdr:
+        info['telescope'] = hdr['TELESCOP']
+        info['diameter'] = float(get_telescope_diameter(hdr['TELESCOP']))
+    if 'RESTFREQ' in hdr:
+        info['restfreq'] = float(hdr['RESTFREQ'])
+    if 'FREQ' in axes:
+        i = axes['FREQ']
+        crpix, crval = hdr['CRPIX{0}'.format(i)], hdr['CRVAL{0}'.format(i)]
+        cdelt, naxis = hdr['CDELT{0}'.format(i)], hdr['NAXIS{0}'.format(i)]
+        # channel centers +/- half a channel
+        freqs = (_np.array([0, naxis - 1]) - (crpix - 1)) * cdelt + crval
+        freqs = freqs + _np.array([-0.5, 0.5]) * abs(cdelt)
+        info['freq_min'], info['freq_max'] = freqs.min(), freqs.max()
+        if 'restfreq' in info:
+            vels = calc_vlsr(freqs, info['restfreq'])
+            info['v_min'], info['v_max'] = vels.min(), vels.max()
+    if 'RA' in axes and 'DEC' in axes:
+        ra = hdr['CRVAL{0}'.format(axes['RA'])]
+        dec = hdr['CRVAL{0}'.format(axes['DEC'])]
+    elif 'OBSRA' in hdr and 'OBSDEC' in hdr:
+        ra, dec = hdr['OBSRA'], hdr['OBSDEC']
+    else:
+        ra = dec = None
+    if ra is not None:
+        info['ra'], info['dec'] = float(ra), float(dec)
+        info['ra_str'] = parse_ra(ra, string=True)
+        info['dec_str'] = parse_dec(dec, string=True)
+    return info
+
+def _index_file(path):
+    """
+    Worker function, returns (path, row, None) or (path, None, error)
+    for one file. Only the header is read.
+    """
+    from astropy.io.fits import getheader
+    try:
+        hdr = getheader(path)
+        if hdr.get('GROUPS', False) and hdr['NAXIS1'] == 0:
+            info = _uvfits_info(path, hdr)
+        else:
+            info = _fits_info(path, hdr)
+        info['path'] = path
+        info['mtime'] = _os.path.getmtime(path)
+        return path, [info.get(i) for i in _NAMES], None
+    except Exception as ex:
+        return path, None, '{0}: {1}'.format(type(ex).__name__, ex)
+
+########################################################################
+# CRAWLER
+def find_files(top, patterns=PATTERNS):
+    """ Walk the directory tree 'top' and yield the matching files """
+    for root, dirs, files in _os.walk(top):
+        for name in files:
+            if any(_fnmatch(name, p) for p in patterns):
+                yield _os.path.abspath(_os.path.join(root, name))
+
+def crawl(top, dbfile='archive.db', nprocs=None, patterns=PATTERNS,
+            update=True, chunksize=16, verbose=True):
+    """
+    Walk the directory tree 'top' and index all FITS and UV-FITS files
+    in the SQLite database 'dbfile'.
+
+    nprocs : number of worker processes (default: number of CPUs)
+    update : if True, files already in the index with the same
+             modification time are not parsed again
+    Returns the ArchiveIndex and a list of (path, error) for the files
+    that could not be indexed.
+    """
+    index = ArchiveIndex(dbfile)
+    paths = list(find_files(top, patterns))
+    if update:
+        known = index.mtimes()
+        paths = [p for p in paths
+                    if known.get(p) != _os.path.getmtime(p)]
+    if verbose:
+        print('Indexing {0} files in {1}'.format(len(paths), top))
+    rows, errors = [], []
+    if paths:
+        pool = _Pool(nprocs)
+        try:
+            for path, row, err in pool.imap_unordered(_index_file, paths,
+                                                    chunksize):
+                if err is None:
+                    rows.append(row)
+                else:
+                    errors.append((path, err))
+        finally:
+            pool.close()
+            pool.join()
+    index.insert(rows)
+    if verbose:
+        print('Indexed {0} files, {1} failed'.format(len(rows), len(errors)))
+    return index, errors
+
+########################################################################
+# INDEX
+class ArchiveIndex(object):
+    """
+    SQLite index of FITS and UV-FITS data products, filled by crawl()
+
+    Usage :
+    idx = ArchiveIndex('archive.db')
+    idx.covers(230.5e9, ra=52.2379, dec=31.2436, radius=10)
+    """
+    def __init__(self, dbfile='archive.db'):
+        self.dbfile = dbfile
+        self.db = _sqlite3.connect(dbfile)
+        self.db.row_factory = _sqlite3.Row
+        cols = ', '.join(['{0} {1}'.format(*i) for i in _COLUMNS])
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS products ({0})'.format(cols))
+            self.db.execute('CREATE INDEX IF NOT EXISTS idx_freq '
+                            'ON products (freq_min, freq_max)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS idx_dec '
+                            'ON products (dec)')
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+    def __str__(self):
+        return 'Archive index {0} ({1} products)'.format(self.dbfile, len(self))
+    def mtimes(self):
+        """ Dictionary of path : modification time, of indexed files """
+        return dict(self.db.execute('SELECT path, mtime FROM products'))
+    def insert(self, rows):
+        """ Insert (or replace) rows, lists ordered as the columns """
+        sql = 'INSERT OR REPLACE INTO products ({0}) VALUES ({1})'.format(
+                ', '.join(_NAMES), ', '.join('?' * len(_NAMES)))
+        with self.db:
+            self.db.executemany(sql, rows)
+    def query(self, where='1', args=()):
+        """ Rows matching an SQL 'where' clause """
+        sql = 'SELECT * FROM products WHERE {0}'.format(where)
+        return self.db.execute(sql, args).fetchall()
+    def covers(self, freq=None, ra=None, dec=None, radius=None, datatype=None):
+        """
+        Find the products that cover a frequency (Hz) and/or have their
+        phase center within 'radius' (asec) of (ra, dec) (degrees).
+
+        datatype : 'CUBE', 'IMAGE' or 'SDSPECT' to only get that type
+        """
+        where, args = [], []
+        if freq is not None:
+            where.append('freq_min <= ? AND freq_max >= ?')
+            args += [freq, freq]
+        if datatype is not None:
+            where.append('datatype = ?')
+            args.append(datatype)
+        if ra is not None and dec is not None and radius is not None:
+            # first a cheap box in DEC (uses the index)
+            r_deg = radius / 3600.
+            where.append('dec BETWEEN ? AND ?')
+            args += [dec - r_deg, dec + r_deg]
+        rows = self.query(' AND '.join(where) or '1', args)
+        if ra is not None and dec is not None and radius is not None and rows:
+            # then the exact angular separation
+            sep = angular_separation(ra, dec,
+                                    _np.array([i['ra'] for i in rows]),
+                                    _np.array([i['dec'] for i in rows]))
+            rows = [i for i, s in zip(rows, sep) if s <= radius]
+        return rows
+    def close(self):
+        self.db.close()
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """ Great circle distance in asec, input in degrees (haversine) """
+    ra1, dec1, ra2, dec2 = [_np.radians(i) for i in (ra1, dec1, ra2, dec2)]
+    a = (_np.sin((dec2 - dec1) / 2.)**2 +
+            _np.cos(dec1) * _np.cos(dec2) * _np.sin((ra2 - ra1) / 2.)**2)
+    return _np.degrees(2 * _np.arcsin(_np.sqrt(a))) * 3600.
@@ -1,5 +1,6 @@
 
 from .helpers import *
+from .libs.errors import ParError
 
 
 ########################################################################
@@ -33,11 +34,20 @@ class Moments:
 
     ### not shure if it is allowed to use "FITS" as input here.
     # perhaps need some other input name, for clarity
-    def __init__ (self, Fits, chvals, nsig):
+    def __init__ (self, Fits, chvals, nsig, tile=None, nthreads=1):
         """
         moment class initialiser
 
         input :
+            tile, nthreads : compute the maps in tiles of tile x tile
+                pixels, divided over nthreads threads (when tile is
+                given or nthreads > 1). Each tile only reads its part
+                of the cube, use it for (memory mapped) big cubes.
+
+        output :
+            zero, one, two : moments 0, 1 and 2
+            peak : the peak intensity (moment 8)
+            vpeak : velocity of the peak (moment 9)
 
 
         DONE : Check if I take enough levels, i.e. that the self.maximum
@@ -45,21 +55,39 @@ class Moments:
                 -> Yes it is
 
         """
-        from scipy import sqrt, alen, flipud, arange, array, ones, nan
+        from scipy import sqrt, alen, arange, nan, isnan
         # -> never use binned array
         # -> never use velocities from/with the v_sys corrected data
         # get the data from the cube
         # copy header for easy acess to stuff
         self.hdr = Fits.hdr
-        self.channels = get_indices(Fits.v_arr, chvals)
-        imgs = Fits.d[self.channels]
+        ch = Fits.get_channels(chvals)
+        self.channels = arange(alen(Fits.v_arr))[ch]
+        # the velocities relative to their mean, v0
+        velocities = Fits.v_arr[ch]
+        v0 = velocities.mean()
+        # the sums over the channels, read one channel at a time, from
+        # a view of the cube if the channels are a slice
+        if isinstance(ch, slice):
+            cube, ch = Fits.d[ch], arange(alen(velocities))
+        else:
+            cube = Fits.d
+        if tile is None and nthreads == 1:
+            sums = moment_sums(cube, ch, velocities - v0)
+        else:
+            sums = moment_sums_tiled(cube, ch, velocities - v0,
+                                    tile=512 if tile is None else tile,
+                                    nthreads=nthreads)
+        Isum, Ivsum, Iv2sum, self.peak, ipeak = sums
+        ## PEAK INTENSITY AND ITS VELOCITY (moments 8 and 9)
+        self.vpeak = velocities[ipeak]
+        self.vpeak[isnan(self.peak)] = nan
         ## MOMENT 0
         # calculate the moment 0
-        self.zero = imgs.sum(axis=0) * abs(Fits.v_cdeltkms)
-        #Isum = imgs.sum(axis=0)*abs(Fits.v_cdeltkms) # make a copy for masking <3sigma values in mom1 map
+        self.zero = Isum * abs(Fits.v_cdeltkms)
         ## STATISTICS of MOMENT 0 (sigma, min, max, levels)
         # other statistics
-        self.sigma = sqrt(alen(imgs)) * Fits.rms * abs(Fits.v_cdeltkms)
+        self.sigma = sqrt(alen(self.channels)) * Fits.rms * abs(Fits.v_cdeltkms)
         self.minimum = self.zero.min()
         self.maximum = self.zero.max()
         # calculate levels, start at 1 sigma, jump 1 sigma
@@ -69,24 +97,17 @@ class Moments:
         self.levels_pos = arange(self.sigma, self.maximum + 2 * self.sigma, self.sigma)
         #levels = arange(nsig*moment0_sigma,moment0_max+moment0_sigma,nsjump*moment0_sigma)
         ## MOMENT 1
-        # create array that matches imgs array
-        # only the velocities that we want, i.e. Fits.v_arr[self.channels]
-        velocities_matrix = array([ones(imgs.shape[1:]) * i for i in Fits.v_arr[self.channels]] )
-        # removed where(), because a boolean array works fine
         # find out where we calculate the moment 1, i.e. 3 sigma level
-        Isum = imgs.sum(axis=0)
         lt_3sigma = (self.zero < (nsig * self.sigma)) * (self.zero > (-1.0 * nsig * self.sigma))
         Isum[ lt_3sigma ] = nan
-        Ivsum = (imgs * velocities_matrix).sum(axis=0)
-        # calculate the denominator, the sum of all images
-        # in our velocity interval
 
         # MOMENT 1
         #
         # M1 = V(x,y)
         # = sum( v_i * I(x,y,v_i)) / sum(I(x,y,v_i))
         #
-        self.one = Ivsum / Isum
+        mean = Ivsum / Isum
+        self.one = v0 + mean
 
         # MOMENT 2
         #
@@ -94,10 +115,217 @@ class Moments:
         #
         # M2 = sqrt[ sum( I(x,y,v_i) * (v_i - M1)**2 ) / sum(I(x,y,v_i)) ]
         #
-        top = imgs * (velocities_matrix - self.one)**2
-        division = abs(top.sum(axis=0) / Isum)
+        # expanded, with the sums of I*v and I*v**2 (v relative to v0)
+        # M2 = sqrt[ sum(I*v**2) / sum(I) - (M1 - v0)**2 ]
+        #
+        division = abs(Iv2sum / Isum - mean**2)
         self.two = sqrt(division)
 
+# CUBE FITTING
+# gaussians fitted to the spectrum of every pixel of a cube,
+# tile by tile in a pool of processes, see CubeFit
+# the cube, the rms and the guesses of the workers, in shared memory,
+# the cube of a lazy Fits object is read from its file instead
+_CUBEFIT = {}
+
+def _cubefit_share(arr, dtype=None):
+    # copy to shared memory, one plane at a time (arr can be memmapped),
+    # in the native byte order of the dtype of arr (or dtype)
+    from multiprocessing.sharedctypes import RawArray
+    from numpy import frombuffer, dtype as _dtype
+    dtype = (arr.dtype if dtype is None else _dtype(dtype)).newbyteorder('=')
+    raw = RawArray('c', int(arr.size) * dtype.itemsize)
+    out = frombuffer(raw, dtype=dtype).reshape(arr.shape)
+    for i in xrange(arr.shape[0]):
+        out[i] = arr[i]
+    return raw, arr.shape, dtype.str
+
+def _cubefit_file(Fits):
+    # the path of the file, if Fits.d is (still) a memory map of the
+    # file of a lazy Fits object, so the workers can read their tiles
+    from mmap import mmap
+    from numpy import memmap
+    if not getattr(Fits, 'lazy', False) or not isinstance(Fits.fitsfile, str):
+        return None
+    base = Fits.d
+    while base is not None:
+        if isinstance(base, (mmap, memmap)):
+            return Fits.fitsfile, Fits.d.shape
+        base = getattr(base, 'base', None)
+    return None
+
+def _cubefit_init(shared, X, kwargs):
+    from numpy import frombuffer, ndarray
+    from astropy.io.fits import getdata
+    for key, val in shared.items():
+        if val is None or isinstance(val, ndarray):
+            # one process, the arrays themselves
+            _CUBEFIT[key] = val
+        elif isinstance(val[0], str):
+            # memory map the file, only the tiles are read
+            path, shape = val
+            _CUBEFIT[key] = getdata(path, memmap=True).reshape(shape)
+        else:
+            raw, shape, dtype = val
+            _CUBEFIT[key] = frombuffer(raw, dtype=dtype).reshape(shape)
+    _CUBEFIT['X'] = X
+    _CUBEFIT['kwargs'] = kwargs
+
+def _cubefit_tile((y0, y1, x0, x1)):
+    # fit all the pixels of a tile, with fit_gauss1d_cube
+    X, kw = _CUBEFIT['X'], _CUBEFIT['kwargs']
+    rms = _CUBEFIT['rms']
+    fit = fit_gauss1d_cube((X, _CUBEFIT['cube'][:, y0:y1, x0:x1]),
+                _CUBEFIT['guess'][:, y0:y1, x0:x1],
+                err=None if rms is None else rms[y0:y1, x0:x1],
+                verbose=0, **kw)
+    return (y0, y1, x0, x1), fit.params, fit.perror, fit.chi2, fit.dof, \
+            fit.status
+
+class CubeFit:
+    """
+    Fit gaussian(s) to the spectrum of every pixel of a cube
+
+    The cube is split in tiles, that are fitted with
+    helpers.fit_gauss1d_cube (the batched Levenberg-Marquardt solver)
+    in a pool of processes, the cube is put in shared memory once (in
+    its own data type), or, for a lazy Fits object, read tile by tile
+    from the file by the processes. Pixels that did not converge are
+    fitted again, starting from the median of their converged
+    neighbours (npass of fit_gauss1d_cube).
+
+    Usage :
+    fit = CubeFit(Fits, rms=0.05)
+    fit = CubeFit(Fits, params=[[1, 7., 2.], [0.5, 9., 1.]], nvals=[-20, -5, 20, 35], nprocs=8)
+    fit.amplitude, fit.centroid, fit.fwhm (and _err)
+    fit.writeto('iras4a_co')
+
+    Input :
+        Fits   : Fits object (cube)
+        params : first guesses [AMPL, POS, FWHM] per gaussian, the same
+                 for all pixels, or maps (3*ngauss, ny, nx). Default is
+                 one gaussian, guessed from the peak and integral of
+                 each spectrum (helpers.gauss1d_cube_guess)
+        rms    : the error of the data, a number or a map (ny, nx)
+        nvals  : if rms is not given, the velocity range(s) without
+                 lines, [v1, v2] or [v1, v2, v3, v4], to calculate an
+                 rms map
+        mask   : (ny, nx) booleans, the pixels to fit
+        tile   : size of the tiles (pixels along each axis)
+        npass  : number of times failed pixels are seeded from
+                 their neighbours
+        nprocs : number of processes
+        **kwargs : fixlist, minpar, maxpar, maxiter of fit_gauss1d_batch
+    """
+    def __init__(self, Fits, params=None, rms=None, nvals=None, mask=None,
+                tile=64, npass=4, nprocs=1, verbose=True, **kwargs):
+        from numpy import asarray, float64, nan, empty, ones
+        from multiprocessing import Pool
+        if Fits.datatype[0] != 'CUBE':
+            raise ParError(Fits.datatype)
+        self.hdr = Fits.hdr
+        X = asarray(Fits.v_arr, dtype=float64)
+        nchan, ny, nx = Fits.d.shape
+        #
+        # the error, a number or rms map
+        if rms is None and nvals is not None:
+            rms = asarray(Fits.d[Fits.get_channels(nvals)], dtype=float64).std(axis=0)
+        if rms is not None and asarray(rms).ndim == 0:
+            rms = ones((ny, nx)) * rms
+        self.rms = rms
+        #
+        # the first guesses
+        if params is None:
+            guess = gauss1d_cube_guess((X, Fits.d))
+        else:
+            guess = asarray(params, dtype=float64)
+            if guess.ndim < 3:
+                guess = guess.reshape(-1)[:, None, None] * ones((1, ny, nx))
+        if mask is not None:
+            guess[:, ~asarray(mask, dtype=bool)] = nan
+        npar = guess.shape[0]
+        #
+        if nprocs > 1:
+            cube = _cubefit_file(Fits)
+            shared = dict(cube=_cubefit_share(Fits.d) if cube is None else cube,
+                        guess=_cubefit_share(guess, 'f8'),
+                        rms=None if rms is None else _cubefit_share(rms, 'f8'))
+        else:
+            shared = dict(cube=Fits.d, guess=guess, rms=rms)
+        kwargs['npass'] = npass
+        tiles = [(y0, min(y0 + tile, ny), x0, min(x0 + tile, nx))
+                for y0 in xrange(0, ny, tile) for x0 in xrange(0, nx, tile)]
+        #
+        self.params = empty((npar, ny, nx))
+        self.perror = empty((npar, ny, nx))
+        self.chi2 = empty((ny, nx))
+        self.dof = empty((ny, nx))
+        self.status = -ones((ny, nx), dtype=int)
+        if nprocs > 1:
+            pool = Pool(nprocs, initializer=_cubefit_init, initargs=(shared, X, kwargs))
+            results = pool.imap_unordered(_cubefit_tile, tiles)
+        else:
+            pool = None
+            _cubefit_init(shared, X, kwargs)
+            results = (_cubefit_tile(t) for t in tiles)
+        try:
+            for n, ((y0, y1, x0, x1), p, pe, c2, dof, st) in enumerate(results):
+                self.params[:, y0:y1, x0:x1] = p
+                self.perror[:, y0:y1, x0:x1] = pe
+                self.chi2[y0:y1, x0:x1] = c2
+                self.dof[y0:y1, x0:x1] = dof
+                self.status[y0:y1, x0:x1] = st
+                if verbose:
+                    print 'Tile {0} of {1}'.format(n + 1, len(tiles))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _CUBEFIT.clear()
+        self.amplitude, self.centroid, self.fwhm = [self.params[i::3] for i in range(3)]
+        self.amplitude_err, self.centroid_err, self.fwhm_err = [self.perror[i::3] for i in range(3)]
+        if verbose:
+            print 'Converged : {0} of {1} pixels'.format(
+                    ((self.status >= 1) & (self.status <= 3)).sum(), ny * nx)
+
+    def _map_header(self, bunit, ncomp):
+        # the header of the cube, with the spectral axis replaced by
+        # the gaussian component (if more than one)
+        from astropy.io.fits import Header
+        hdr = Header()
+        hdr['NAXIS'] = 2 if ncomp == 1 else 3
+        for key in ['NAXIS1', 'NAXIS2', 'CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2',
+                    'CDELT1', 'CDELT2', 'CRPIX1', 'CRPIX2', 'CUNIT1', 'CUNIT2',
+                    'EQUINOX', 'RADESYS', 'EPOCH', 'OBJECT', 'TELESCOP',
+                    'RESTFREQ', 'BMAJ', 'BMIN', 'BPA']:
+            if key in self.hdr:
+                hdr[key] = self.hdr[key]
+        if ncomp > 1:
+            hdr['NAXIS3'] = ncomp
+            hdr['CTYPE3'] = 'COMPONENT'
+            hdr['CRVAL3'], hdr['CDELT3'], hdr['CRPIX3'] = 1., 1., 1.
+        hdr['BUNIT'] = bunit
+        return hdr
+
+    def writeto(self, basename, overwrite=False):
+        """
+        Write the maps to FITS files, basename_amplitude.fits,
+        basename_amplitude_err.fits, ... _centroid, _fwhm and _chi2
+        """
+        from astropy.io.fits import PrimaryHDU
+        unit = self.hdr.get('BUNIT', '')
+        ncomp = self.amplitude.shape[0]
+        names = []
+        for name, bunit in [('amplitude', unit), ('centroid', 'km/s'), ('fwhm', 'km/s')]:
+            for suffix in ['', '_err']:
+                data = getattr(self, name + suffix)
+                names.append(basename + '_' + name + suffix + '.fits')
+                PrimaryHDU(data[0] if ncomp == 1 else data,
+                        header=self._map_header(bunit, ncomp)).writeto(names[-1], overwrite=overwrite)
+        names.append(basename + '_chi2.fits')
+        PrimaryHDU(self.chi2, header=self._map_header('', 1)).writeto(names[-1], overwrite=overwrite)
+        return names
+
 #
 # SPECTRUM DATA CLASS
 #
@@ -164,10 +392,22 @@ class Spectrum:
         print 'Extracted from region: {0}'.format(self.region)
         return '<ADAVIS Spectrum Object>'
     def bin_spectrum(self, binning, bintype='mean'):
+        """
+        Bin the spectrum, the unbinned spectrum is kept in self.Original
+
+        binning : number of channels in each bin
+        bintype : 'mean' - average every binning channels, channels
+                           left over at the end are dropped
+                  'resample' - flux conserving rebinning onto channels
+                           binning times wider
+        """
         from string import lower
-        from scipy import alen, arange, array
-        from sys import exit as sysexit
+        from scipy import alen, arange
         binning = int(binning)
+        if binning < 1:
+            print stylify("\nERROR:\n Variable \"bin\" has to be 1 for no binning, or above 1 \n\
+            for the number of channels to bin")
+            raise ParError(binning)
         self.binning = binning
         ##### temporary solution, saving old stuff
         class Original: pass
@@ -177,27 +417,21 @@ class Spectrum:
         Original.v_cdeltkms = self.v_cdeltkms
         self.Original = Original
         #
+        if alen(self.d)%binning!=0:
+            print 'Dropping the last {0} channels, binning does not evenly divide {1}'.format(
+                    alen(self.d)%binning, alen(self.d))
+        # the new channels, the mean velocity of every binning channels
+        v_new = rebin_spectral(self.v_arr, binning=binning)
         if lower(bintype) == 'resample':
-            from congridding import congrid
-            # congridding, proper resampling of data
-            self.d = congrid(self.d,(alen(self.d)/binning,),centre=True, method='neighbour')
-            self.v_arr = congrid(self.v_arr,(alen(self.v_arr)/binning,))
-            #
-            self.v_cdeltkms = self.v_cdeltkms*binning
-            self.v_cdelt = self.v_cdelt*binning
+            # flux conserving, onto channels binning times wider
+            self.d = rebin_spectral(self.d, v_in=self.v_arr, v_out=v_new)
         elif lower(bintype) == 'mean':
-            if alen(self.d)%binning!=0:
-                print 'Bin has to be evenly devide the number of channels: %d' % alen(self.d)
-                sysexit()
-            #  Old method - simple binning, just average
-            indices = arange(0,alen(self.d),binning)
-            self.d = array([self.d[x:x+binning].sum(axis=0)/binning for x in indices])
-            self.v_arr = array([self.v_arr[x:x+binning].sum(axis=0)/binning for x in indices])
-            #
-            self.v_cdeltkms = self.v_cdeltkms*binning
-        elif binning == 0 or binning <0:
-            print stylify("\nERROR:\n Variable \"bin\" has to be 1 for no binning, or above 1 \n\
-            for the number of channels to bin")
+            self.d = rebin_spectral(self.d, binning=binning)
+        else:
+            raise ParError(bintype)
+        self.v_arr = v_new
+        self.v_cdeltkms = self.v_cdeltkms*binning
+        self.v_cdelt = self.v_cdelt*binning
         # print out information about the binning
         print '='*40
         print ' '*11,"Binning of data\n"
@@ -206,7 +440,7 @@ class Spectrum:
         if bintype=='mean':
             print 'Type of binning : Simple mean over selected no. bin channels'
         elif bintype=='resample':
-            print 'Type of binning : Resampling - 1D interpolation'
+            print 'Type of binning : Resampling - flux conserving'
         # set the "binned" flag to True! (i.e. larger than 0)
         # every time we bin, it increases with the number of the binning parameter
         # hence the number of channels that it has been binned is repr
@@ -235,10 +469,10 @@ class Spectrum:
         """
         if Fits.datatype[0] == 'SDSPECT':
             if self.binned>1: # if it is larger than 0
-                self.rms = sqrt(((Fits.d[get_indices(Fits.v_arr,nvals)])**2).mean()/self.binned)
-                #self.rms = sqrt(((Fits.d[get_indices(Fits.v_arr,nvals),j1:j2,i1:i2])**2).mean()/self.binned)
+                self.rms = sqrt(((Fits.d[Fits.get_channels(nvals)])**2).mean()/self.binned)
+                #self.rms = sqrt(((Fits.d[Fits.get_channels(nvals),j1:j2,i1:i2])**2).mean()/self.binned)
             else:
-                self.rms = sqrt(((Fits.d[get_indices(Fits.v_arr,nvals)])**2).mean())
+                self.rms = sqrt(((Fits.d[Fits.get_channels(nvals)])**2).mean())
         else:
             zlen, ylen, xlen = Fits.d.shape
             ydelt = ylen/6
@@ -246,9 +480,9 @@ class Spectrum:
             i1,i2 = xlen/2-xdelt, xlen/2+xdelt
             j1,j2 = ylen/2-ydelt, ylen/2+ydelt
             if self.binned>1: # if it is larger than 0
-                self.rms = sqrt(((Fits.d[get_indices(Fits.v_arr,nvals),j1:j2,i1:i2])**2).mean()/self.binned)
+                self.rms = sqrt(((Fits.d[Fits.get_channels(nvals),j1:j2,i1:i2])**2).mean()/self.binned)
             else: # if it is 0
-                self.rms = sqrt(((Fits.d[get_indices(Fits.v_arr,nvals),j1:j2,i1:i2])**2).mean())
+                self.rms = sqrt(((Fits.d[Fits.get_channels(nvals),j1:j2,i1:i2])**2).mean())
         self.rms_mjy = self.rms*1e3
         # the sensitivity
         #TODO : if the unit is K km/s how come we divide?
@@ -1,5 +1,6 @@
 
 from .helpers import *
+from .libs.errors import FitsError, ParError
 from .libs.date import jd2gd
 import scipy as _sp
 from datetime import datetime as _dt
@@ -48,9 +49,26 @@ class Fits:
     TODO : Create a frequency array as well, much simpler later on then
 
     """
-    def __init__(self, fitsfile, telescope=None, vsys=0, distance=0, endian=None, **kwargs):
+    def __init__(self, fitsfile, telescope=None, vsys=0, distance=0, endian=None, lazy=False, header_only=False, verbose=True, **kwargs):
         """
 
+        header_only
+            only read and parse the header, self.d is None. Everything
+            derived from the header (v_arr, extent, beam, units etc) is
+            still set. See Fits.from_header.
+        verbose
+            if False, do not print the loading information
+
+        endian
+            None (default) keeps the data in the byte order of the file
+            (big endian) without any copy, 'little' converts it to the
+            native byte order in place.
+        lazy
+            if True the data is memory mapped and never read into memory
+            as a whole, self.d is then a (big endian) view of the file
+            and only the channels/pixels indexed later are read from disk.
+            Use for cubes that are larger than the available RAM.
+
         attributes
         ------------------------
         datatype
@@ -96,9 +114,8 @@ class Fits:
 
         #imports
         #~ from pyfits import open as fitsopen
-        from astropy.io.fits import open as fitsopen
+        from astropy.io.fits import getheader, Header
         #from  sys import
-        from os.path import getsize
         from scipy import where, array, nan
         from string import upper
         from sys import exit as sysexit
@@ -107,17 +124,17 @@ class Fits:
 
         # create the class, but without any init script.
         # a class (object) the easy way
-        print(u'Loading fitsfile :  %s ' % stylify(str(fitsfile),fg='g'))
-        s  = getsize(fitsfile)
-        print(" Size %0.2f MB" % (s/(1024.*1024.)))
-        f = fitsopen(fitsfile, **kwargs)
-        if endian == 'little':
-            self.hdr, self.d = f[0].header, f[0].data.byteswap().newbyteorder()
+        self.lazy = lazy
+        self.verbose = verbose
+        if header_only:
+            # never touch the data block, just parse the header
+            if isinstance(fitsfile, Header):
+                self.hdr, fitsfile = fitsfile, None
+            else:
+                self.hdr = getheader(fitsfile, **kwargs)
+            self.d = None
         else:
-            self.hdr, self.d = f[0].header, f[0].data
-        #self.d = self.d[0] # this is if the stokes axis is present,
-        # but it should not be there anymore
-        f.close()
+            self._load_data(fitsfile, endian, lazy, **kwargs)
         # save the fitsfile, perhaps the path too, for updating it
         self.fitsfile = fitsfile
         # the telescope diameter
@@ -159,11 +176,14 @@ class Fits:
             try:
                 self.restfreq = Unit(self.hdr['RESTFRQ'],'Hz' ) # in Hertz
             except KeyError:
-                print ('No frequency information.')
+                if verbose:
+                    print ('No frequency information.')
 
-        if self.hdr['NAXIS']==4 and self.d.shape[0:2] == (1,1):
+        # (NAXIS4, NAXIS3) is the shape of the first two data axes
+        if self.hdr['NAXIS']==4 and (self.hdr['NAXIS4'], self.hdr['NAXIS3']) == (1,1):
             self.datatype = ('IMAGE',2)
-            self.d = self.d[0][0]
+            if self.d is not None:
+                self.d = self.d[0][0]
         #naxis = self.hdr['NAXIS']
         #axshape = self.d.shape
         #if axshape[0] array([i>1 for i in a.shape[1:]]).all()
@@ -190,7 +210,7 @@ class Fits:
             self.datatype = ('CUBE',3)
             # load the third axis
             # need frequency!
-            while self.d.shape[0] == 1:
+            while self.d is not None and self.d.shape[0] == 1:
                 self.d = self.d[0]
             ##### have to add loading of frequency and calculate velocity
             # UGLY HACK BELOW, BEWARE!
@@ -205,10 +225,12 @@ class Fits:
                 velax = str([x for x in self.hdr.keys() if x[:-1]=='CTYPE' and _velname in self.hdr[x]][0][-1:])
                 vel_info = True
             elif _velname == []:
-                print('No velocity axis defined')
+                if verbose:
+                    print('No velocity axis defined')
                 vel_info = False
             else:
-                print('No velocity axis defined')
+                if verbose:
+                    print('No velocity axis defined')
                 vel_info = False
             ##### FUGLY hack END
             if vel_info:
@@ -263,10 +285,11 @@ class Fits:
             # calculate the FOV = 58.4*lambda/D*3600 asec
            
             self.fov = 58.4*(3.e8/self.restfreq)/float(self.diameter)*3600.
-            print 'Field of view: %.2f asecs, for dish size: %.1f m' % (self.fov, self.diameter)
-            #print self.veltype, self.v_crpix, self.v_crval, self.v_cdeltkms, self.v_naxis
-            print 'Velocity range \t: {0:.2f} km/s'.format(self.v_rangekms)
-            print 'Velocity step \t: {0:2.4f} km/s'.format(self.v_cdeltkms)
+            if verbose:
+                print 'Field of view: %.2f asecs, for dish size: %.1f m' % (self.fov, self.diameter)
+                #print self.veltype, self.v_crpix, self.v_crval, self.v_cdeltkms, self.v_naxis
+                print 'Velocity range \t: {0:.2f} km/s'.format(self.v_rangekms)
+                print 'Velocity step \t: {0:2.4f} km/s'.format(self.v_cdeltkms)
             #
             # now if we want to have the spectral array as well to use
             #~ already on line 1480
@@ -315,9 +338,12 @@ class Fits:
             #~ self.fov = 58.4*(3e8/self.restfreq)/(self.diameter)*3600
         else:
             # if it is not an image or a spectral cube
+            if header_only:
+                raise FitsError('{0} has {1} axes, unknown data type'.format(fitsfile, self.hdr['NAXIS']))
             print_error('The dimensions of the data is wrong\n at least the header keywords indicate that.\n The data has '+str(self.hdr['NAXIS'])+' axes. \n\n Perhaps use the removeaxis script?\n')
             sysexit()
-        print 'Datatype : {0}'.format(self.datatype[0])
+        if verbose:
+            print 'Datatype : {0}'.format(self.datatype[0])
         # perhaps check in the header?
         # velref probably at what velocity that middle of spectra is?
         self.v_sys = float(vsys)
@@ -331,7 +357,8 @@ class Fits:
         try:
             self.f_arr = self.restfreq * (1. - (self.v_arr - self.v_sys)*1e5 / _cgs.CC) 
         except:
-            print('no frequency array created')
+            if verbose:
+                print('no frequency array created')
     
         if self.datatype[0] in ['CUBE', 'SDSPECT']:
             self.v_arr_syscorr = self.v_arr - self.v_sys
@@ -387,7 +414,8 @@ class Fits:
             self.bpa = Unit(self.hdr['BPA'], 'degrees?')
         except KeyError, ex:
             msg='Header keywords (bmaj,bmin,bpa) incomplete and not loaded.'
-            print(msg)
+            if verbose:
+                print(msg)
             #~ self.bmaj = None
             #~ self.bmin = None
             #~ self.bpa = None
@@ -402,7 +430,8 @@ class Fits:
                 self.unitpixel = u"K\u00b7channel\u207b\u00b9"
                 self.unitint = u"K\u00b7" + KMS
         else:
-            print('No beam unit in header.')
+            if verbose:
+                print('No beam unit in header.')
             self.unitpixel = "INTENSITY"
             self.unitint = "INTEGRATED-INTENSITY"
         # calculate the GAIN of the observations (interferometric observations?)
@@ -412,11 +441,57 @@ class Fits:
         #
         # Object name
         self.obj = self.hdr['OBJECT']
+    def _load_data(self, fitsfile, endian=None, lazy=False, **kwargs):
+        """
+        Open the fits file and load the header and the data (self.hdr
+        and self.d) of the primary HDU.
+        """
+        from astropy.io.fits import open as fitsopen
+        from os.path import getsize
+        if self.verbose:
+            print(u'Loading fitsfile :  %s ' % stylify(str(fitsfile),fg='g'))
+            s  = getsize(fitsfile)
+            print(" Size %0.2f MB" % (s/(1024.*1024.)))
+        if lazy:
+            # memory map the file, slicing/indexing self.d later on
+            # only reads the part of the data that is asked for
+            kwargs['memmap'] = True
+        f = fitsopen(fitsfile, **kwargs)
+        if lazy and ('BSCALE' in f[0].header or 'BZERO' in f[0].header):
+            print(stylify('Data is scaled (BSCALE/BZERO), the whole '
+                    'array will be read into memory.', fg='y'))
+        if lazy and endian == 'little':
+            # a byteswap would read (and copy) the whole cube
+            print('Lazy loading, endian keyword ignored (data kept as on disk).')
+            self.hdr, self.d = f[0].header, f[0].data
+        elif endian == 'little':
+            # swap the bytes in place, chunk by chunk, so that the
+            # peak memory use is not doubled by a converted copy
+            self.hdr, self.d = f[0].header, byteswap_inplace(f[0].data)
+        else:
+            # keep the (big endian) data as it is, numpy converts
+            # on the fly in the arithmetic
+            self.hdr, self.d = f[0].header, f[0].data
+        #self.d = self.d[0] # this is if the stokes axis is present,
+        # but it should not be there anymore
+        f.close()
+    @classmethod
+    def from_header(cls, fitsfile, **kwargs):
+        """
+        Create a Fits object from the header only, the data block is
+        never read, and nothing is printed (unless verbose=True is
+        given). Input is a path to a fits file or an astropy Header.
+
+        Usage :
+        ObjectName = Fits.from_header(PathToFitsFile)
+        """
+        kwargs.setdefault('verbose', False)
+        return cls(fitsfile, header_only=True, **kwargs)
     def __str__(self):
         print '\n','='*40
         print ' '*8,'FITS file\n'
         print 'Data type : %s' % str(self.datatype[0])
-        if self.datatype[1] in [3]:
+        if self.datatype[1] in [3] and self.d is not None:
             print 'Shape of image cube : {0}'.format(self.d.shape)
         print 'Object : %s' % self.obj
         if hasattr(self,'beameff'):
@@ -545,27 +620,49 @@ class Fits:
         elif self.diameter == 1:
             print 'You have not changed either the diameter of the telescope or the telescope name'
         self.fov = 58.4*(3.e8/self.restfreq)/float(self.diameter)*3600.
+    def get_channels(self, vals):
+        """
+        The channels with velocities vals = [v1, v2] (or [v1, v2, v3, v4]),
+        see get_indices. Two values give a slice, so self.d[channels] is a
+        view of the data and not a copy. The result is cached, until the
+        velocity axis changes.
+        """
+        cache = self._channel_cache()
+        key = tuple(float(i) for i in vals)
+        if key not in cache[2]:
+            cache[2][key] = get_slice(self.v_arr, vals, order=cache[1])
+        return cache[2][key]
+    def _channel_cache(self):
+        # (v_arr, order of v_arr, {vals: channels}), the order is only
+        # found once for each velocity axis
+        from .helpers import _monotonic
+        cache = getattr(self, '_channels', None)
+        if cache is None or cache[0] is not self.v_arr:
+            cache = self._channels = (self.v_arr, _monotonic(self.v_arr), {})
+        return cache
     def calc_rms(self, nvals, area):
         from scipy import sqrt,array
         i1,i2,j1,j2 = self.parse_region(area)
-        n_channels = get_indices(self.v_arr, nvals)
+        order = self._channel_cache()[1]
+        n_channels = get_indices(self.v_arr, nvals, order=order)
         # just to find out which channels (start, stop) to print
         if len(nvals)==2:
             n = array([n_channels.min(),n_channels.max()])
             nv = self.v_arr[n]
             print "RMS calculated in intervals {0} ({1}) and region {2}".format(n, nv,nvals,area)
         if len(nvals)==4:
-            n_1 = get_indices(self.v_arr,array(nvals)[:2])
+            n_1 = get_indices(self.v_arr,array(nvals)[:2],order=order)
             n_1min = min(n_1)
             n_1max = max(n_1)
-            n_2 = get_indices(self.v_arr,array(nvals)[2:])
+            n_2 = get_indices(self.v_arr,array(nvals)[2:],order=order)
             n_2min = min(n_2)
             n_2max = max(n_2)
             #n = array([n_channels.min(),n_channels.max()])
             #nv = self.v_arr[n]
             print "RMS calculated in intervals {0} and {1} ({2}) and region {3}".format([n_1min,n_1max], [n_2min,n_2max],nvals,area)
-        rms_data = self.d[n_channels]
-        self.rms = sqrt(((rms_data[:, j1:j2, i1:i2])**2).mean())
+        # only read the region, and a view for two values
+        rms_data = self.d[self.get_channels(nvals), j1:j2, i1:i2]
+        self.rms = sqrt((rms_data**2).mean())
         del rms_data
     def add_line(self, name, frequency=None, channels=None, width=None):
         """
@@ -600,9 +697,314 @@ class Fits:
     def change_dist (self, dist):
         self.dist = dist # unit of pc
 
+    def rebin_spectral(self, binning=None, v_arr=None, chunksize=2**22, out=None, dtype=None):
+        """
+        Rebin the cube (or spectrum) along the spectral axis, the data
+        and velocity information before is kept in self.Original
+
+        binning : average every binning channels (reshape and mean,
+                  channels left over at the end are dropped)
+        v_arr   : or rebin flux conserving onto these velocities (km/s),
+                  any channel width, see helpers.rebin_spectral
+        chunksize : number of values (channels x pixels) processed at a
+                  time, a memory mapped cube (lazy=True) is only read
+                  a chunk at a time
+        out     : optional output array of the rebinned shape, e.g. a
+                  numpy.memmap, so that the rebinned cube is not held
+                  in memory either, self.d is then out
+        dtype   : data type of the rebinned data (when out is not
+                  given), default the (floating point) type of self.d
+
+        Usage :
+        cube.rebin_spectral(binning=4)
+        cube.rebin_spectral(v_arr=arange(-10, 20, 0.5))
+        """
+        if self.datatype[0] not in ['CUBE', 'SDSPECT']:
+            raise FitsError('No spectral axis to rebin.')
+        import adapy.libs.cgsconst as _cgs
+        class Original: pass
+        for key in ['d', 'v_arr', 'v_cdelt', 'v_cdeltkms', 'v_crpix', 'v_crval',
+                    'v_naxis', 'v_rangekms', 'v_arr_syscorr', 'f_arr',
+                    'f_crpix', 'f_crval', 'f_cdelt', 'f_naxis']:
+            if hasattr(self, key):
+                setattr(Original, key, getattr(self, key))
+        Original.hdr = self.hdr.copy()
+        self.Original = Original
+        #
+        if dtype is None:
+            dtype = self.d.dtype.newbyteorder('=')
+            if dtype.kind != 'f':
+                dtype = np.float64
+        if binning is not None:
+            v_new = rebin_spectral(self.v_arr, binning=binning)
+            self.d = rebin_spectral(self.d, binning=binning, chunksize=chunksize,
+                                    out=out, dtype=dtype)
+        elif v_arr is not None:
+            v_new = np.asarray(v_arr, dtype=np.float64)
+            self.d = rebin_spectral(self.d, v_in=self.v_arr, v_out=v_new,
+                                    chunksize=chunksize, out=out, dtype=dtype)
+        else:
+            raise ParError('Give binning or v_arr.')
+        # the new (regular) spectral axis
+        self.v_arr = v_new
+        self.v_naxis = len(v_new)
+        self.v_cdelt = (v_new[1] - v_new[0]) * 1e3 if len(v_new) > 1 else self.v_cdelt
+        self.v_cdeltkms = self.v_cdelt / float(1e3)
+        self.v_crpix = 0
+        self.v_crval = v_new[0] * 1e3
+        self.v_rangekms = v_new.max() - v_new.min()
+        self.v_arr_syscorr = self.v_arr - self.v_sys
+        if hasattr(self, 'f_arr'):
+            self.f_arr = self.restfreq * (1. - (self.v_arr - self.v_sys)*1e5 / _cgs.CC)
+        if hasattr(self, 'v_type'):
+            self.hdr['NAXIS' + self.v_type] = self.v_naxis
+            self.hdr['CRPIX' + self.v_type] = self.v_crpix + 1
+            self.hdr['CRVAL' + self.v_type] = self.v_crval
+            self.hdr['CDELT' + self.v_type] = self.v_cdelt
+        elif hasattr(self, 'f_type'):
+            # a frequency axis, regular in frequency as well
+            f_new = calc_frequency(v_new, self.restfreq)
+            self.f_naxis = self.v_naxis
+            self.f_crpix = 0
+            self.f_crval = f_new[0]
+            self.f_cdelt = f_new[1] - f_new[0] if len(f_new) > 1 else self.f_cdelt
+            self.hdr['NAXIS' + self.f_type] = self.f_naxis
+            self.hdr['CRPIX' + self.f_type] = self.f_crpix + 1
+            self.hdr['CRVAL' + self.f_type] = self.f_crval
+            self.hdr['CDELT' + self.f_type] = self.f_cdelt
+
+    def convolve_to_beam(self, bmaj, bmin=None, bpa=0, batch=16, nthreads=1, verbose=True):
+        """
+        Convolve the image/cube to a (larger) beam, all channels with
+        the same kernel, in Fourier space (FFT)
+
+        bmaj, bmin : the FWHM of the new beam (asecs), bmin=bmaj if
+                     not given
+        bpa        : position angle of the new beam (degrees)
+        batch      : number of channels transformed together
+        nthreads   : the batches are divided over this many threads
+
+        The convolving kernel is the new beam deconvolved with the
+        current beam (helpers.gauss2d_decon), and applied analytically
+        in Fourier space, with zero padding so nothing wraps around.
+        Images in Jy/beam are scaled with the ratio of the beam areas.
+        NaN pixels stay NaN. bmaj, bmin, bpa and the header are updated.
+
+        Usage :
+        cube.convolve_to_beam(2.0, 1.5, 30., nthreads=4)
+        """
+        from multiprocessing.pool import ThreadPool
+        if not hasattr(self, 'bmaj'):
+            raise FitsError('The current beam (BMAJ, BMIN, BPA) is not known.')
+        if bmin is None:
+            bmin = bmaj
+        kmaj, kmin, kpa, success = gauss2d_decon((bmaj, bmin, float(bpa),
+                                    float(self.bmaj), float(self.bmin),
+                                    float(self.bpa)), ang='deg')
+        if success == 2:
+            raise ParError('Can not convolve to a beam that is smaller '
+                            'than the current beam, in any direction.')
+        d = self.d if self.d.ndim == 3 else self.d[None]
+        nchan, ny, nx = d.shape
+        out = np.empty(d.shape, dtype=np.float32)
+        scale = 1.
+        if 'BEAM' in str(self.hdr.get('BUNIT', '')).upper():
+            scale = (bmaj * bmin) / float(self.bmaj * self.bmin)
+        if success == 1:
+            # (close to) the same beam, nothing to convolve
+            kernel = None
+        else:
+            # pad by 4 sigma of the kernel major axis, in pixels
+            pad = int(np.ceil(4 * kmaj / 2.3548 / min(abs(self.ra_cdelt), abs(self.dec_cdelt))))
+            kernel = _gauss_ft(ny + 2 * pad, nx + 2 * pad, self.ra_cdelt,
+                                self.dec_cdelt, kmaj, kmin, kpa)
+        def work(c0):
+            img = np.asarray(d[c0:c0 + batch], dtype=np.float64)
+            blank = np.isnan(img)
+            if kernel is not None:
+                big = np.zeros((len(img), ny + 2 * pad, nx + 2 * pad))
+                big[:, pad:pad + ny, pad:pad + nx] = np.where(blank, 0, img)
+                big = np.fft.irfft2(np.fft.rfft2(big) * kernel, s=big.shape[1:])
+                img = big[:, pad:pad + ny, pad:pad + nx]
+            img *= scale
+            img[blank] = np.nan
+            out[c0:c0 + batch] = img
+        starts = range(0, nchan, batch)
+        if nthreads > 1:
+            pool = ThreadPool(min(nthreads, len(starts)))
+            try:
+                pool.map(work, starts)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for c0 in starts:
+                work(c0)
+        self.d = out if self.d.ndim == 3 else out[0]
+        #
+        self.bmaj = Unit(bmaj, 'asecs')
+        self.bmin = Unit(bmin, 'asecs')
+        self.bpa = Unit(bpa, 'degrees?')
+        self.hdr['BMAJ'] = bmaj / 3600.
+        self.hdr['BMIN'] = bmin / 3600.
+        self.hdr['BPA'] = bpa
+        self.hdr['BITPIX'] = -32
+        if hasattr(self, 'gain'):
+            self.gain = 8.168e-25*(self.restfreq)**2*self.bmin*self.bmaj
+        if verbose:
+            print 'Convolved with kernel {0:.3f} x {1:.3f} asecs, PA {2:.1f} deg'.format(kmaj, kmin, kpa)
+
     def box_cut(self,region=[-10,10,-10,10]):
         pass
 
+# BEAM CONVOLUTION
+def _gauss_ft(ny, nx, ra_cdelt, dec_cdelt, bmaj, bmin, bpa):
+    # Fourier transform (rfft2 layout) of a normalized elliptical
+    # gaussian, FWHM bmaj x bmin (asecs), PA bpa (deg, east of north),
+    # on a grid with pixel sizes ra_cdelt, dec_cdelt (asecs)
+    fy = np.fft.fftfreq(ny)[:, None] / dec_cdelt
+    fx = np.fft.rfftfreq(nx)[None, :] / ra_cdelt
+    pa = np.radians(bpa)
+    fmaj = fx * np.sin(pa) + fy * np.cos(pa)
+    fmin = fx * np.cos(pa) - fy * np.sin(pa)
+    smaj, smin = bmaj / 2.3548200450309493, bmin / 2.3548200450309493
+    return np.exp(-2 * np.pi**2 * ((smaj * fmaj)**2 + (smin * fmin)**2))
+
+# REGRIDDING OF CUBES
+def common_velocities(cubes, syscorr=False):
+    """
+    The velocity channels (km/s) that all the cubes cover, with the
+    widest channel width of the cubes
+    """
+    lo, hi, dv = [], [], []
+    for cube in cubes:
+        v = cube.v_arr_syscorr if syscorr else cube.v_arr
+        edges = channel_edges(v)
+        lo.append(edges[0].min())
+        hi.append(edges[1].max())
+        dv.append(abs(cube.v_cdeltkms))
+    lo, hi, dv = max(lo), min(hi), max(dv)
+    if hi - lo < dv:
+        raise FitsError('The cubes have no velocities in common.')
+    return lo + dv * (np.arange(int((hi - lo) / dv + 1e-9)) + 0.5)
+
+def _regrid_header(cube, v_arr):
+    # the header of the cube with the new spectral axis, 32 bit floats,
+    # a frequency axis stays one (converted with the rest frequency)
+    hdr = cube.hdr.copy()
+    hdr['BITPIX'] = -32
+    for key in ['BSCALE', 'BZERO', 'BLANK']:
+        if key in hdr:
+            del hdr[key]
+    if hasattr(cube, 'v_type'):
+        ax, crval = cube.v_type, v_arr[0] * 1e3
+        cdelt = (v_arr[1] - v_arr[0]) * 1e3 if len(v_arr) > 1 else cube.v_cdelt
+        hdr['CTYPE' + ax] = cube.v_ctype
+    else:
+        f_arr = calc_frequency(v_arr, cube.restfreq)
+        ax, crval = cube.f_type, float(f_arr[0])
+        cdelt = float(f_arr[1] - f_arr[0]) if len(v_arr) > 1 else cube.f_cdelt
+    hdr['NAXIS' + ax] = len(v_arr)
+    hdr['CRPIX' + ax] = 1
+    hdr['CRVAL' + ax] = crval
+    hdr['CDELT' + ax] = cdelt
+    return hdr
+
+def regrid_cubes(cubes, v_arr=None, outfiles=None, stackfile=None,
+                syscorr=False, overwrite=False, verbose=True):
+    """
+    Regrid cubes onto a common velocity axis (flux conserving, see
+    helpers.rebin_weights), and/or stack (average) them
+
+    The output is written one channel at a time (astropy StreamingHDU),
+    and for each output channel only the input channels that overlap it
+    are read, so with memory mapped cubes (Fits(..., lazy=True)) only a
+    few images are in memory at any time.
+
+    cubes     : Fits objects (with a velocity or frequency axis, the
+                velocities v_arr are used), or file names that are then
+                opened memory mapped. A frequency axis is written as a
+                frequency axis again, with the cube's rest frequency
+    v_arr     : the common velocities (km/s), default the range all the
+                cubes cover, with the widest channels (common_velocities)
+    outfiles  : a file name for each regridded cube (or None)
+    stackfile : file name for the average of the regridded cubes (NaN
+                pixels are left out), the cubes need the same image grid
+    syscorr   : regrid the velocities corrected for each cube's v_sys
+                (v_arr_syscorr)
+
+    Returns the common velocities.
+
+    Usage :
+    v = regrid_cubes(['spw1.fits', 'spw2.fits'], outfiles=['spw1_rg.fits',
+                    'spw2_rg.fits'], stackfile='stack.fits')
+    """
+    import os
+    from astropy.io.fits import StreamingHDU
+    cubes = [Fits(i, lazy=True, verbose=False) if isinstance(i, str) else i
+            for i in cubes]
+    for cube in cubes:
+        if cube.datatype[0] != 'CUBE' or not (hasattr(cube, 'v_type') or hasattr(cube, 'f_type')):
+            raise FitsError('Can only regrid cubes with a velocity or frequency axis.')
+    if outfiles is None and stackfile is None:
+        raise ParError('Give outfiles and/or stackfile.')
+    if outfiles is not None and len(outfiles) != len(cubes):
+        raise ParError(outfiles)
+    if stackfile is not None and len(set(cube.d.shape[1:] for cube in cubes)) > 1:
+        raise FitsError('Can only stack cubes with the same image size.')
+    if v_arr is None:
+        v_arr = common_velocities(cubes, syscorr=syscorr)
+    v_arr = np.asarray(v_arr, dtype=np.float64)
+    #
+    names = [i for i in (outfiles or []) + [stackfile] if i is not None]
+    for name in names:
+        if os.path.exists(name):
+            if not overwrite:
+                raise IOError('{0} exists, use overwrite=True.'.format(name))
+            # a StreamingHDU appends to an existing file
+            os.remove(name)
+    weights = []
+    for cube in cubes:
+        W, coverage = rebin_weights(cube.v_arr_syscorr if syscorr else cube.v_arr, v_arr)
+        weights.append((W, coverage < 1 - 1e-6))
+    streams = [None] * len(cubes)
+    if outfiles is not None:
+        streams = [StreamingHDU(name, _regrid_header(cube, v_arr))
+                    for name, cube in zip(outfiles, cubes)]
+    stack = None
+    if stackfile is not None:
+        hdr = _regrid_header(cubes[0], v_arr)
+        hdr['HISTORY'] = 'Average of {0} regridded cubes'.format(len(cubes))
+        stack = StreamingHDU(stackfile, hdr)
+    try:
+        for j in xrange(len(v_arr)):
+            total, count = None, None
+            for cube, (W, uncovered), stream in zip(cubes, weights, streams):
+                row = W.getrow(j)
+                img = np.zeros(cube.d.shape[1:], dtype=np.float64)
+                for i, w in zip(row.indices, row.data):
+                    img += w * np.asarray(cube.d[i], dtype=np.float64)
+                if uncovered[j]:
+                    img.fill(np.nan)
+                if stream is not None:
+                    stream.write(img.astype(np.float32))
+                if stack is not None:
+                    if total is None:
+                        total, count = np.zeros(img.shape), np.zeros(img.shape)
+                    good = np.isfinite(img)
+                    total[good] += img[good]
+                    count += good
+            if stack is not None:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    stack.write((total / count).astype(np.float32))
+            if verbose and (j + 1) % 100 == 0:
+                print 'Channel {0} of {1}'.format(j + 1, len(v_arr))
+    finally:
+        for stream in streams + [stack]:
+            if stream is not None:
+                stream.close()
+    return v_arr
+
 # UV-FITS DATA CLASS
 class Uvfits(object):
     """
@@ -1011,263 +1413,6 @@ class Uvfits(object):
 
 #########################
 
-def uv_bin_vector(uvdist, re, im, wt, start='zero', binsize=10, nbins=50, weighted=False):
-    """
-
-    Vector averaging of amplitudes
-    Calculate the binned amplitude and various related things.
-    The binned amplitude is calculated from the real and imaginary
-    part of the visibilities.
-    
-    
-    zero : where to start the binning, at uvdist = 0, or min(uvdist)
-
-    Description
-    ===========
-    Vector binning of the amplitude, first bin the real and
-    imaginary parts as
-    RE = sum(RE_i)/Np (Mean) (not the weighted mean, should be?)
-    RE_sig = sqrt( ( sum(RE_i^2) - Np * RE^2 ) / (Np - 1) )
-    (-1 because we determined the mean)
-    the same goes for the Imaginary part.
-    
-    the square root of the sum of the squared real and imaginary parts
-    A = sqrt( RE^2 + IM^2 )
-
-    and the error propagation of the
-    variance of the real and imaginary parts
-    A_sig = sqrt( ((RE*RE_sig/A)^2 + (IM*IM_sig/A)^2) / (Np - 2) )
-    
-
-    NOTES
-    =====
-    Some parts divide with possible zeros.
-    This operation will create 'nan' entries which messes things
-    when running calculations on it, i.e. nan*2 = nan
-    therefore I've started using masked arrays.
-
-    
-    """
-    class Binned_Vector(object):
-            pass
-    ##### CORE CALC START #####
-    if start in ['zero', 0, '0']:
-        uvmin = 0.0
-    elif start in ['min']:
-        uvmin = uvdist.min()
-    uvmax = uvmin + binsize * (int(nbins) + 0.5)
-    # Define the bins, from uvmin to uvmax
-    arr_bins = _sp.arange(_sp.floor(uvmin),
-                            _sp.ceil(uvmax),
-                            binsize)
-    # mid-points of the bins
-    arr_bins1 = 0.5*(arr_bins[1:] + arr_bins[:-1])
-    minmax = zip(arr_bins[:-1], arr_bins[1:])
-    # only choose data with positive weigths
-    pos_wt = wt>= 0.0
-    def filter_points(i,j):
-        # find the indices of data within the limits and
-        # with positive weigths
-        # i:lower boundary, j:upper boundary
-        return ( (uvdist>=i) * (uvdist<j) * pos_wt).nonzero()[0]
-    isubs = [filter_points(i,j) for i,j in minmax]
-    npoints = _sp.array([len(i) for i in isubs])       # points in each interval
-    ###########################################################################
-    # Real and Imaginary data binning
-    data = _sp.array([re[:], im[:]])
-    # mean for Re and Im separately
-    if not weighted:
-        # changed this
-        #~ data_mean = _sp.array([data[:,i].mean(axis=1) for i in isubs])
-        # to this instead, got some problems with not explicitly setting
-        # value to nan, do not rely on mean or average to take care of it
-        # here we use a masked array, which handles the nan much better
-        # removed masked arrays again!
-        # print('method takes into account nan raw data values')
-        data_mean =  _sp.array([_sp.nanmean(data[:,i], axis=1) if j>0 else _sp.array([_sp.nan, _sp.nan]) for i,j in zip(isubs,npoints)])
-        #~ check = _sp.array([npoints==0, npoints==0]).T
-        #~ data_mean = _sp.ma.masked_array(data_mean, check, fill_value=_sp.nan)
-        #~ data_mean = _sp.ma.masked_array(data_mean,_sp.isnan(data_mean), fill_value=_sp.nan)
-    elif weighted:
-        print ('Calculating weighted average real and imaginary amplitudes')
-        print ('method does not take into account nan raw data values')
-        # doesn't work if isubs is empty somewhere
-        #~ data_mean = _sp.array([_sp.average(data[:,i], axis=1, weights=wt[i]) for i in isubs])
-        data_mean = _sp.array([_sp.average(data[:,i], axis=1, weights=wt[i]) if j>0 else _sp.array([_sp.nan, _sp.nan]) for i,j in zip(isubs,npoints)], dtype='float')
-        #~ data_mean = _sp.ma.masked_array(data_mean,_sp.isnan(data_mean))
-    # Error of real and imaginary data
-    #~ data_var = _sp.array([_sp.var(data[:,i], ddof=1, axis=1) if j>0 else _sp.array([_sp.nan, _sp.nan]) for i,j in zip(isubs,npoints)])
-    # ddof = j-1, the number of points in bin, minus the parameter determined
-    # i.e. the mean.
-    data_var = _sp.array([_sp.var(data[:,i], ddof=1, axis=1) if j>0 else _sp.array([_sp.nan, _sp.nan]) for i,j in zip(isubs,npoints)])
-    #~ data_var = _sp.ma.masked_array(data_var,_sp.isnan(data_var), fill_value=_sp.nan)
-
-    #~ data_var[data_var==-0] = _sp.nan
-    #~ data_var = _sp.ma.masked_array(data_var, data_var==-0, fill_value=_sp.nan)
-
-    #~ data_std = _sp.ma.sqrt(data_var)
-    data_std = data_var**0.5 # used sqrt here before, got floating point error
-    # Amplitude binning
-    amp_mean = ( (data_mean**2).sum(axis=1) )**0.5
-    #~ amp_mean = _sp.sqrt( (data_mean**2).sum(axis=1) )
-    amp_tmp = amp_mean.reshape((len(amp_mean), 1))
-    # calculate the variance of the amplitude
-    # error propagation of the variance of the imaginary
-    # and real parts
-    # if the amp_temp is close to zero, we can end up with
-    # inf in variance.
-    pars=2
-    dof = _sp.array([float(i-pars) if i>0 else 0.0 for i in npoints])
-    amp_var = (( ( data_mean * data_var / amp_tmp )**2).sum(axis=1)
-        / ( dof ) )**0.5
-    amp_std = amp_var**0.5
-    # Signal to Noise (SNR), _sp.divide gives 0 when dividing by 0
-    amp_snr = _sp.divide( amp_mean, amp_var )
-    # expectation value when no signal
-    amp_expt = _sp.sqrt( _sp.pi / 2. ) * amp_var
-    ###########################################################################
-    # get the binned real and imaginary parts
-    re_mean, im_mean = data_mean.T
-    re_var, im_var = data_var.T
-    re_std, im_std = data_std.T
-    # Signal to Noise (SNR), _sp.divide gives 0 when dividing by 0
-    re_snr, im_snr = _sp.divide(data_mean, data_var).T
-    # expectation value when no signal
-    re_expt, im_expt = _sp.sqrt( _sp.pi / 2. ) * data_var.T
-
-    ###########################################################################
-    ##### CORE CALC END #####
-
-    # store in class        
-    #~ Binned_Vector.nbin = nbin
-    Binned_Vector.npoints = npoints
-    Binned_Vector.bins = arr_bins1
-    Binned_Vector.uvdist_klam = arr_bins1
-    Binned_Vector.amp = amp_mean
-    Binned_Vector.amp_var = amp_var
-    Binned_Vector.amp_std = amp_std
-    Binned_Vector.data = data_mean
-    Binned_Vector.data_var = data_var
-    Binned_Vector.data_std = data_std
-    Binned_Vector.snr = amp_snr
-    Binned_Vector.expt = amp_expt
-    # store Re in class        
-    Binned_Vector.re = re_mean
-    Binned_Vector.re_var = re_var
-    Binned_Vector.re_snr = re_snr
-    Binned_Vector.re_expt = re_expt
-    # store Im in class        
-    Binned_Vector.im = im_mean
-    Binned_Vector.im_var = im_var
-    Binned_Vector.im_snr = im_snr
-    Binned_Vector.im_expt = im_expt
-    
-    return Binned_Vector
-
-def uv_bin_scalar(uvdist, re, im, wt, start='zero', binsize=10, nbins=50, weighted=False):
-    """
-    Scalar averaging amplitudes
-    
-    NOTES
-    =====
-    Some parts divide with possible zeros.
-    This operation will create 'nan' entries which messes things
-    when running calculations on it, i.e. nan*2 = nan
-    therefore I've started using masked arrays.
-    
-    """
-    class Binned_Scalar(object):
-            pass
-    ##### CORE CALC START #####
-    if start in ['zero', 0, '0']:
-        uvmin = 0.0
-    elif start in ['min']:
-        uvmin = uvdist.min()
-    uvmax = uvmin + binsize * (int(nbins) + 0.5)
-    #~ binsize = int(round(((uvmax-uvmin)/nbins), 0 ))
-    # Define the bins, from uvmin to uvmax
-    #~ arr_bins = _sp.linspace(uvmin, uvmax, nbins)
-    arr_bins = _sp.arange(_sp.floor(uvmin),
-                            _sp.ceil(uvmax),
-                            binsize)
-    #~ print ('{0} bins with {1} binsize'.format(nbins, binsize))
-    #~ print len(arr_bins)
-    # mid-points of the bins
-    arr_bins1 = 0.5*(arr_bins[1:] + arr_bins[:-1])
-    minmax = zip(arr_bins[:-1], arr_bins[1:])
-    # only choose data with positive weigths
-    pos_wt = wt>= 0.0
-    def filter_points(i,j):
-        # find the indices of data within the limits and
-        # with positive weigths
-        # i:lower boundary, j:upper boundary
-        return ( (uvdist>=i) * (uvdist<j) * pos_wt).nonzero()[0]
-    isubs = [filter_points(i,j) for i,j in minmax]
-    npoints = _sp.array([len(i) for i in isubs])       # points in each interval
-    ###########################################################################
-    # AMPLITUDE 
-    amp = _sp.sqrt(re**2 + im**2)
-    # PHASE
-    pha = _sp.arctan2(im, re)
-    pha_deg = pha / _sp.pi * 180.
-    # put amp and pha in an array
-    data = _sp.array([amp, pha])
-    # ERROR / SIGMA
-    #TODO : check
-    # following 1.0e6 is just for GILDAS, change if needed
-    #~ print('NB : Error calculated from weights assuming GILDAS '
-    #~ 'data (i.e. frequencies in MHz).')
-    #~ self.sigma = 1/sqrt(self.wt*1.0e6)
-    # Daniels way of calculating sigma
-    # test this first
-    sigma = _sp.sqrt(0.5 / ( wt * float(amp.shape[0]) ) )
-    
-    if not weighted:
-        data_mean = _sp.array([_sp.nanmean(data[:,i], axis=1) if j>0 else _sp.array([_sp.nan, _sp.nan]) for i,j in zip(isubs,npoints)])
-        # above operation create some 'nan' entries which messes things up
-        # later on if we're not using a masked array
-        #~ data_mean = _sp.ma.masked_array(data_mean,_sp.isnan(data_mean))
-    elif weighted:
-        print ('Calculating weighted average amplitudes')
-        data_mean = _sp.array([_sp.average(data[:,i], axis=1, weights=wt[i]) if j>0 else _sp.array([_sp.nan, _sp.nan])  for i,j in zip(isubs,npoints)])
-        #~ data_mean = _sp.ma.masked_array(data_mean,_sp.isnan(data_mean), fill_value=_sp.nan)
-    # variance and standard deviation
-    data_var = _sp.array([_sp.var(data[:,i], ddof=1, axis=1) if j>0 else _sp.array([_sp.nan, _sp.nan]) for i,j in zip(isubs,npoints)])
-    #~ data_var[data_var==-0] = _sp.nan
-    #~ data_var = _sp.ma.masked_array(data_var, data_var == -0, fill_value=_sp.nan)
-    data_std = data_var**0.5
-    
-    amp_mean, pha_mean = data_mean.T
-    amp_var, pha_var = data_var.T
-    amp_std, pha_std = data_std.T
-    
-    # Signal to Noise (SNR), _sp.divide gives 0 when dividing by 0
-    amp_snr, pha_snr = _sp.divide(data_mean, data_var).T
-    # expectation value when no signal
-    amp_expt, pha_expt = _sp.sqrt( _sp.pi / 2. ) * data_var.T
-    
-    ###########################################################################
-    ##### CORE CALC END #####
-
-    # store in class        
-    #~ Binned.nbin = nbin
-    Binned_Scalar.npoints = npoints
-    Binned_Scalar.bins = arr_bins1
-    Binned_Scalar.uvdist_klam = arr_bins1
-    Binned_Scalar.data = data_mean
-    Binned_Scalar.data_var = data_var
-    Binned_Scalar.amp = amp_mean
-    Binned_Scalar.amp_var = amp_var
-    Binned_Scalar.amp_snr = amp_snr
-    Binned_Scalar.amp_expt = amp_expt
-    Binned_Scalar.pha = pha_mean
-    Binned_Scalar.pha_var = pha_var
-    Binned_Scalar.pha_snr = pha_snr
-    Binned_Scalar.pha_expt = pha_expt
-    
-    # send back an object with all the data structures
-    return Binned_Scalar
-
 def translate(uv_klam, reim, offset):
     print ('Has a -1 multiplied here, is this right?')
     phas = -1.0*( ((uv_klam[0])*(offset[0]/pc2au)) +
@@ -1 +1,2 @@
 import mpfit
+import batchlm
@@ -0,0 +1,198 @@
+"""
+Levenberg-Marquardt for many small, independent problems at once
+
+Instead of one mpfit call per problem (e.g. per pixel of a cube), all
+problems are stepped together : the damped normal equations of every
+problem are stacked, (n, npar, npar), scaled to a unit diagonal, and
+solved with one call to the batched Cholesky factorisation of numpy
+(and a substitution that runs over the parameters, not the problems).
+Only the problems where the factorisation fails are solved one by one
+(least squares). Problems that have converged are dropped from the
+active set, the others continue.
+
+The function to minimise gets the parameters of a set of problems and
+their indices, and returns the residuals (deviates) and the jacobian
+of the residuals with respect to the parameters :
+
+    def fcn(P, index):
+        # P (n, npar), index (n,) into the problems
+        return resid, jac       # (n, m), (n, m, npar)
+
+Usage :
+    fit = batch_lm(fcn, p0, limits=(lo, hi), fixed=[0, 0, 1])
+    fit.params, fit.perror, fit.chi2, fit.status
+
+"""
+import numpy as _np
+
+__all__ = ['batch_lm']
+
+# the status codes, as in mpfit
+STATUS = {0 : 'Improper input (not finite)',
+          1 : 'Relative reduction of chi2 at most ftol',
+          2 : 'Relative change of the parameters at most xtol',
+          3 : 'Both 1 and 2',
+          4 : 'Gradient at most gtol',
+          5 : 'Maximum number of iterations reached',
+          6 : 'No further reduction of chi2 possible'}
+
+class BatchFit:
+    pass
+
+def _normal(resid, jac, free):
+    # the normal equations, with the fixed parameters taken out
+    chi2 = _np.einsum('ij,ij->i', resid, resid)
+    A = _np.einsum('ijk,ijl->ikl', jac, jac)
+    g = _np.einsum('ijk,ij->ik', jac, resid)
+    fix = (~free).nonzero()[0]
+    A[:, fix, :] = 0
+    A[:, :, fix] = 0
+    A[:, fix, fix] = 1
+    g[:, fix] = 0
+    return chi2, A, g
+
+def _stacked(func, fallback, *arrays):
+    # func of the stacked problems, if it fails the stack is split in
+    # halves, so that only the problems that fail go to fallback
+    try:
+        return func(*arrays)
+    except _np.linalg.LinAlgError:
+        if len(arrays[0]) == 1:
+            return fallback(*[a[0] for a in arrays])[None]
+        h = len(arrays[0]) // 2
+        return _np.concatenate([_stacked(func, fallback, *[a[:h] for a in arrays]),
+                                _stacked(func, fallback, *[a[h:] for a in arrays])])
+
+def _cho_solve(A, b):
+    # stacked Cholesky solve, L L^T x = b, the substitutions loop over
+    # the (few) parameters
+    L = _np.linalg.cholesky(A)
+    npar = b.shape[1]
+    y = _np.empty_like(b)
+    for k in range(npar):
+        y[:, k] = (b[:, k] - _np.einsum('ij,ij->i', L[:, k, :k], y[:, :k])) / L[:, k, k]
+    x = _np.empty_like(b)
+    for k in range(npar - 1, -1, -1):
+        x[:, k] = (y[:, k] - _np.einsum('ij,ij->i', L[:, k+1:, k], x[:, k+1:])) / L[:, k, k]
+    return x
+
+def _lstsq(a, c):
+    return _np.linalg.lstsq(a, c, rcond=None)[0]
+
+def _covariance(A, free):
+    C = _stacked(_np.linalg.inv, _np.linalg.pinv, A)
+    C[:, ~free, :] = 0
+    C[:, :, ~free] = 0
+    return C
+
+def batch_lm(fcn, p0, limits=None, fixed=None, maxiter=200, ftol=1e-10,
+            xtol=1e-10, gtol=1e-10, lambda0=1., npoints=None, quiet=True):
+    """
+    Fit n independent problems with the Levenberg-Marquardt method
+
+    fcn : function of (P, index), see the module docstring
+    p0 : start parameters, (n, npar)
+    limits : (lo, hi), each broadcastable to (n, npar), use -inf/inf
+             for unlimited parameters. Steps are clipped to the limits.
+    fixed : (npar,) booleans, the parameters that are kept at p0
+    maxiter : maximum number of iterations
+    ftol, xtol, gtol : tolerances as in mpfit, on the relative
+             reduction of chi2, the relative change of the parameters,
+             and the cosine between the residuals and the jacobian
+    lambda0 : start value of the damping
+    npoints : number of data points of each problem, (n,), for the
+            degrees of freedom when some residuals are masked (zero)
+            (default m)
+
+    Returns an object with
+        params, perror (n, npar), covar (n, npar, npar),
+        chi2, dof, niter, status (n,), nfev
+    perror is the 1 sigma error from the covariance matrix, not scaled
+    with the reduced chi2, the same as mpfit.
+    """
+    P = _np.array(p0, dtype=_np.float64)
+    if P.ndim != 2:
+        raise ValueError('p0 has to be (n, npar).')
+    n, npar = P.shape
+    free = _np.ones(npar, dtype=bool)
+    if fixed is not None:
+        free = ~_np.asarray(fixed, dtype=bool)
+    if limits is None:
+        lo, hi = -_np.inf, _np.inf
+    else:
+        lo, hi = limits
+    lo = _np.broadcast_to(_np.asarray(lo, dtype=_np.float64), P.shape)
+    hi = _np.broadcast_to(_np.asarray(hi, dtype=_np.float64), P.shape)
+    P = _np.clip(P, lo, hi)
+    #
+    index = _np.arange(n)
+    status = _np.zeros(n, dtype=int)
+    niter = _np.zeros(n, dtype=int)
+    lam = _np.empty(n)
+    lam.fill(lambda0)
+    resid, jac = fcn(P, index)
+    m = resid.shape[1]
+    chi2, A, g = _normal(resid, jac, free)
+    nfev = 1
+    # problems with a bad start are not fitted
+    active = _np.isfinite(chi2) & _np.isfinite(A).all(axis=(1, 2))
+    for it in xrange(maxiter):
+        act = active.nonzero()[0]
+        if not len(act):
+            break
+        niter[act] += 1
+        a, gg = A[act], g[act]
+        # gradient test, cosine between the residuals and the jacobian
+        diag = _np.einsum('ikk->ik', a)
+        cos = abs(gg) / _np.sqrt(diag * chi2[act, None] + 1e-300)
+        done = (cos[:, free].max(axis=1) <= gtol)
+        status[act[done]] = 4
+        active[act[done]] = False
+        act, a, gg, diag = act[~done], a[~done], gg[~done], diag[~done]
+        if not len(act):
+            break
+        # the damped step, scaled with the diagonal (Marquardt), the
+        # system is solved scaled to a unit diagonal, (S A S + lam) z = S g
+        # with dp = S z, for the condition of the Cholesky factorisation
+        D = _np.maximum(diag, 1e-300 + 1e-12 * diag.max(axis=1)[:, None])
+        S = 1. / _np.sqrt(D)
+        damped = a * S[:, :, None] * S[:, None, :]
+        damped[:, range(npar), range(npar)] += lam[act, None]
+        dp = -S * _stacked(_cho_solve, _lstsq, damped, gg * S)
+        Pt = _np.clip(P[act] + dp, lo[act], hi[act])
+        rt, jt = fcn(Pt, act)
+        nfev += 1
+        chi2t, At, gt = _normal(rt, jt, free)
+        better = _np.isfinite(chi2t) & (chi2t <= chi2[act])
+        # accepted steps
+        acc = act[better]
+        dchi2 = chi2[acc] - chi2t[better]
+        dx = abs(Pt[better] - P[acc])[:, free]
+        small_x = (dx <= xtol * (abs(P[acc][:, free]) + xtol)).all(axis=1)
+        small_f = dchi2 <= ftol * chi2[acc]
+        P[acc] = Pt[better]
+        chi2[acc], A[acc], g[acc] = chi2t[better], At[better], gt[better]
+        lam[acc] = _np.maximum(lam[acc] / 10., 1e-12)
+        conv = small_f | small_x
+        status[acc[conv]] = small_f[conv] * 1 + small_x[conv] * 2
+        active[acc[conv]] = False
+        # rejected steps, more damping
+        rej = act[~better]
+        lam[rej] *= 10.
+        stuck = rej[lam[rej] > 1e16]
+        status[stuck] = 6
+        active[stuck] = False
+        if not quiet:
+            print('Iteration {0}, {1} of {2} problems active'.format(it + 1, active.sum(), n))
+    status[active] = 5
+    #
+    fit = BatchFit()
+    fit.params = P
+    fit.covar = _covariance(A, free)
+    fit.perror = _np.sqrt(_np.clip(_np.einsum('ikk->ik', fit.covar), 0, None))
+    fit.chi2 = chi2
+    fit.dof = (m if npoints is None else _np.asarray(npoints)) - free.sum()
+    fit.niter = niter
+    fit.status = status
+    fit.nfev = nfev
+    return fit
@@ -412,6 +412,14 @@ import numpy
 import types
 import scipy.lib.blas
 
+class _FcnCall:
+    # fcn(x, fjac=None, **functkw) as a picklable callable for pool.map
+    def __init__(self, fcn, functkw):
+        self.fcn = fcn
+        self.functkw = functkw
+    def __call__(self, x):
+        return self.fcn(x, fjac=None, **self.functkw)
+
 #    Original FORTRAN documentation
 #    **********
 #
@@ -605,7 +613,8 @@ class mpfit:
                  damp=0., maxiter=200, factor=100., nprint=1,
                  iterfunct='default', iterkw={}, nocovar=0,
                  rescale=0, autoderivative=1, quiet=0,
-                 diag=None, epsfcn=None, debug=0):
+                 diag=None, epsfcn=None, debug=0, pool=None, vectorized=0,
+                 linalg='minpack'):
         """
   Inputs:
     fcn:
@@ -717,6 +726,34 @@ class mpfit:
         can be made in a single iteration.
         Default value: 1
 
+     pool:
+        An object with a map method (e.g. multiprocessing.Pool or
+        multiprocessing.pool.ThreadPool) used to evaluate the perturbed
+        parameter vectors of the finite difference jacobian concurrently,
+        instead of one after the other. With a process pool, fcn (and
+        functkw) must be picklable, i.e. a module level function.
+        The jacobian is the same (bitwise) as without a pool.
+        Default: None, serial evaluation
+
+     vectorized:
+        Set this keyword if fcn also accepts a 2D array of parameter
+        vectors, shape (k, npar), and then returns [status, f] with f of
+        shape (k, m). The finite difference jacobian is then calculated
+        with one call of fcn. Each row of f should be the same as the
+        result of fcn for that row alone.
+        Default: clear (=0)
+
+     linalg:
+        The linear algebra of each iteration, 'minpack' for the Python
+        translation of the MINPACK routines (qrfac, qrsolv, lmpar and
+        calc_covar), or 'lapack' to do the pivoted QR factorization,
+        the triangular solves and the covariance matrix with LAPACK
+        (scipy.linalg). The lapack version is much faster for many
+        residuals and parameters, the iterations are the same up to
+        rounding. Parameter limits, ties and the covariance matrix are
+        handled the same way.
+        Default: 'minpack'
+
      parinfo
         Provides a mechanism for more sophisticated constraints to be placed on
         parameter values.  When parinfo is not passed, then it is assumed that
@@ -851,6 +888,13 @@ class mpfit:
         self.nfev = 0
         self.damp = damp
         self.dof=0
+        self.pool = pool
+        self.vectorized = vectorized
+        self.linalg = linalg
+
+        if linalg not in ['minpack', 'lapack']:
+            self.errmsg = 'ERROR: linalg must be \'minpack\' or \'lapack\''
+            return
 
         if fcn==None:
             self.errmsg = "Usage: parms = mpfit('myfunt', ... )"
@@ -1097,7 +1141,10 @@ class mpfit:
                             fjac[:,whupeg[i]] = 0
 
             # Compute the QR factorization of the jacobian
-            [fjac, ipvt, wa1, wa2] = self.qrfac(fjac, pivot=1)
+            if self.linalg == 'lapack':
+                [fjac, ipvt, wa1, wa2, qtf] = self.qrfac_lapack(fjac, fvec)
+            else:
+                [fjac, ipvt, wa1, wa2] = self.qrfac(fjac, pivot=1)
             
             # On the first iteration if "diag" is unspecified, scale
             # according to the norms of the columns of the initial jacobian
@@ -1116,26 +1163,28 @@ class mpfit:
                     delta = factor
 
             # Form (q transpose)*fvec and store the first n components in qtf
+            # (qrfac_lapack already did, and returned R itself)
             catch_msg = 'forming (q transpose)*fvec'
-            wa4 = fvec.copy()
-            for j in range(n):
-                lj = ipvt[j]
-                temp3 = fjac[j,lj]
-                if temp3 != 0:
-                    fj = fjac[j:,lj]
-                    wj = wa4[j:]
-                    # *** optimization wa4(j:*)
-                    wa4[j:] = wj - fj * sum(fj*wj) / temp3
-                fjac[j,lj] = wa1[j]
-                qtf[j] = wa4[j]
-            # From this point on, only the square matrix, consisting of the
-            # triangle of R, is needed.
-            fjac = fjac[0:n, 0:n]
-            fjac.shape = [n, n]
-            temp = fjac.copy()
-            for i in range(n):
-                temp[:,i] = fjac[:, ipvt[i]]
-            fjac = temp.copy()
+            if self.linalg != 'lapack':
+                wa4 = fvec.copy()
+                for j in range(n):
+                    lj = ipvt[j]
+                    temp3 = fjac[j,lj]
+                    if temp3 != 0:
+                        fj = fjac[j:,lj]
+                        wj = wa4[j:]
+                        # *** optimization wa4(j:*)
+                        wa4[j:] = wj - fj * sum(fj*wj) / temp3
+                    fjac[j,lj] = wa1[j]
+                    qtf[j] = wa4[j]
+                # From this point on, only the square matrix, consisting of the
+                # triangle of R, is needed.
+                fjac = fjac[0:n, 0:n]
+                fjac.shape = [n, n]
+                temp = fjac.copy()
+                for i in range(n):
+                    temp[:,i] = fjac[:, ipvt[i]]
+                fjac = temp.copy()
 
             # Check for overflow.  This should be a cheap test here since FJAC
             # has been reduced to a (small) square matrix, and the test is
@@ -1500,6 +1549,23 @@ class mpfit:
             return fcn(x, fjac=fjac, **functkw)
     
     
+    def call_many(self, fcn, xs, functkw):
+        # Evaluate fcn for a list of parameter vectors, with one call
+        # (vectorized) or through the pool. Returns [status, list of f]
+        if self.qanytied:
+            xs = [self.tie(x, self.ptied) for x in xs]
+        self.nfev = self.nfev + len(xs)
+        if self.vectorized:
+            [status, f] = fcn(numpy.array(xs), fjac=None, **functkw)
+            fs = list(f)
+        else:
+            results = self.pool.map(_FcnCall(fcn, functkw), xs)
+            status = min([r[0] for r in results])
+            fs = [r[1] for r in results]
+        if self.damp > 0:
+            fs = [numpy.tanh(f/self.damp) for f in fs]
+        return [status, fs]
+
     def enorm(self, vec):
         ans = self.blas_enorm(vec)
         return ans
@@ -1531,7 +1597,8 @@ class mpfit:
             mperr = 0
             fjac = numpy.zeros(nall, dtype=float)
             fjac[ifree] = 1.0  # Specify which parameters need derivatives
-            [status, fp] = self.call(fcn, xall, functkw, fjac=fjac)
+            [status, fp, pderiv] = self.call(fcn, xall, functkw, fjac=fjac)
+            fjac = numpy.array(pderiv, dtype=float).flatten()
 
             if len(fjac) != m*nall:
                 print 'ERROR: Derivative matrix was not computed properly.'
@@ -1546,7 +1613,7 @@ class mpfit:
             if len(ifree) < nall:
                 fjac = fjac[:,ifree]
                 fjac.shape = [m, n]
-                return fjac
+            return fjac
 
         fjac = numpy.zeros([m, n], dtype=float)
 
@@ -1581,6 +1648,33 @@ class mpfit:
             wh = (numpy.nonzero(mask))[0]
             if len(wh) > 0:
                 h[wh] = - h[wh]
+        if self.pool is not None or self.vectorized:
+            # all the perturbed parameter vectors at once, then the
+            # same differences as in the loop below
+            xps = []
+            for j in range(n):
+                xp = xall.copy()
+                xp[ifree[j]] = xp[ifree[j]] + h[j]
+                xps.append(xp)
+                if numpy.abs(dside[ifree[j]]) > 1:
+                    xp = xall.copy()
+                    xp[ifree[j]] = xall[ifree[j]] - h[j]
+                    xps.append(xp)
+            [status, fs] = self.call_many(fcn, xps, functkw)
+            if status < 0:
+                return None
+            k = 0
+            for j in range(n):
+                fp = fs[k]
+                k = k + 1
+                if numpy.abs(dside[ifree[j]]) <= 1:
+                    fjac[0:,j] = (fp-fvec)/h[j]
+                else:
+                    fm = fs[k]
+                    k = k + 1
+                    fjac[0:,j] = (fp-fm)/(2*h[j])
+            return fjac
+
         # Loop through parameters, computing the derivative for each
         for j in range(n):
             xp = xall.copy()
@@ -1817,6 +1911,21 @@ class mpfit:
             rdiag[j] = -ajnorm
         return [a, ipvt, rdiag, acnorm]
 
+    # The same as qrfac (pivot=1) followed by forming (q transpose)*fvec,
+    # with the pivoted QR factorization of LAPACK (geqp3). Returns the
+    # square upper triangular R, in the pivoted column order, as the
+    # main loop has after its own permutation, and qtf.
+    def qrfac_lapack(self, a, fvec):
+        from scipy.linalg import qr
+
+        if self.debug: print 'Entering qrfac_lapack...'
+        n = a.shape[1]
+        acnorm = numpy.sqrt((a*a).sum(axis=0))
+        q, r, ipvt = qr(a, mode='economic', pivoting=True, check_finite=False)
+        qtf = numpy.dot(q.T, fvec)
+        r = r[0:n, 0:n].copy()
+        return [r, ipvt, numpy.diagonal(r).copy(), acnorm, qtf]
+
     
     #    Original FORTRAN documentation
     #    **********
@@ -1897,6 +2006,8 @@ class mpfit:
     #
     
     def qrsolv(self, r, ipvt, diag, qtb, sdiag):
+        if self.linalg == 'lapack':
+            return self.qrsolv_lapack(r, ipvt, diag, qtb, sdiag)
         if self.debug:
             print 'Entering qrsolv...'
         sz = r.shape
@@ -1908,7 +2019,7 @@ class mpfit:
 
         for j in range(n):
             r[j:n,j] = r[j,j:n]
-        x = numpy.diagonal(r)
+        x = numpy.diagonal(r).copy()
         wa = qtb.copy()
 
         # Eliminate the diagonal matrix d using a givens rotation
@@ -1970,6 +2081,39 @@ class mpfit:
         x[ipvt] = wa
         return (r, x, sdiag)
 
+    # qrsolv with LAPACK, instead of the givens rotations the stacked
+    # system [r ; d*p] z = [qtb ; 0] is factorized once (it is 2n by n),
+    # s is stored as in qrsolv, transposed in the strict lower triangle
+    # of r, with its diagonal in sdiag.
+    def qrsolv_lapack(self, r, ipvt, diag, qtb, sdiag):
+        from scipy.linalg import qr, solve_triangular
+
+        if self.debug:
+            print 'Entering qrsolv_lapack...'
+        n = r.shape[1]
+        a = numpy.vstack([numpy.triu(r), numpy.diag(diag[ipvt])])
+        q, s = qr(a, mode='economic', check_finite=False)
+        wa = numpy.dot(q[0:n].T, qtb)
+        lower = numpy.tril_indices(n, -1)
+        r[lower] = s.T[lower]
+        sdiag[:] = numpy.diagonal(s)
+
+        # Solve the triangular system for z.  If the system is singular
+        # then obtain a least squares solution
+        nsing = n
+        wh = (numpy.nonzero(sdiag == 0))[0]
+        if len(wh) > 0:
+            nsing = wh[0]
+            wa[nsing:] = 0
+        if nsing >= 1:
+            wa[0:nsing] = solve_triangular(s[0:nsing, 0:nsing], wa[0:nsing],
+                                           check_finite=False)
+
+        # Permute the components of z back to components of x
+        x = numpy.zeros(n, dtype=float)
+        x[ipvt] = wa
+        return (r, x, sdiag)
+
 
 
     
@@ -2071,6 +2215,8 @@ class mpfit:
 
         if self.debug:
             print 'Entering lmpar...'
+        if self.linalg == 'lapack':
+            from scipy.linalg import solve_triangular
         dwarf = self.machar.minnum
         machep = self.machar.machep
         sz = r.shape
@@ -2086,7 +2232,10 @@ class mpfit:
         if len(wh) > 0:
             nsing = wh[0]
             wa1[wh[0]:] = 0
-        if nsing >= 1:
+        if nsing >= 1 and self.linalg == 'lapack':
+            wa1[0:nsing] = solve_triangular(r[0:nsing, 0:nsing], wa1[0:nsing],
+                                            check_finite=False)
+        elif nsing >= 1:
             # *** Reverse loop ***
             for j in range(nsing-1,-1,-1):
                 wa1[j] = wa1[j]/r[j,j]
@@ -2112,18 +2261,24 @@ class mpfit:
         parl = 0.
         if nsing >= n:
             wa1 = diag[ipvt] * wa2[ipvt] / dxnorm
-            wa1[0] = wa1[0] / r[0,0] # Degenerate case
-            for j in range(1,n):   # Note "1" here, not zero
-                sum0 = sum(r[0:j,j]*wa1[0:j])
-                wa1[j] = (wa1[j] - sum0)/r[j,j]
+            if self.linalg == 'lapack':
+                wa1 = solve_triangular(r, wa1, trans='T', check_finite=False)
+            else:
+                wa1[0] = wa1[0] / r[0,0] # Degenerate case
+                for j in range(1,n):   # Note "1" here, not zero
+                    sum0 = sum(r[0:j,j]*wa1[0:j])
+                    wa1[j] = (wa1[j] - sum0)/r[j,j]
 
             temp = self.enorm(wa1)
             parl = ((fp/delta)/temp)/temp
 
         # Calculate an upper bound, paru, for the zero of the function
-        for j in range(n):
-            sum0 = sum(r[0:j+1,j]*qtb[0:j+1])
-            wa1[j] = sum0/diag[ipvt[j]]
+        if self.linalg == 'lapack':
+            wa1 = numpy.dot(numpy.triu(r).T, qtb) / diag[ipvt]
+        else:
+            for j in range(n):
+                sum0 = sum(r[0:j+1,j]*qtb[0:j+1])
+                wa1[j] = sum0/diag[ipvt[j]]
         gnorm = self.enorm(wa1)
         paru = gnorm/delta
         if paru == 0:
@@ -2160,10 +2315,14 @@ class mpfit:
             # Compute the newton correction
             wa1 = diag[ipvt] * wa2[ipvt] / dxnorm
 
-            for j in range(n-1):
-                wa1[j] = wa1[j]/sdiag[j]
-                wa1[j+1:n] = wa1[j+1:n] - r[j+1:n,j]*wa1[j]
-            wa1[n-1] = wa1[n-1]/sdiag[n-1] # Degenerate case
+            if self.linalg == 'lapack':
+                s = numpy.tril(r, -1) + numpy.diag(sdiag)
+                wa1 = solve_triangular(s, wa1, lower=True, check_finite=False)
+            else:
+                for j in range(n-1):
+                    wa1[j] = wa1[j]/sdiag[j]
+                    wa1[j+1:n] = wa1[j+1:n] - r[j+1:n,j]*wa1[j]
+                wa1[n-1] = wa1[n-1]/sdiag[n-1] # Degenerate case
 
             temp = self.enorm(wa1)
             parc = ((fp/delta)/temp)/temp
@@ -2279,6 +2438,8 @@ class mpfit:
 
         if ipvt is None:
             ipvt = numpy.arange(n)
+        if self.linalg == 'lapack':
+            return self.calc_covar_lapack(rr, ipvt, tol=tol)
         r = rr.copy()
         r.shape = [n,n]
 
@@ -2328,6 +2489,25 @@ class mpfit:
 
         return r
 
+    # calc_covar with a LAPACK triangular inverse, the leading part of r
+    # down to the first (nearly) zero diagonal element is inverted, the
+    # rest of the covariance matrix is zero, as in calc_covar
+    def calc_covar_lapack(self, rr, ipvt, tol=1.e-14):
+        from scipy.linalg import solve_triangular
+
+        n = rr.shape[0]
+        r = numpy.triu(rr)
+        tolr = tol * numpy.abs(r[0,0])
+        wh = (numpy.nonzero(numpy.abs(numpy.diagonal(r)) <= tolr))[0]
+        l = n if len(wh) == 0 else wh[0]
+        cv = numpy.zeros([n,n], dtype=float)
+        if l > 0:
+            rinv = solve_triangular(r[0:l,0:l], numpy.eye(l), check_finite=False)
+            cv[0:l,0:l] = numpy.dot(rinv, rinv.T)
+        covar = numpy.zeros([n,n], dtype=float)
+        covar[numpy.ix_(ipvt, ipvt)] = cv
+        return covar
+
 class machar:
     def __init__(self, double=1):
         if double == 0:
@@ -154,6 +154,29 @@ def calc_vlsr (f,f0):
 def calc_sigma(N,rms,v_cdelt):
     from scipy import sqrt
     return sqrt(N)*rms*abs(v_cdelt)
+def byteswap_inplace(arr, chunksize=64*1024**2):
+    """
+    Convert 'arr' to the native byte order without making a copy.
+
+    The bytes are swapped in place, chunksize bytes at a time along
+    the first axis, and a native byte order view of the same memory is
+    returned. Arrays that already are native are returned as they are,
+    read-only arrays are copied (as .byteswap().newbyteorder() does).
+
+    NB : 'arr' itself (and any array/HDU sharing its memory) holds
+    garbage afterwards, only use the returned view.
+    """
+    if arr.dtype.isnative:
+        return arr
+    if not arr.flags.writeable:
+        return arr.byteswap().newbyteorder()
+    if arr.ndim == 0 or arr.size == 0:
+        arr.byteswap(True)
+    else:
+        step = max(1, int(chunksize // max(1, arr[0].nbytes)))
+        for i in xrange(0, arr.shape[0], step):
+            arr[i:i+step].byteswap(True)
+    return arr.view(arr.dtype.newbyteorder())
 def get_telescope_diameter(telescope):
     from string import upper
     from scipy import where, array
@@ -468,7 +491,7 @@ def parse_linelist(linelist, out='brief'):
         return [names, freqs]
     else:
         print('Did not parse!')
-def get_indices (arr,vals,disp=False):
+def get_indices (arr,vals,disp=False,order=None):
     """
 
     Get the indices of all the elements between vals[0] and vals[1].
@@ -483,6 +506,9 @@ def get_indices (arr,vals,disp=False):
         disp : Bolean parameter, if True it displays start and end
                index and the number of channels inbetween. Only works
                for value lists of length 2.
+        order : the order of arr, 1 (increasing), -1 (decreasing) or
+               0 (neither), see _monotonic. Found from arr if not given,
+               pass it when arr is searched many times.
 
     Assumes the values in 'arr' is the mid values and that it is evenly
     spaced for all values.
@@ -507,20 +533,31 @@ def get_indices (arr,vals,disp=False):
         Funciton created
     """
 
-    from scipy import concatenate, where, array, diff
-    dx = abs(.5*diff(arr)[0])
+    from scipy import concatenate, where, array, diff, arange
+    dx = abs(.5*diff(arr[:2])[0])
     if len(vals)==4:
         v1,v2,v3,v4 = vals + array([-1,1,-1,1])*dx
         # if the user wants two velocity areas to calculate noise
-        low = where((arr>=v1)*(arr<=v2))[0]
-        high = where((arr>=v3)*(arr<=v4))[0]
+        if order is None:
+            order = _monotonic(arr)
+        low = _channel_range(arr, v1, v2, order)
+        high = _channel_range(arr, v3, v4, order)
+        if low is None or high is None:
+            low = where((arr>=v1)*(arr<=v2))[0]
+            high = where((arr>=v3)*(arr<=v4))[0]
+        else:
+            low, high = arange(*low), arange(*high)
         channels = concatenate((low,high))
     elif len(vals)==2:
         v1,v2 = vals + array([-1,1])*dx
         #channels = where((arr>=v1)*(arr<v2))[0]+1
         # this is because if +1 it is FITS/Fortran safe
         # changed: removed +1 for consistency in program
-        channels = where((arr>=v1)*(arr<=v2))[0]
+        rng = _channel_range(arr, v1, v2, order)
+        if rng is None:
+            channels = where((arr>=v1)*(arr<=v2))[0]
+        else:
+            channels = arange(*rng)
     #
     if disp and len(vals)==2:
         first, last = channels.min(), channels.max()
@@ -528,6 +565,222 @@ def get_indices (arr,vals,disp=False):
         print '\nFirst: %d,\n Last: %d\n Nchan: %d\n' % (first, last, n)
     return channels
 
+def _monotonic(arr):
+    # 1 if arr is increasing, -1 if decreasing, 0 if neither
+    from scipy import diff
+    step = diff(arr)
+    if (step >= 0).all():
+        return 1
+    elif (step <= 0).all():
+        return -1
+    return 0
+
+def _channel_range(arr, v1, v2, order=None):
+    # (start, stop) of the elements of arr in [v1, v2], with a binary
+    # search instead of a scan of arr. None if arr is not monotonic.
+    from scipy import searchsorted, asarray
+    arr = asarray(arr)
+    if order is None:
+        order = _monotonic(arr)
+    if order > 0:
+        return searchsorted(arr, v1, 'left'), searchsorted(arr, v2, 'right')
+    elif order < 0:
+        # decreasing, search the reversed array
+        n = len(arr)
+        rev = arr[::-1]
+        return n - searchsorted(rev, v2, 'right'), n - searchsorted(rev, v1, 'left')
+    return None
+
+def get_slice(arr, vals, order=None):
+    """
+    As get_indices, but returns a slice for two values (vals = [v1, v2])
+    and a monotonic arr, so that indexing the data with it gives a view
+    and not a copy, e.g. Fits.d[get_slice(Fits.v_arr, [v1, v2])].
+    Otherwise (four values, or arr not monotonic) the indices from
+    get_indices are returned. The order of arr is passed on to
+    get_indices.
+    """
+    from scipy import diff, array
+    if len(vals)==2:
+        dx = abs(.5*diff(arr[:2])[0])
+        v1,v2 = vals + array([-1,1])*dx
+        rng = _channel_range(arr, v1, v2, order)
+        if rng is not None:
+            return slice(*rng)
+    return get_indices(arr, vals, order=order)
+
+def moment_sums(cube, channels, velocities, region=None):
+    """
+    Sums over the channels of a cube, for the moment maps
+
+    The cube is read one channel (image) at a time, so the only extra
+    memory is a few images, and a memory mapped cube is never read as
+    a whole.
+
+    Input:
+        cube       : the data, (nchan, ny, nx)
+        channels   : the indices of the channels to sum
+        velocities : the velocity of each of these channels
+        region     : (y0, y1, x0, x1), only sum this part of the images
+
+    Returns five images, sum(I), sum(I*v) and sum(I*v**2), the peak
+    intensity and the index (into channels) of the peak. Subtract a
+    reference velocity (e.g. the mean) from the velocities first, for
+    the precision of the second moment.
+    """
+    from numpy import zeros, empty, array, float64, inf, nan, isinf
+    if region is None:
+        region = (0, cube.shape[1], 0, cube.shape[2])
+    y0, y1, x0, x1 = region
+    shape = (y1 - y0, x1 - x0)
+    Isum = zeros(shape, dtype=float64)
+    Ivsum = zeros(shape, dtype=float64)
+    Iv2sum = zeros(shape, dtype=float64)
+    peak = empty(shape, dtype=float64)
+    peak.fill(-inf)
+    ipeak = zeros(shape, dtype=int)
+    for k, (i, v) in enumerate(zip(channels, velocities)):
+        # a copy, img is multiplied in place below
+        img = array(cube[i, y0:y1, x0:x1], dtype=float64)
+        higher = img > peak
+        peak[higher] = img[higher]
+        ipeak[higher] = k
+        Isum += img
+        img *= v
+        Ivsum += img
+        img *= v
+        Iv2sum += img
+    peak[isinf(peak)] = nan
+    return Isum, Ivsum, Iv2sum, peak, ipeak
+
+def moment_sums_tiled(cube, channels, velocities, tile=512, nthreads=4):
+    """
+    moment_sums in tiles of tile x tile pixels, that are divided over
+    a pool of threads (numpy releases the GIL in the arithmetic). Each
+    tile only reads its own part of the (memory mapped) cube.
+
+    Returns the same five images as moment_sums.
+    """
+    from multiprocessing.pool import ThreadPool
+    from numpy import empty, float64
+    ny, nx = cube.shape[1:]
+    out = [empty((ny, nx), dtype=float64) for i in range(4)] + [empty((ny, nx), dtype=int)]
+    tiles = [(y0, min(y0 + tile, ny), x0, min(x0 + tile, nx))
+            for y0 in xrange(0, ny, tile) for x0 in xrange(0, nx, tile)]
+    def work(region):
+        y0, y1, x0, x1 = region
+        for arr, res in zip(out, moment_sums(cube, channels, velocities, region)):
+            arr[y0:y1, x0:x1] = res
+    pool = ThreadPool(max(1, min(nthreads, len(tiles))))
+    try:
+        pool.map(work, tiles)
+    finally:
+        pool.close()
+        pool.join()
+    return out
+
+def channel_edges(v):
+    """
+    The lower and upper edges of channels, from the channel centres v
+    (increasing or decreasing), halfway between the centres
+    """
+    from numpy import asarray, float64, concatenate, minimum, maximum
+    v = asarray(v, dtype=float64)
+    mid = (v[1:] + v[:-1]) / 2.
+    edges = concatenate([[2 * v[0] - mid[0]], mid, [2 * v[-1] - mid[-1]]])
+    return minimum(edges[:-1], edges[1:]), maximum(edges[:-1], edges[1:])
+
+def rebin_weights(v_in, v_out, blocksize=256):
+    """
+    The flux conserving rebinning matrix from the channels v_in to the
+    channels v_out (centres, any spacing). Element (j, i) is the fraction
+    of output channel j that overlaps input channel i, so the rebinned
+    spectrum is W.dot(spectrum), the mean intensity in each output
+    channel, and the integral is conserved.
+
+    Returns W (sparse, nout x nin) and the fraction of each output
+    channel that is covered by the input channels.
+    """
+    from numpy import minimum, maximum, clip, nonzero, concatenate
+    from scipy.sparse import csr_matrix
+    lo_in, hi_in = channel_edges(v_in)
+    lo_out, hi_out = channel_edges(v_out)
+    width = hi_out - lo_out
+    rows, cols, vals = [], [], []
+    for j0 in xrange(0, len(lo_out), blocksize):
+        j1 = j0 + blocksize
+        overlap = clip(minimum(hi_out[j0:j1, None], hi_in) -
+                        maximum(lo_out[j0:j1, None], lo_in), 0, None)
+        j, i = nonzero(overlap)
+        rows.append(j + j0)
+        cols.append(i)
+        vals.append(overlap[j, i] / width[j + j0])
+    rows, cols, vals = concatenate(rows), concatenate(cols), concatenate(vals)
+    W = csr_matrix((vals, (rows, cols)), shape=(len(lo_out), len(lo_in)))
+    coverage = W.sum(axis=1).A1
+    return W, coverage
+
+def rebin_spectral(data, binning=None, v_in=None, v_out=None,
+                    chunksize=2**22, out=None, dtype=None):
+    """
+    Rebin data along the first (spectral) axis
+
+    Either average every binning channels (reshape and mean, channels
+    left over at the end are dropped), or rebin flux conserving from the
+    channels v_in onto any other channels v_out (see rebin_weights).
+    Output channels that are not covered by the input are NaN.
+
+    The data is processed chunksize values (channels x pixels) at a
+    time, so it can be a memory mapped cube, and out a memory mapped
+    array of the right shape (e.g. a numpy.memmap, or the data of a
+    FITS file opened with mode='update'). An astropy StreamingHDU is
+    not an array and can not be used as out.
+
+    Input:
+        data      : (nchan, ...) array, e.g. a spectrum or cube
+        binning   : number of channels to average, or
+        v_in, v_out : the channel velocities (or frequencies) of the
+                    data, and of the output
+        out       : optional output array, (nout, ...) and C contiguous
+        dtype     : data type of the output when out is not given
+                    (default float64), the arithmetic is always done
+                    in float64
+
+    Returns the rebinned data.
+    """
+    from numpy import asarray, float64, empty, nan
+    from adapy.libs.errors import ParError
+    nin = data.shape[0]
+    if binning is not None:
+        binning = int(binning)
+        if binning < 1:
+            raise ParError(binning)
+        nout = nin // binning
+    elif v_in is not None and v_out is not None:
+        if len(v_in) != nin:
+            raise ParError((len(v_in), nin))
+        W, coverage = rebin_weights(v_in, v_out)
+        nout = len(v_out)
+        uncovered = coverage < 1 - 1e-6
+    else:
+        raise ParError('Give binning, or v_in and v_out.')
+    if out is None:
+        out = empty((nout,) + data.shape[1:], dtype=float64 if dtype is None else dtype)
+    elif out.shape != (nout,) + data.shape[1:] or not out.flags.c_contiguous:
+        raise ParError('out has to be a C contiguous array of shape {0}.'.format((nout,) + data.shape[1:]))
+    data2 = data.reshape(nin, -1)
+    out2 = out.reshape(nout, -1)
+    step = max(1, chunksize // max(nin, 1))
+    for p0 in xrange(0, data2.shape[1], step):
+        block = asarray(data2[:, p0:p0 + step], dtype=float64)
+        if binning is not None:
+            out2[:, p0:p0 + step] = block[:nout * binning].reshape(nout, binning, -1).mean(axis=1)
+        else:
+            res = W.dot(block)
+            res[uncovered] = nan
+            out2[:, p0:p0 + step] = res
+    return out
+
 #
 # Help functions for fitting
 # 1D
@@ -818,6 +1071,282 @@ def fit_gauss1d((X,Y),
         return pfit, pfit_err, chi2, mpfit_out
     else:
         return pfit, pfit_err
+def _gauss1d_batch_fcn(X, Y, W):
+    # residuals and jacobian of the sum of gaussians (FWHM) for
+    # many spectra, Y and W (1/err, 0 where masked) are (n, m)
+    from numpy import exp, log, zeros
+    c = 4 * log(2)
+    def fcn(P, index):
+        y, w = Y[index], W[index]
+        model = zeros(y.shape)
+        jac = zeros(y.shape + (P.shape[1],))
+        for i in xrange(0, P.shape[1], 3):
+            a, b, f = P[:, i, None], P[:, i+1, None], P[:, i+2, None]
+            dx = X - b
+            e = exp(-c * dx**2 / f**2)
+            model += a * e
+            jac[..., i] = -w * e
+            jac[..., i+1] = -w * a * e * 2 * c * dx / f**2
+            jac[..., i+2] = -w * a * e * 2 * c * dx**2 / f**3
+        return w * (y - model), jac
+    return fcn
+def fit_gauss1d_batch((X, Y),
+                params,
+                err = None,
+                fixlist = None,
+                minpar = None,
+                maxpar = None,
+                maxiter = 200,
+                verbose = 0,
+                full_output = 0):
+    """
+    Fit gaussian(s) to many spectra at once, with the batched
+    Levenberg-Marquardt solver (fitting.batchlm), instead of one
+    call to fit_gauss1d (mpfit) per spectrum.
+
+    X - the coordinates of the x-axis (m,)
+    Y - the spectra (n, m), NaN channels are masked
+    params - initial guesses, grouped in three (AMPL, POS, FWHM)
+            the same for all spectra (3*ngauss,) or per spectrum
+            (n, 3*ngauss)
+    err - error of the Y data, a number, (n,) or (n, m)
+    fixlist - which parameters to keep fixed e.g. [[0,0,1]]
+    minpar, maxpar - the limits, None for unlimited,
+            e.g. minpar = [[0, None, None]]
+            the FWHM is limited to the channel width, as in fit_gauss1d
+    verbose - 1 to print a summary
+
+    Returns the parameters and errors, (n, 3*ngauss), and with
+    full_output also the chi2 and the whole fit object (status etc).
+    """
+    from numpy import array, asarray, isfinite, inf, where, ones
+    from numpy import broadcast_to, float64
+    from adapy.fitting.batchlm import batch_lm, STATUS
+    from adapy.libs.errors import ParError
+    Y = array(Y, dtype=float64, ndmin=2)
+    n, m = Y.shape
+    params = array(params, dtype=float64)
+    npar = params.shape[-1] if params.ndim == 2 else params.size
+    if npar % 3 != 0:
+        raise ParError(params)
+    params = broadcast_to(params.reshape(-1, npar), (n, npar))
+    #
+    xwidth = abs(X[1] - X[0])
+    lo = array([-inf, -inf, xwidth] * (npar / 3))
+    hi = ones(npar) * inf
+    for lim, val in [(lo, minpar), (hi, maxpar)]:
+        if val is None:
+            continue
+        val = array(val, dtype=object).flatten()
+        if len(val) != npar:
+            raise ParError(val)
+        for i, v in enumerate(val):
+            if v is not None:
+                lim[i] = v
+    fixed = None
+    if fixlist is not None:
+        fixed = array(fixlist, dtype=bool).flatten()
+        if len(fixed) != npar:
+            raise ParError(fixlist)
+    #
+    if err is None:
+        err = 1.
+    err = asarray(err, dtype=float64)
+    if err.ndim == 1:
+        err = err[:, None]
+    good = isfinite(Y) & isfinite(err) & (err > 0)
+    W = where(good, 1. / where(good, err, 1.), 0)
+    Y = where(good, Y, 0)
+    #
+    fcn = _gauss1d_batch_fcn(asarray(X, dtype=float64), Y, W)
+    fit = batch_lm(fcn, params, limits=(lo, hi), fixed=fixed,
+                    maxiter=maxiter, npoints=good.sum(axis=1))
+    if verbose:
+        print '*'*40
+        print 'Fitted {0} spectra, {1} parameters each'.format(n, npar)
+        for s in sorted(set(fit.status)):
+            print '{0:6d} : {1}'.format((fit.status == s).sum(), STATUS[s])
+        print '*'*40
+    if full_output:
+        return fit.params, fit.perror, fit.chi2, fit
+    else:
+        return fit.params, fit.perror
+def _neighbour_guess(params, ok):
+    # median of the parameters of the (up to 8) converged neighbours
+    from numpy import nan, empty, array, isfinite, nanmedian
+    import warnings
+    npar, ny, nx = params.shape
+    pad = empty((npar, ny + 2, nx + 2))
+    pad.fill(nan)
+    pad[:, 1:-1, 1:-1] = params
+    pad[:, 1:-1, 1:-1][:, ~ok] = nan
+    shifts = array([pad[:, 1+dy:ny+1+dy, 1+dx:nx+1+dx]
+                for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        guess = nanmedian(shifts, axis=0)
+    return guess, isfinite(guess).all(axis=0)
+
+def _gauss1d_converged(out, X, reference=None):
+    # status 1-3, the lines inside X, and a reduced chi2 that is not
+    # much worse than expected (reference, or else the median)
+    from numpy import nanmedian, sqrt, errstate
+    with errstate(invalid='ignore', divide='ignore'):
+        ok = (out.status >= 1) & (out.status <= 3) & \
+                (out.amplitude != 0).all(axis=0) & \
+                (out.centroid >= X.min()).all(axis=0) & \
+                (out.centroid <= X.max()).all(axis=0)
+        if not ok.any():
+            return ok
+        red = out.chi2 / out.dof
+        ref = reference if reference is not None else nanmedian(red[ok])
+        return ok & (red <= ref * (1 + 5 * sqrt(2. / out.dof)))
+
+def gauss1d_cube_guess((X, cube)):
+    """
+    First guesses (3, ny, nx) of one gaussian [AMPL, POS, FWHM] for
+    every pixel of a cube, from the peak and the integral of the
+    spectrum. Read a row at a time. Pixels without data are NaN.
+    """
+    from numpy import asarray, float64, isfinite, where, inf, nan, nansum
+    from numpy import empty, clip, sqrt, log, pi, array
+    X = asarray(X, dtype=float64)
+    nchan, ny, nx = cube.shape
+    dx = abs(X[1] - X[0])
+    guess = empty((3, ny, nx))
+    for y in xrange(ny):
+        row = asarray(cube[:, y], dtype=float64)
+        good = isfinite(row).any(axis=0)
+        row_inf = where(isfinite(row), row, -inf)
+        peak = row_inf.argmax(axis=0)
+        amp = row_inf.max(axis=0)
+        integral = nansum(row, axis=0) * dx
+        fwhm = integral / where(amp > 0, amp, 1) / sqrt(pi / (4 * log(2)))
+        fwhm = clip(fwhm, 2 * dx, X.max() - X.min())
+        guess[:, y] = array([amp, X[peak], fwhm])
+        guess[:, y, ~good] = nan
+    return guess
+
+def fit_gauss1d_cube((X, cube),
+                params = None,
+                err = None,
+                mask = None,
+                chunksize = 4096,
+                npass = 0,
+                verbose = 1,
+                **kwargs):
+    """
+    Fit gaussian(s) to the spectrum of every pixel of a cube, with
+    fit_gauss1d_batch. The cube is read a block of rows at a time,
+    so a memory mapped cube (Fits(..., lazy=True)) is fine.
+
+    X - the coordinates of the spectral axis (nchan,), e.g. Fits.v_arr
+    cube - (nchan, ny, nx)
+    params - initial guesses (3*ngauss,) for all pixels, or maps
+            (3*ngauss, ny, nx), pixels with NaN guesses are not fitted.
+            None, one gaussian guessed from the peak and integral of
+            each spectrum (gauss1d_cube_guess)
+    err - a number, rms map (ny, nx), or a cube
+    mask - (ny, nx) booleans, the pixels to fit (default all)
+    chunksize - (about) the number of spectra fitted together
+    npass - number of times the pixels that did not converge are
+            fitted again, starting from the median of their converged
+            neighbours. A refit is kept if its chi2 is lower. Converged
+            is status 1-3, the lines inside X and a reduced chi2 not
+            much worse than 1 (err given) or the median.
+    **kwargs - fixlist, minpar, maxpar, maxiter of fit_gauss1d_batch
+
+    Returns an object with the maps
+        params, perror (3*ngauss, ny, nx)
+        amplitude, centroid, fwhm (and _err) (ngauss, ny, nx)
+        chi2, dof, status, niter (ny, nx)
+    pixels that are not fitted are NaN (status -1).
+    """
+    from numpy import asarray, empty, nan, inf, ones, zeros, isfinite
+    from numpy import arange, float64, isinf
+    nchan, ny, nx = cube.shape
+    if params is None:
+        params = gauss1d_cube_guess((X, cube))
+    params = asarray(params, dtype=float64)
+    npar = params.shape[0]
+    if mask is None:
+        mask = ones((ny, nx), dtype=bool)
+    mask = asarray(mask, dtype=bool)
+    if params.ndim == 3:
+        mask = mask & isfinite(params).all(axis=0)
+    err = None if err is None else asarray(err, dtype=float64)
+    if err is not None and err.ndim == 2:
+        mask = mask & isfinite(err) & (err > 0)
+    #
+    class Maps: pass
+    out = Maps()
+    out.params = empty((npar, ny, nx))
+    out.perror = empty((npar, ny, nx))
+    out.dof = empty((ny, nx))
+    for arr in [out.params, out.perror, out.dof]:
+        arr.fill(nan)
+    # inf until fitted, so that any finite chi2 is better
+    out.chi2 = empty((ny, nx))
+    out.chi2.fill(inf)
+    out.status = -ones((ny, nx), dtype=int)
+    out.niter = zeros((ny, nx), dtype=int)
+    fitted = zeros((ny, nx), dtype=bool)
+    out.amplitude, out.centroid, out.fwhm = [out.params[i::3] for i in range(3)]
+    def errors(rows, cols):
+        # the errors of the spectra at rows, cols
+        if err is None or err.ndim == 0:
+            return 1. if err is None else err
+        elif err.ndim == 2:
+            return err[rows, cols]
+        return asarray(err[:, rows, cols], dtype=float64).T
+    def store(rows, cols, p, perr, chi2, fit):
+        # keep the fits that are better than the earlier ones, a failed
+        # fit (chi2 NaN) only sets the status of pixels not fitted yet
+        better = isfinite(chi2) & ~(out.chi2[rows, cols] <= chi2)
+        new = ~better & (out.status[rows, cols] == -1)
+        out.status[rows[new], cols[new]] = fit.status[new]
+        out.niter[rows[new], cols[new]] = fit.niter[new]
+        rows, cols = rows[better], cols[better]
+        out.params[:, rows, cols] = p[better].T
+        out.perror[:, rows, cols] = perr[better].T
+        out.chi2[rows, cols] = chi2[better]
+        out.dof[rows, cols] = fit.dof[better]
+        out.status[rows, cols] = fit.status[better]
+        out.niter[rows, cols] = fit.niter[better]
+    nrows = max(1, chunksize // nx)
+    for y0 in xrange(0, ny, nrows):
+        y1 = min(y0 + nrows, ny)
+        spec = asarray(cube[:, y0:y1], dtype=float64).reshape(nchan, -1).T
+        pix = mask[y0:y1].ravel() & isfinite(spec).any(axis=1)
+        if not pix.any():
+            continue
+        p0 = params if params.ndim == 1 else params[:, y0:y1].reshape(npar, -1).T[pix]
+        rows, cols = divmod(arange(pix.size)[pix], nx)
+        rows += y0
+        fitted[rows, cols] = True
+        p, perr, chi2, fit = fit_gauss1d_batch((X, spec[pix]), p0,
+                        err=errors(rows, cols), full_output=1, **kwargs)
+        store(rows, cols, p, perr, chi2, fit)
+        if verbose:
+            print 'Rows {0}-{1} of {2}, {3} spectra'.format(y0, y1, ny, pix.sum())
+    # refit the pixels that did not converge, from their neighbours
+    for i in xrange(npass):
+        ok = _gauss1d_converged(out, X, None if err is None else 1.)
+        guess, seeded = _neighbour_guess(out.params, ok)
+        rows, cols = (fitted & ~ok & seeded).nonzero()
+        if not len(rows):
+            break
+        for k in xrange(0, len(rows), chunksize):
+            r, c = rows[k:k+chunksize], cols[k:k+chunksize]
+            spec = asarray(cube[:, r, c], dtype=float64).T
+            p, perr, chi2, fit = fit_gauss1d_batch((X, spec), guess[:, r, c].T,
+                        err=errors(r, c), full_output=1, **kwargs)
+            store(r, c, p, perr, chi2, fit)
+        if verbose:
+            print 'Pass {0}, {1} spectra refitted'.format(i + 1, len(rows))
+    out.chi2[isinf(out.chi2)] = nan
+    out.amplitude_err, out.centroid_err, out.fwhm_err = [out.perror[i::3] for i in range(3)]
+    return out
 # 2D
 # to adacore.py
 def gauss2d (a, X, Y):
@@ -1088,6 +1617,91 @@ def gauss2d_decon ((bmaj1, bmin1, theta1, bmaj2, bmin2, theta2), ang='rad'):
     # send back the results
     return (bmaj, bmin, bpa, success)
 
+def gauss2d_decon_arr((bmaj1, bmin1, theta1, bmaj2, bmin2, theta2), ang='rad'):
+    """
+    gauss2d_decon for arrays, e.g. a catalogue of fitted sizes or a map
+    of beams. Deconvolves the gaussians (bmaj1, bmin1, theta1) with the
+    gaussians (bmaj2, bmin2, theta2), all in FWHM and radians (or
+    ang='deg'). The six inputs are arrays (or numbers) that broadcast
+    against each other.
+
+    Returns the arrays bmaj, bmin, bpa and success, per element
+        0 : ok
+        1 : (close to) a point source, bmaj, bmin, bpa are 0
+        2 : illegal (the second gaussian is larger in some direction),
+            or not finite input, bmaj, bmin, bpa are 0
+    """
+    from numpy import asarray, float64, cos, sin, arctan2, sqrt, pi
+    from numpy import minimum, where, zeros, isfinite, broadcast_arrays, errstate
+    bmaj1, bmin1, theta1, bmaj2, bmin2, theta2 = [asarray(i, dtype=float64)
+            for i in broadcast_arrays(bmaj1, bmin1, theta1, bmaj2, bmin2, theta2)]
+    if ang=='deg':
+        theta1 = theta1 * pi/180
+        theta2 = theta2 * pi/180
+    alpha  = (bmaj1*cos(theta1))**2 + (bmin1*sin(theta1))**2 - \
+             (bmaj2*cos(theta2))**2 - (bmin2*sin(theta2))**2
+    beta   = (bmaj1*sin(theta1))**2 + (bmin1*cos(theta1))**2 - \
+             (bmaj2*sin(theta2))**2 - (bmin2*cos(theta2))**2
+    gamma  = 2 * ( (bmin1**2-bmaj1**2)*sin(theta1)*cos(theta1) -\
+                   (bmin2**2-bmaj2**2)*sin(theta2)*cos(theta2) )
+    s = alpha + beta
+    t = sqrt((alpha-beta)**2 + gamma**2)
+    limit = 0.1*minimum(minimum(bmaj1, bmin1), minimum(bmaj2, bmin2))**2
+    #
+    # the masks of the illegal and (close to) point source results
+    with errstate(invalid='ignore'):
+        illegal = (alpha < 0) | (beta < 0) | (s < t)
+        point = illegal & (.5*(s-t) < limit) & (alpha > -limit) & (beta > -limit)
+        bad = illegal | ~isfinite(s + t)
+    success = where(point, 1, where(bad, 2, 0))
+    good = ~bad
+    bmaj, bmin, bpa = zeros(s.shape), zeros(s.shape), zeros(s.shape)
+    bmaj[good] = sqrt(.5*(s+t)[good])
+    bmin[good] = sqrt(.5*(s-t)[good])
+    round = (abs(gamma)+abs(alpha-beta)) == 0
+    bpa[good & ~round] = 0.5 * arctan2(-gamma, (alpha-beta))[good & ~round]
+    if ang=='deg':
+        bpa *= 180/pi
+    return bmaj, bmin, bpa, success
+
+def gauss2d_convolve_arr((bmaj1, bmin1, theta1, bmaj2, bmin2, theta2), ang='deg'):
+    """
+    gauss2d_convolve for arrays, convolves the gaussians (bmaj1, bmin1,
+    theta1) with (bmaj2, bmin2, theta2), all in FWHM and degrees (or
+    ang='rad'). The six inputs are arrays (or numbers) that broadcast
+    against each other.
+
+    Returns the arrays bmaj, bmin, bpa, fac and success, fac is the
+    factor of the convolution integral (as in gauss2d_convolve), success
+    is 0, or 2 where the input is not finite (the results are 0 there).
+    """
+    from numpy import asarray, float64, cos, sin, arctan2, sqrt, pi, log
+    from numpy import where, zeros, isfinite, broadcast_arrays
+    bmaj1, bmin1, theta1, bmaj2, bmin2, theta2 = [asarray(i, dtype=float64)
+            for i in broadcast_arrays(bmaj1, bmin1, theta1, bmaj2, bmin2, theta2)]
+    if ang=='deg':
+        theta1 = theta1 * pi/180
+        theta2 = theta2 * pi/180
+    cospa1, cospa2 = cos(theta1), cos(theta2)
+    sinpa1, sinpa2 = sin(theta1), sin(theta2)
+    alpha = (bmaj1*cospa1)**2 + (bmin1*sinpa1)**2 + (bmaj2*cospa2)**2 + (bmin2*sinpa2)**2
+    beta  = (bmaj1*sinpa1)**2 + (bmin1*cospa1)**2 + (bmaj2*sinpa2)**2 + (bmin2*cospa2)**2
+    gamma = 2 * ((bmin1**2-bmaj1**2)*sinpa1*cospa1 + (bmin2**2-bmaj2**2)*sinpa2*cospa2)
+    s = alpha + beta
+    t = sqrt( (alpha-beta)**2 + gamma**2 )
+    good = isfinite(s + t) & isfinite(gamma)
+    success = where(good, 0, 2)
+    bmaj, bmin, bpa, fac = zeros(s.shape), zeros(s.shape), zeros(s.shape), zeros(s.shape)
+    bmaj[good] = sqrt( 0.5*(s+t)[good] )
+    bmin[good] = sqrt( 0.5*(s-t)[good] )
+    round = (abs(gamma)+abs(alpha-beta)) == 0
+    bpa[good & ~round] = 0.5 * arctan2(-gamma, alpha-beta)[good & ~round]
+    if ang=='deg':
+        bpa *= 180/pi
+    fac[good] = (pi / (4.0*log(2.0)) * bmaj1*bmin1 * bmaj2*bmin2 /
+                    sqrt(alpha*beta - 0.25 * gamma*gamma))[good]
+    return bmaj, bmin, bpa, fac, success
+
 
 
 
@@ -0,0 +1,389 @@
+"""
+Imaging of uv data, from Uvfits to Fits
+
+The visibilities are gridded with a Kaiser-Bessel convolution kernel
+onto a (padded) uv grid, chunk by chunk, and Fourier transformed to
+the dirty image and the dirty beam (PSF). The Fourier transform of the
+kernel is divided out of the images (gridding correction).
+The chunks can be gridded in a pool of threads, each with its own grid.
+
+Usage :
+    uv = Uvfits('data.uvfits')
+    dirty, psf = dirty_image(uv, npix=512, cell=0.05, nthreads=4)
+    dirty.d     # the image, Jy/beam
+
+The other way, model visibilities of an image (degridding) or of
+point/Gaussian components at the uv points of the data :
+    uv.make_model(Fits('model.fits'))
+    uv.Model.amp
+
+"""
+from multiprocessing.pool import ThreadPool as _ThreadPool
+
+import numpy as _np
+from scipy.special import i0 as _i0
+
+from .fits import Fits
+
+__all__ = ['dirty_image', 'grid_visibilities', 'model_visibilities']
+
+########################################################################
+# KERNEL
+def kaiser_bessel_beta(width=6, pad=2.):
+    """
+    Shape parameter of the Kaiser-Bessel kernel for a support of
+    'width' cells and grid padding (oversampling) 'pad',
+    Beatty et al. 2005, IEEE Trans. Med. Imaging 24, 799
+    """
+    return _np.pi * _np.sqrt((float(width) / pad)**2 * (pad - 0.5)**2 - 0.8)
+
+def kaiser_bessel(x, width=6, beta=None):
+    """
+    Kaiser-Bessel kernel, x is the distance in grid cells,
+    zero outside +/- width/2
+    """
+    if beta is None:
+        beta = kaiser_bessel_beta(width)
+    x = _np.asarray(x, dtype=_np.float64)
+    arg = 1. - (2. * x / width)**2
+    return _np.where(arg >= 0, _i0(beta * _np.sqrt(arg.clip(0))) / _i0(beta), 0.)
+
+def kaiser_bessel_correction(ngrid, width=6, beta=None):
+    """
+    The Fourier transform of the Kaiser-Bessel kernel at the
+    (fftshifted) pixels of a ngrid image, normalized to 1 in the center
+    """
+    if beta is None:
+        beta = kaiser_bessel_beta(width)
+    x = (_np.arange(ngrid) - ngrid // 2) / float(ngrid)
+    # sinh(z)/z, sin(|z|)/|z| when z is imaginary
+    z = _np.sqrt((beta**2 - (_np.pi * width * x)**2).astype(_np.complex128))
+    z[z == 0] = 1e-12
+    corr = (_np.sinh(z) / z).real
+    return corr / corr[ngrid // 2]
+
+def _kernel_table(width, beta, oversample=1000):
+    # kernel sampled at 1/oversample cell steps, from -width/2 to width/2
+    x = _np.arange(width * oversample + 1) / float(oversample) - width / 2.
+    return kaiser_bessel(x, width, beta)
+
+########################################################################
+# GRIDDING
+def _grid_coordinates(u, v, du, ngrid):
+    # the u axis is flipped, so that RA increases to the left
+    # (negative CDELT1) as in the images
+    return -u / du + ngrid // 2, v / du + ngrid // 2
+
+def _grid_chunk(gu, gv, re, im, wt, ngrid, width, table, oversample):
+    """
+    Grid one chunk (gu, gv in grid cells), plus the Hermitian
+    conjugates. Returns the flat real, imaginary and weight grids.
+    """
+    gu = _np.r_[gu, 2 * (ngrid // 2) - gu]
+    gv = _np.r_[gv, 2 * (ngrid // 2) - gv]
+    re, im, wt = _np.r_[re, re], _np.r_[im, -im], _np.r_[wt, wt]
+    half = width // 2
+    # the first cell of the kernel support of each visibility
+    iu0 = _np.floor(gu).astype(_np.int64) - half + 1
+    iv0 = _np.floor(gv).astype(_np.int64) - half + 1
+    offs = _np.arange(width)[:, None]
+    iu, iv = iu0 + offs, iv0 + offs
+    # kernel values from the table, (width, nvis)
+    wu = table[_np.round((iu - gu + width / 2.) * oversample).astype(_np.int64)]
+    wv = table[_np.round((iv - gv + width / 2.) * oversample).astype(_np.int64)]
+    idx = (iv[:, None, :] * ngrid + iu[None, :, :]).ravel()
+    kw = (wv[:, None, :] * wu[None, :, :] * wt).ravel()
+    nn = ngrid * ngrid
+    return (_np.bincount(idx, weights=kw * _np.tile(re, width * width), minlength=nn),
+            _np.bincount(idx, weights=kw * _np.tile(im, width * width), minlength=nn),
+            _np.bincount(idx, weights=kw, minlength=nn))
+
+def grid_visibilities(u, v, re, im, wt, ngrid, du, width=6, beta=None,
+                        weighting='natural', chunksize=100000, nthreads=1):
+    """
+    Convolutional gridding of visibilities onto a ngrid x ngrid uv grid
+
+    u, v : in lambda (as Uvfits.u_lam, Uvfits.v_lam)
+    re, im, wt : real, imaginary and weights (zero/negative weights
+                 are not used)
+    du : the size of a grid cell, in lambda
+    width, beta : support (cells) and shape of the Kaiser-Bessel kernel
+    weighting : 'natural' or 'uniform'
+    chunksize : number of visibilities gridded at a time
+    nthreads : the chunks are divided over this many threads, each
+               thread accumulates its own grid
+
+    Returns the complex visibility grid and the (real) weight grid,
+    the center of the grid is at [ngrid//2, ngrid//2].
+    """
+    if beta is None:
+        beta = kaiser_bessel_beta(width)
+    oversample = 1000
+    table = _kernel_table(width, beta, oversample)
+    nvis = len(u)
+    starts = range(0, nvis, chunksize)
+    def chunk(i):
+        # grid coordinates and weights, drop points outside the grid
+        gu, gv = _grid_coordinates(_np.asarray(u[i:i+chunksize], dtype=_np.float64),
+                                    _np.asarray(v[i:i+chunksize], dtype=_np.float64),
+                                    du, ngrid)
+        w = _np.asarray(wt[i:i+chunksize], dtype=_np.float64)
+        good = ((w > 0) & (abs(gu - ngrid // 2) < ngrid // 2 - width) &
+                (abs(gv - ngrid // 2) < ngrid // 2 - width))
+        return gu[good], gv[good], w[good], good
+    density = None
+    if weighting == 'uniform':
+        # the summed weight in each cell (nearest cell), first pass
+        density = _np.zeros(ngrid * ngrid)
+        for i in starts:
+            gu, gv, w, good = chunk(i)
+            for gu_, gv_ in [(gu, gv), (2 * (ngrid // 2) - gu, 2 * (ngrid // 2) - gv)]:
+                cell = _np.round(gv_).astype(_np.int64) * ngrid + _np.round(gu_).astype(_np.int64)
+                density += _np.bincount(cell, weights=w, minlength=ngrid * ngrid)
+    elif weighting != 'natural':
+        raise ValueError("weighting should be 'natural' or 'uniform'")
+    def worker(mystarts):
+        grids = [_np.zeros(ngrid * ngrid) for k in range(3)]
+        for i in mystarts:
+            gu, gv, w, good = chunk(i)
+            if density is not None:
+                cell = _np.round(gv).astype(_np.int64) * ngrid + _np.round(gu).astype(_np.int64)
+                w = w / density[cell]
+            parts = _grid_chunk(gu, gv,
+                        _np.asarray(re[i:i+chunksize], dtype=_np.float64)[good],
+                        _np.asarray(im[i:i+chunksize], dtype=_np.float64)[good],
+                        w, ngrid, width, table, oversample)
+            for g, p in zip(grids, parts):
+                g += p
+        return grids
+    nthreads = max(1, min(nthreads, len(starts)))
+    tasks = [starts[k::nthreads] for k in range(nthreads)]
+    if nthreads > 1:
+        pool = _ThreadPool(nthreads)
+        try:
+            results = pool.map(worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [worker(tasks[0])]
+    regrid, imgrid, wtgrid = [sum(i) for i in zip(*results)]
+    vis = (regrid + 1j * imgrid).reshape(ngrid, ngrid)
+    return vis, wtgrid.reshape(ngrid, ngrid)
+
+def degrid(grid, u, v, du, width=6, beta=None, chunksize=100000):
+    """
+    Interpolate a uv grid (center at [ngrid//2, ngrid//2]) to the
+    visibilities at u, v (lambda) with the Kaiser-Bessel kernel.
+    The grid should be the transform of a grid corrected image,
+    see image_visibilities.
+    """
+    if beta is None:
+        beta = kaiser_bessel_beta(width)
+    oversample = 1000
+    table = _kernel_table(width, beta, oversample)
+    # the kernel integral, the interpolation is normalized by it
+    norm = (table.sum() / oversample)**2
+    ngrid = grid.shape[0]
+    flat = grid.ravel()
+    half = width // 2
+    offs = _np.arange(width)[:, None]
+    out = _np.zeros(len(u), dtype=_np.complex128)
+    for i in xrange(0, len(u), chunksize):
+        gu, gv = _grid_coordinates(_np.asarray(u[i:i+chunksize], dtype=_np.float64),
+                                    _np.asarray(v[i:i+chunksize], dtype=_np.float64),
+                                    du, ngrid)
+        inside = ((abs(gu - ngrid // 2) < ngrid // 2 - width) &
+                  (abs(gv - ngrid // 2) < ngrid // 2 - width))
+        gu, gv = gu[inside], gv[inside]
+        iu = _np.floor(gu).astype(_np.int64) - half + 1 + offs
+        iv = _np.floor(gv).astype(_np.int64) - half + 1 + offs
+        wu = table[_np.round((iu - gu + width / 2.) * oversample).astype(_np.int64)]
+        wv = table[_np.round((iv - gv + width / 2.) * oversample).astype(_np.int64)]
+        vis = _np.zeros(len(gu), dtype=_np.complex128)
+        for a in range(width):
+            for b in range(width):
+                vis += flat[iv[a] * ngrid + iu[b]] * (wv[a] * wu[b])
+        out[i:i+chunksize][inside] = vis / norm
+    return out
+
+def image_visibilities(image, cell, u, v, crpix=None, pad=2, width=6,
+                        chunksize=100000):
+    """
+    Visibilities of a model image at u, v (lambda), with a non-uniform
+    FFT (grid correction, FFT and degridding).
+
+    image : 2D array (y, x), Jy/pixel, RA increasing to the left
+    cell : pixel size in asec
+    crpix : (x, y) pixel (0-based) at the phase center, default the
+            center pixel npix//2
+    Visibilities outside the (padded) uv grid are zero.
+    """
+    image = _np.asarray(image, dtype=_np.float64)
+    ny, nx = image.shape
+    if crpix is None:
+        crpix = (nx // 2, ny // 2)
+    cx, cy = [int(round(i)) for i in crpix]
+    ngrid = int(pad * max(nx, ny, 2 * max(cx, cy, nx - cx, ny - cy)))
+    ngrid += ngrid % 2
+    beta = kaiser_bessel_beta(width, pad)
+    corr = kaiser_bessel_correction(ngrid, width, beta)
+    # the image, grid corrected, with crpix at the grid center
+    padded = _np.zeros((ngrid, ngrid))
+    x0, y0 = ngrid // 2 - cx, ngrid // 2 - cy
+    padded[y0:y0+ny, x0:x0+nx] = image
+    padded /= corr[:, None] * corr[None, :]
+    grid = _np.fft.fftshift(_np.fft.fft2(_np.fft.ifftshift(padded)))
+    du = 1. / (ngrid * _np.radians(cell / 3600.))
+    return degrid(grid, u, v, du, width, beta, chunksize)
+
+def component_visibilities(components, u, v):
+    """
+    Visibilities of point and Gaussian components at u, v (lambda)
+
+    components : list of tuples, offsets and sizes in asec,
+        (flux, dra, ddec)                    point source
+        (flux, dra, ddec, fwhm)              circular Gaussian
+        (flux, dra, ddec, major, minor, pa)  elliptical Gaussian,
+                                             pa in degrees, east of north
+    flux in Jy, dra positive to the east
+    """
+    u = _np.asarray(u, dtype=_np.float64)
+    v = _np.asarray(v, dtype=_np.float64)
+    vis = _np.zeros(len(u), dtype=_np.complex128)
+    asec = _np.radians(1 / 3600.)
+    for comp in components:
+        flux, dra, ddec = comp[:3]
+        amp = flux
+        if len(comp) > 3:
+            major = comp[3] * asec
+            minor, pa = (comp[4] * asec, _np.radians(comp[5])) if len(comp) > 4 else (major, 0.)
+            # baseline projected on the major and minor axis
+            qmaj = u * _np.sin(pa) + v * _np.cos(pa)
+            qmin = u * _np.cos(pa) - v * _np.sin(pa)
+            amp = flux * _np.exp(-_np.pi**2 / (4 * _np.log(2)) *
+                                ((major * qmaj)**2 + (minor * qmin)**2))
+        vis += amp * _np.exp(-2j * _np.pi * (u * dra + v * ddec) * asec)
+    return vis
+
+def model_visibilities(uv, image=None, components=None, cell=None,
+                        channel=0, pad=2, width=6, chunksize=100000):
+    """
+    Model visibilities at the uv points of a Uvfits object, of a model
+    image and/or a list of components (summed), see
+    image_visibilities and component_visibilities.
+
+    image : Fits object, or 2D array (then cell, asec, is needed)
+            Jy/pixel, or Jy/beam if there is a beam in the header
+    channel : the channel of a model cube that is used
+    """
+    vis = _np.zeros(len(uv.re), dtype=_np.complex128)
+    if image is not None:
+        crpix = None
+        if isinstance(image, Fits):
+            if abs(abs(image.ra_cdelt) - abs(image.dec_cdelt)) > 1e-6 * abs(image.dec_cdelt):
+                raise ValueError('The model image pixels have to be square.')
+            cell = abs(image.dec_cdelt)
+            data = _np.asarray(image.d[channel] if image.datatype[0] == 'CUBE' else image.d,
+                                dtype=_np.float64)
+            crpix = (image.ra_crpix, image.dec_crpix)
+            if image.ra_cdelt > 0:
+                # RA increasing to the right, flip it
+                data = data[:, ::-1]
+                crpix = (data.shape[1] - 1 - crpix[0], crpix[1])
+            if 'JY/BEAM' in str(getattr(image, 'unit', '')).upper() and hasattr(image, 'bmaj'):
+                # Jy/beam to Jy/pixel
+                beam = _np.pi * image.bmaj * image.bmin / (4 * _np.log(2))
+                data = data * cell**2 / beam
+        else:
+            data = image
+            if cell is None:
+                raise ValueError('Give the pixel size (cell) of the model image.')
+        vis += image_visibilities(data, cell, uv.u_lam, uv.v_lam, crpix=crpix,
+                                    pad=pad, width=width, chunksize=chunksize)
+    if components is not None:
+        vis += component_visibilities(components, uv.u_lam, uv.v_lam)
+    return vis
+
+########################################################################
+# IMAGING
+def _grid_to_image(grid, npix, corr):
+    # fft of the centered grid, cropped to npix and grid corrected
+    ngrid = grid.shape[0]
+    img = _np.fft.fftshift(_np.fft.ifft2(_np.fft.ifftshift(grid))).real
+    lo = ngrid // 2 - npix // 2
+    img = img[lo:lo+npix, lo:lo+npix]
+    c = corr[lo:lo+npix]
+    return img / (c[:, None] * c[None, :])
+
+def phase_center(hdr):
+    """ RA and DEC (degrees) of the phase center of a uv-fits header """
+    for i in range(2, hdr['NAXIS'] + 1):
+        if str(hdr.get('CTYPE{0}'.format(i), '')).strip() == 'RA':
+            ra = hdr['CRVAL{0}'.format(i)]
+        if str(hdr.get('CTYPE{0}'.format(i), '')).strip() == 'DEC':
+            dec = hdr['CRVAL{0}'.format(i)]
+    try:
+        return ra, dec
+    except NameError:
+        return hdr.get('OBSRA', 0.), hdr.get('OBSDEC', 0.)
+
+def _image_header(uv, npix, cell, bunit):
+    from astropy.io.fits import Header
+    ra, dec = phase_center(uv.hdr)
+    hdr = Header()
+    hdr['NAXIS'] = 4
+    for i, (naxis, ctype, crval, cdelt, crpix) in enumerate([
+                (npix, 'RA---SIN', ra, -cell / 3600., npix // 2 + 1),
+                (npix, 'DEC--SIN', dec, cell / 3600., npix // 2 + 1),
+                (1, 'FREQ', uv.freq, 1., 1),
+                (1, 'STOKES', 1., 1., 1)]):
+        hdr['NAXIS{0}'.format(i + 1)] = naxis
+        hdr['CTYPE{0}'.format(i + 1)] = ctype
+        hdr['CRVAL{0}'.format(i + 1)] = crval
+        hdr['CDELT{0}'.format(i + 1)] = cdelt
+        hdr['CRPIX{0}'.format(i + 1)] = crpix
+    hdr['BUNIT'] = bunit
+    hdr['RESTFREQ'] = uv.restfreq
+    hdr['OBJECT'] = uv.hdr.get('OBJECT', '')
+    if 'TELESCOP' in uv.hdr:
+        hdr['TELESCOP'] = uv.hdr['TELESCOP']
+    return hdr
+
+def dirty_image(uv, npix=256, cell=None, weighting='natural', width=6,
+                pad=2, chunksize=100000, nthreads=1):
+    """
+    Dirty image and dirty beam (PSF) of a Uvfits object
+
+    npix : number of pixels along each axis
+    cell : pixel size in asec, default 1/3 of the resolution
+           (1/max(uv distance))
+    weighting : 'natural' or 'uniform'
+    width : support of the Kaiser-Bessel kernel, in grid cells
+    pad : padding of the uv grid (the image is cropped afterwards)
+    chunksize, nthreads : see grid_visibilities
+
+    Returns two Fits objects (IMAGE), the dirty image in Jy/beam and
+    the PSF normalized to 1 at the center.
+    """
+    if cell is None:
+        cell = _np.degrees(1. / (3. * _np.nanmax(uv.uvdist_lam))) * 3600.
+    ngrid = int(npix * pad)
+    ngrid += ngrid % 2
+    # uv cell size in lambda
+    du = 1. / (ngrid * _np.radians(cell / 3600.))
+    beta = kaiser_bessel_beta(width, pad)
+    vis, wts = grid_visibilities(uv.u_lam, uv.v_lam, uv.re, uv.im, uv.wt,
+                                ngrid, du, width=width, beta=beta,
+                                weighting=weighting, chunksize=chunksize,
+                                nthreads=nthreads)
+    corr = kaiser_bessel_correction(ngrid, width, beta)
+    psf = _grid_to_image(wts.astype(_np.complex128), npix, corr)
+    dirty = _grid_to_image(vis, npix, corr)
+    norm = psf[npix // 2, npix // 2]
+    out = []
+    for img, bunit in [(dirty, 'JY/BEAM'), (psf, '')]:
+        obj = Fits.from_header(_image_header(uv, npix, cell, bunit))
+        obj.d = img / norm
+        out.append(obj)
+    return tuple(out)
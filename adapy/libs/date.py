@@ -1,3 +1,5 @@
+import numpy as _np
+
 
 def jd2gd(jd):
 
@@ -76,3 +78,39 @@ def jd2gd(jd):
     #~ print (yyyy, mm, dd, hh, mins, sec)
 
     return (yyyy, mm, dd, hh, mins, sec)
+
+
+def jd2datetime64(jd):
+    """
+    Convert (an array of) julian dates to numpy datetime64[ns], vectorized.
+    Note that a float64 julian date only resolves about 10 micro seconds.
+    """
+    jd = _np.asarray(jd, dtype=_np.float64)
+    # julian date of the unix epoch, 1970-01-01T00:00:00
+    ns = _np.round((jd - 2440587.5) * 86400.0e9).astype(_np.int64)
+    return ns.astype('M8[ns]')
+
+def datetime64_fields(dt):
+    """
+    The year, month, day, hour, minute (integer arrays) and seconds
+    (float array) of (an array of) datetime64.
+    """
+    dt = _np.asarray(dt, dtype='M8[ns]')
+    years = dt.astype('M8[Y]')
+    months = dt.astype('M8[M]')
+    days = dt.astype('M8[D]')
+    minutes = dt.astype('M8[m]')
+    year = years.astype(_np.int64) + 1970
+    month = (months - years.astype('M8[M]')).astype(_np.int64) + 1
+    day = (days - months.astype('M8[D]')).astype(_np.int64) + 1
+    hour = (minutes - days.astype('M8[m]')).astype(_np.int64) // 60
+    minute = (minutes - days.astype('M8[m]')).astype(_np.int64) % 60
+    sec = (dt - minutes.astype('M8[ns]')).astype(_np.int64) * 1.0e-9
+    return year, month, day, hour, minute, sec
+
+def jd2gd_arr(jd):
+    """
+    Vectorized jd2gd, for an array of julian dates.
+    Returns an array with rows of (year, month, day, hour, min, sec)
+    """
+    return _np.array(datetime64_fields(jd2datetime64(jd)), dtype=_np.float64).T
@@ -25,6 +25,7 @@
 #  version 0.1b
 
 import logger as _logger
+from ..helpers import stylify
 
 class ParError(Exception):
     def __init__(self, value, reason=None):
@@ -11,7 +11,7 @@ from .uvfits_helpers import *
 # check the imports below
 from datetime import datetime as _dt
 from .helpers import *
-from .libs.date import jd2gd
+from .libs.date import jd2datetime64, jd2gd_arr
 import scipy as _sp
 from scipy import sqrt, pi, arctan2
 import numpy as _np
@@ -25,10 +25,31 @@ import adapy
 # STRINGS
 KMS = u"km\u00b7s\u207b\u00b9"
 
-__all__ = ['Uvfits']
+__all__ = ['Uvfits', 'bin_uvfits']
 
 ########################################################################
 # DATA HANDLING
+def _cached_uv(name, func, doc=None):
+    """
+    Attribute that is calculated by func(self) the first time it is
+    used, and then cached (in self.__dict__['_' + name]).
+    It can be assigned to as a normal attribute (e.g. by rotate and
+    deproject), 'del' drops the cached value so that it is calculated
+    again from the canonical u, v, w (self._uvw).
+    """
+    key = '_' + name
+    def fget(self):
+        try:
+            return self.__dict__[key]
+        except KeyError:
+            value = self.__dict__[key] = func(self)
+            return value
+    def fset(self, value):
+        self.__dict__[key] = value
+    def fdel(self):
+        self.__dict__.pop(key, None)
+    return property(fget, fset, fdel, doc)
+
 # UV-FITS DATA CLASS
 class Uvfits(object):
     """
@@ -54,14 +75,52 @@ class Uvfits(object):
                 - No antennas
                 - Telescope (if present)
     """
-    def __init__(self, uvfitsfile, telescope=None, vsys=0, distance=0, endian=None, **kwargs):
+    # The u, v, w coordinates in different units, calculated from
+    # self._uvw (seconds, as in the file) when first used.
+    # unit lambda
+    u_lam = _cached_uv('u_lam', lambda self: self._uvw[0] * self._uv_freq())
+    v_lam = _cached_uv('v_lam', lambda self: self._uvw[1] * self._uv_freq())
+    w_lam = _cached_uv('w_lam', lambda self: self._uvw[2] * self._uv_freq())
+    # unit kilo lambda
+    u_klam = _cached_uv('u_klam', lambda self: self._uvw[0] * self._uv_freq() * 1.0e-3)
+    v_klam = _cached_uv('v_klam', lambda self: self._uvw[1] * self._uv_freq() * 1.0e-3)
+    w_klam = _cached_uv('w_klam', lambda self: self._uvw[2] * self._uv_freq() * 1.0e-3)
+    # unit meters
+    u_m = _cached_uv('u_m', lambda self: self._uvw[0] * co.c.cgs.value * 1.0e-2)
+    v_m = _cached_uv('v_m', lambda self: self._uvw[1] * co.c.cgs.value * 1.0e-2)
+    w_m = _cached_uv('w_m', lambda self: self._uvw[2] * co.c.cgs.value * 1.0e-2)
+    # uv distance
+    uvdist_lam = _cached_uv('uvdist_lam', lambda self: sqrt(self.u_lam**2 + self.v_lam**2))
+    uvdist_klam = _cached_uv('uvdist_klam', lambda self: sqrt(self.u_klam**2 + self.v_klam**2))
+    uvdist_m = _cached_uv('uvdist_m', lambda self: sqrt(self.u_m**2 + self.v_m**2))
+    # astropy quantities, kilo lambda
+    u = _cached_uv('u', lambda self: self._to_klambdas(self._uvw[0]))
+    v = _cached_uv('v', lambda self: self._to_klambdas(self._uvw[1]))
+    w = _cached_uv('w', lambda self: self._to_klambdas(self._uvw[2]))
+    uvdist = _cached_uv('uvdist', lambda self: sqrt(self.u.value**2 + self.v.value**2) * klambdas)
+
+    def __init__(self, uvfitsfile, telescope=None, vsys=0, distance=0, endian=None, pydates=False, **kwargs):
         """
 
         Reads the uvfits and calculates useful things, e.g. u,v,w,
         phase and amplitude
 
-        .byteswap().newbyteorder() is applied in various places to
-        convert to little endian
+        The dates of the visibilities are in self.dates (datetime64[ns]),
+        self.date (rows of year, month, day, hour, min, sec) and
+        self.date1 (dictionary of the same fields).
+        pydates
+            if True, also create self.date2, a list of datetime objects
+            (slow for large data sets).
+
+        endian
+            None (default) or 'big' keeps the baselines and the
+            visibilities as big endian views of the file (no copy),
+            numpy converts them on the fly in the arithmetic.
+            'little' converts them to the native byte order in place
+            (chunk by chunk, no copy). The memory is shared with
+            self.data/self.hdu, so BASELINE and the visibilities read
+            from self.data are wrong afterwards, use self.baseline and
+            self.visdata.
 
         """
         f = pfopen(uvfitsfile, **kwargs)
@@ -76,6 +135,7 @@ class Uvfits(object):
             print "error: cannot open uv data HDU."
         self.hdr = self.hdu.header
         self.data = self.hdu.data
+        self.WCS = wcs.WCS(self.hdr)
         if self.hdr['NAXIS4'] > 1:
             self.datatype = ('CUBE', 3)
         else:
@@ -88,7 +148,8 @@ class Uvfits(object):
             spec_axis = ('spectral' == ax_types).nonzero()[0][0]
             freq = self.hdu.header['CRVAL{0}'.format(spec_axis+1)]
             # assumes the frequency given in Hz
-            self.freq = freq * un.Hz
+            self.freq = freq
+            self.freq_unit = freq * u.Hz
         except (IndexError):
             print('No spectral axis in header.')
             spec_axis = -1
@@ -108,29 +169,19 @@ class Uvfits(object):
         # standard storing unit here is kilo-lambdas
         # save a million lines of code!
         u.add_enabled_equivalencies(lambdas_equivalencies(self.restfreq_unit))
-        self.u = (self.data.par('UU') * u.s).to(klambdas)
-        self.v = (self.data.par('VV') * u.s).to(klambdas)
-        self.w = (self.data.par('WW') * u.s).to(klambdas)
-        self.uvdist = sqrt(self.u.value**2 + self.v.value**2) * klambdas
+        # only u, v, w in seconds are stored, the other units
+        # (u_klam, uvdist_klam, u etc.) are calculated when used
+        self._uvw = _np.array([self.data.par('UU'), self.data.par('VV'),
+                                self.data.par('WW')], dtype=_np.float64)
 
 
         # BASELINE
-        self.baseline = self.hdu.data.par('BASELINE').byteswap().newbyteorder()
+        self.baseline = self._to_endian(self.hdu.data.par('BASELINE'))
         # DATES
         self.jdate = self.hdu.data.par('DATE')
         # set date to 1900, Jan, 01, 01:00:00 if date before before this
         self.jdate =self.jdate.clip(2415020.5)
-        self.date = _sp.array([jd2gd(i) for i in self.jdate])
-        self.date0 = self.date.transpose()
-        fields = ['year', 'month', 'day', 'hour', 'minute', 'sec']
-        self.date1 = {key:value for key,value in zip(fields, self.date0)}
-        # convert to datetime objects
-        # LOSES the sub-second resolution
-        self.date2 = [_dt(int(i[0]), int(i[1]), int(i[2]), int(i[3]), int(i[4]), int(i[5])) for i in self.date]
-        # get number of tracks
-        # TODO : rough hack, separate track if diff day is >1
-        tmp = _sp.where(_sp.diff(_sp.unique(self.jdate.round(0)))>1)[0]
-        self.ntracks = len(tmp)+1
+        self._set_dates(pydates)
         
         ################################################################
         # NB : need to streamline this.
@@ -141,10 +192,10 @@ class Uvfits(object):
         # COMPLEX VISIBILITY
         visi_index = len(self.data.parnames)
         if self.hdu.header['NAXIS']  == 7:
-            self.visdata = self.data.par(visi_index)[:,0,0,0,0,0,:].byteswap().newbyteorder()
+            self.visdata = self._to_endian(self.data.par(visi_index)[:,0,0,0,0,0,:])
         #~ self.visdata = self.hdu.data.data[:,0,0,0,0,0,:]
         elif self.hdu.header['NAXIS']  == 6:
-            self.visdata = self.data.par(visi_index)[:,0,0,0,0,:].byteswap().newbyteorder()
+            self.visdata = self._to_endian(self.data.par(visi_index)[:,0,0,0,0,:])
         # load the re, im and weight arrays
         self.re, self.im, self.wt = self.visdata[:,:].T
         #~ self.re = self.visdata[:,0][:]
@@ -156,6 +207,25 @@ class Uvfits(object):
         #~ self.comp += self.visdata[:,0][:]
         #~ self.comp = self.visdata[:,:2].astype(_np.float).view(_np.complex)
         
+        self._set_visibilities()
+
+    def _set_dates(self, pydates=False):
+        # the dates from the julian dates (self.jdate)
+        self.dates = jd2datetime64(self.jdate)
+        self.date = jd2gd_arr(self.jdate)
+        self.date0 = self.date.transpose()
+        fields = ['year', 'month', 'day', 'hour', 'minute', 'sec']
+        self.date1 = {key:value for key,value in zip(fields, self.date0)}
+        if pydates:
+            # convert to datetime objects (micro second resolution)
+            self.date2 = self.dates.astype('M8[us]').tolist()
+        # get number of tracks
+        # TODO : rough hack, separate track if diff day is >1
+        tmp = _sp.where(_sp.diff(_sp.unique(self.jdate.round(0)))>1)[0]
+        self.ntracks = len(tmp)+1
+
+    def _set_visibilities(self):
+        # amplitude, phase etc. from self.visdata (re, im, wt)
         # below seems a bit dependent...
         self.cvisi = self.visdata[:,:2].astype(_np.float).view(_np.complex).T[0]
         """
@@ -184,6 +254,24 @@ class Uvfits(object):
         self.sigma = _sp.sqrt(0.5 / ( self.wt * float(self.amp.shape[0]) ) )
         #np.sqrt( 0.5/self.wt/float(self.amp.shape[0]) )
 
+    def _uv_freq(self):
+        # the frequency (Hz) that converts u, v, w from seconds to
+        # wavelengths, the same for u_klam etc. and the quantities u, v, w
+        return self.restfreq if self.freq is None else self.freq
+
+    def _to_klambdas(self, arr):
+        # seconds to kilo lambda quantity, with the equivalencies of this
+        # object, not the globally enabled ones (of the last Uvfits)
+        eq = lambdas_equivalencies(self._uv_freq() * u.Hz)
+        return (arr * u.s).to(klambdas, equivalencies=eq)
+
+    def _to_endian(self, arr):
+        # convert in place (no copy) only if asked for, the memory
+        # is shared with self.data
+        if self.loadendian != 'little':
+            return arr
+        return byteswap_inplace(arr)
+
     def load_model(self, modelfile, endian = None):
         if endian != None: # overrides the endianness of data loading
             self.Model = Uvfits(modelfile, endian = endian)
@@ -191,6 +279,115 @@ class Uvfits(object):
             # make sure it loads the same endian format as data
             self.Model = Uvfits(modelfile, endian = self.loadendian)
 
+    def make_model(self, image=None, components=None, **kwargs):
+        """
+        Calculate model visibilities at the uv points of the data and
+        store them as self.Model (as load_model, but without the
+        round trip through a uv-fits file made elsewhere).
+
+        image : Fits object (or 2D array, then give cell=asec) of the
+                model, Jy/pixel (or Jy/beam if the header has a beam),
+                sampled with a non-uniform FFT (degridding)
+        components : list of point/Gaussian components, see
+                     imaging.component_visibilities
+
+        Other keywords are passed to imaging.model_visibilities
+        """
+        from .imaging import model_visibilities
+        vis = model_visibilities(self, image, components, **kwargs)
+        model = self._new_like()
+        # same uv points (and rotation etc.) as the data
+        model._uvw = self._uvw
+        for key in self.__dict__:
+            if isinstance(getattr(Uvfits, key[1:], None), property):
+                model.__dict__[key] = self.__dict__[key]
+        model.baseline = self.baseline
+        model.jdate = self.jdate
+        model.visdata = _np.column_stack([vis.real, vis.imag, self.wt])
+        model.re, model.im, model.wt = model.visdata.T
+        model._set_dates()
+        model._set_visibilities()
+        self.Model = model
+
+    def _new_like(self):
+        # empty Uvfits object with the header information of self
+        new = Uvfits.__new__(Uvfits)
+        for key in ['hdr', 'WCS', 'datatype', 'freq', 'freq_unit',
+                    'restfreq', 'restfreq_unit', 'loadendian']:
+            if key in self.__dict__:
+                new.__dict__[key] = self.__dict__[key]
+        new.hdu = new.data = None
+        return new
+
+    def track_index(self):
+        """
+        The track number of each visibility, a new track starts
+        when there is more than a day between the dates (as ntracks)
+        """
+        days = _np.unique(self.jdate.round(0))
+        starts = days[1:][_np.diff(days) > 1]
+        return _np.searchsorted(starts, self.jdate.round(0), side='right')
+
+    def average(self, time=None, by='baseline'):
+        """
+        Average the visibilities in time, per baseline.
+
+        time : length of the time bins in seconds, if None all the
+               visibilities of a baseline (per track if by='track')
+               are averaged together
+        by : 'baseline', time bins counted from the first visibility
+             'track', per baseline and track (see track_index), the
+             time bins start at the beginning of each track
+
+        Visibilities with zero or negative weight are not used.
+        re, im, u, v, w and the date are weighted averages and the
+        weights are summed. The uv coordinates are averaged from the
+        stored u, v, w (i.e. not rotated/deprojected) and a loaded
+        Model is not averaged.
+
+        Returns a new Uvfits object with the averaged data.
+        """
+        if by not in ['baseline', 'track']:
+            raise ValueError("by should be 'baseline' or 'track'")
+        good = (self.wt > 0).nonzero()[0]
+        if not len(good):
+            raise ValueError('No visibilities with positive weight.')
+        jdate = self.jdate[good].astype(_np.float64)
+        baseline = self.baseline[good]
+        if by == 'track':
+            track = self.track_index()[good]
+        else:
+            track = _np.zeros(len(good), dtype=int)
+        if time is None:
+            tbin = _np.zeros(len(good), dtype=_np.int64)
+        else:
+            # start of the track (or of the data) of each visibility
+            tstart = _np.zeros(track.max() + 1)
+            for i in _np.unique(track):
+                tstart[i] = jdate[track == i].min()
+            tbin = _np.floor((jdate - tstart[track]) * 86400. / time).astype(_np.int64)
+        # sort once, then reduce each (track, baseline, time bin) segment
+        order = _np.lexsort((jdate, tbin, baseline, track))
+        track, baseline, tbin = track[order], baseline[order], tbin[order]
+        change = ((_np.diff(track) != 0) | (_np.diff(baseline) != 0) |
+                    (_np.diff(tbin) != 0))
+        starts = _np.r_[0, change.nonzero()[0] + 1]
+        wt = self.wt[good][order].astype(_np.float64)
+        wtsum = _np.add.reduceat(wt, starts)
+        def wmean(x):
+            return _np.add.reduceat(x[good][order] * wt, starts) / wtsum
+
+        avg = self._new_like()
+        avg._uvw = _np.array([wmean(i) for i in self._uvw])
+        avg.baseline = baseline[starts]
+        avg.jdate = wmean(self.jdate.astype(_np.float64))
+        avg.visdata = _np.column_stack([wmean(self.re), wmean(self.im), wtsum])
+        avg.re, avg.im, avg.wt = avg.visdata.T
+        avg._set_dates(pydates='date2' in self.__dict__)
+        avg._set_visibilities()
+        avg.averaged = (time, by)
+        return avg
+
     def bin_data_DMC(self,ruv=None, binsize=10):
         """
         Function to bin data
@@ -275,39 +472,40 @@ class Uvfits(object):
         BinnedDMC.expt = expt
         self.BinnedDMC = BinnedDMC
 
-    def bin_data(self, ruv=None, binsize=10, nbins=30, ignore_wt=False):
+    def bin_data(self, ruv=None, binsize=10, nbins=30, ignore_wt=False, weighted=False, start='zero', chunksize=None):
         """
         Function to bin UV data, both vector and scalar average is calculated
         creates Bin.Sca and Bin.Vec objects in self
         
         needs : uvdist_klam
                 re, im, wt, amp
-        TODO: move core calcs to separate function for reuse
+        chunksize : if given, bin this many visibilities at a time,
+                    limits the size of the temporary arrays.
+                    To bin files that do not fit in memory use
+                    bin_uvfits instead.
         """
+        def _bin(uvdist, re, im, wt):
+            if ignore_wt:
+                wt = _sp.ones_like(re)
+            arr_bins = uv_bin_edges(uvdist, start=start, binsize=binsize, nbins=nbins)
+            step = chunksize or max(len(uvdist), 1)
+            chunks = ((uvdist[i:i+step], re[i:i+step], im[i:i+step], wt[i:i+step])
+                        for i in xrange(0, len(uvdist), step))
+            vec, sca = uv_bin_accumulate(chunks, arr_bins)
+            return uv_bin_finalize(vec, sca, arr_bins, weighted=weighted)
      
         if self.__dict__.has_key('Model'):
             if ruv is not None:
                 uvdist = ruv
             else:
                 uvdist = self.Model.uvdist_klam
-            mre = self.Model.re
-            mim = self.Model.im
-            if ignore_wt:
-                mwt = _sp.ones_like(self.Model.re)
-            else:
-                mwt = self.Model.wt
-            self.Model.BinVec = uv_bin_vector(uvdist, re, im, mwt, binsize=binsize, nbins=nbins)
-            self.Model.BinSca = uv_bin_scalar(uvdist, re, im, mwt, binsize=binsize, nbins=nbins)
+            self.Model.BinVec, self.Model.BinSca = _bin(uvdist, self.Model.re,
+                                                self.Model.im, self.Model.wt)
         if ruv is not None:
             uvdist = ruv
         else:
             uvdist = self.uvdist_klam
-        if ignore_wt:
-                wt = _sp.ones_like(self.re)
-        else:
-                wt = self.wt
-        self.BinVec = uv_bin_vector(uvdist, self.re, self.im, wt, binsize=binsize, nbins=nbins)
-        self.BinSca = uv_bin_scalar(uvdist, self.re, self.im, wt, binsize=binsize, nbins=nbins)
+        self.BinVec, self.BinSca = _bin(uvdist, self.re, self.im, self.wt)
         
     def shift(self, offset):
         if 'isshifted' in self.__dict__.keys():
@@ -404,3 +602,50 @@ class Uvfits(object):
 
 
 #########################
+
+
+def bin_uvfits(uvfitsfile, binsize=10, nbins=30, ignore_wt=False, weighted=False, start='zero', chunksize=1000000, **kwargs):
+    """
+    Bin the visibilities of a uv-fits file in uv-distance (kilo-lambda),
+    without loading the whole file. The random groups are read from
+    disk (memory mapped) 'chunksize' visibilities at a time and the
+    per bin moments are accumulated, so the memory used does not depend
+    on the size of the file.
+
+    Same binning and same output as Uvfits.bin_data, returns
+    the Binned_Vector and Binned_Scalar objects.
+
+    kwargs are passed on to astropy.io.fits.open
+    """
+    kwargs.setdefault('memmap', True)
+    f = pfopen(uvfitsfile, **kwargs)
+    try:
+        hdr, data = f[0].header, f[0].data
+        # the frequency, as in Uvfits (first spectral axis)
+        axes = [str(hdr.get('CTYPE{0}'.format(i), '')).strip()
+                    for i in range(1, hdr['NAXIS'] + 1)]
+        freq = hdr['CRVAL{0}'.format(axes.index('FREQ') + 1)]
+        nvis = len(data)
+        def uvdists():
+            for i in xrange(0, nvis, chunksize):
+                part = data[i:i+chunksize]
+                yield _sp.sqrt(part.par('UU')**2 + part.par('VV')**2) * freq * 1.0e-3, part
+        if start in ['min']:
+            # need the minimum uv distance first, only reads UU and VV
+            uvmin = min(uvdist.min() for uvdist, part in uvdists())
+            arr_bins = uv_bin_edges(_np.array([uvmin]), start=start, binsize=binsize, nbins=nbins)
+        else:
+            arr_bins = uv_bin_edges(None, start=start, binsize=binsize, nbins=nbins)
+        def chunks():
+            for uvdist, part in uvdists():
+                vis = part.data
+                # first channel/stokes/IF, as Uvfits
+                vis = vis[(slice(None),) + (0,) * (vis.ndim - 2) + (slice(None),)]
+                re, im, wt = vis.astype(_np.float64).T
+                if ignore_wt:
+                    wt = _sp.ones_like(re)
+                yield uvdist, re, im, wt
+        vec, sca = uv_bin_accumulate(chunks(), arr_bins)
+    finally:
+        f.close()
+    return uv_bin_finalize(vec, sca, arr_bins, weighted=weighted)
@@ -1,6 +1,8 @@
 
 import astropy.units as u
 import astropy.constants as co
+import scipy as _sp
+import numpy as _np
 
 
 ########################################################################
@@ -27,6 +29,160 @@ def lambdas_equivalencies(restunit):
 
 
 # BINNING
+class UVBinMoments(object):
+    """
+    Per bin moments of visibility data, accumulated in one pass.
+
+    The bin number of every visibility is found once (uv_bin_index) and
+    the sums are accumulated with bincount, for each row of 'data'
+    (e.g. [re, im] or [amp, pha]):
+        n     : number of points in each bin (positive weights)
+        nnan  : number of 'nan' values
+        sum   : sum of the non-'nan' values
+        m2    : sum of squared deviations from the (non-'nan') mean
+        wsum  : sum of the weights
+        wxsum : weighted sum of the non-'nan' values
+    Batches of data can be added one after another, the moments are
+    merged (Chan et al. 1979) so that the result does not depend on how
+    the data was split up.
+    """
+    def __init__(self, nbin, ncomp=2):
+        self.nbin = nbin
+        self.ncomp = ncomp
+        self.n = _np.zeros(nbin, dtype=int)
+        self.nnan = _np.zeros((ncomp, nbin))
+        self.sum = _np.zeros((ncomp, nbin))
+        self.m2 = _np.zeros((ncomp, nbin))
+        self.wsum = _np.zeros(nbin)
+        self.wxsum = _np.zeros((ncomp, nbin))
+
+    def add(self, ibin, data, wt):
+        """
+        Accumulate a batch. ibin from uv_bin_index, data a sequence of
+        ncomp arrays and wt the weights, all of the same length.
+        """
+        sel = ibin >= 0
+        ib = ibin[sel]
+        nb = self.nbin
+        n_b = _np.bincount(ib, minlength=nb)
+        w = wt[sel].astype(_np.float64)
+        wsum_b = _np.bincount(ib, weights=w, minlength=nb)
+        for k, x in enumerate(data):
+            x = _np.asarray(x)[sel].astype(_np.float64)
+            isnan = _np.isnan(x)
+            x[isnan] = 0.0
+            nnan_b = _np.bincount(ib, weights=isnan, minlength=nb)
+            sum_b = _np.bincount(ib, weights=x, minlength=nb)
+            cnt_b = n_b - nnan_b
+            with _np.errstate(invalid='ignore', divide='ignore'):
+                mean_b = _np.where(cnt_b > 0, sum_b / cnt_b, 0.0)
+            # squared deviations from the mean of this batch
+            x -= mean_b[ib]
+            x[isnan] = 0.0
+            m2_b = _np.bincount(ib, weights=x * x, minlength=nb)
+            # weighted sum, reuse x
+            x += mean_b[ib]
+            x[isnan] = 0.0
+            wxsum_b = _np.bincount(ib, weights=w * x, minlength=nb)
+            self._merge(k, nnan_b, sum_b, m2_b, wxsum_b, cnt_b)
+        self.n += n_b
+        self.wsum += wsum_b
+
+    def merge(self, other):
+        """
+        Merge the moments of another UVBinMoments (same bins), e.g.
+        accumulated from another part of the data.
+        """
+        if other.nbin != self.nbin or other.ncomp != self.ncomp:
+            raise ValueError('Can only merge moments with the same bins.')
+        for k in range(self.ncomp):
+            self._merge(k, other.nnan[k], other.sum[k], other.m2[k],
+                        other.wxsum[k], other.n - other.nnan[k])
+        self.n += other.n
+        self.wsum += other.wsum
+
+    def _merge(self, k, nnan_b, sum_b, m2_b, wxsum_b, cnt_b):
+        # combine the moments of component k with those of a batch
+        cnt_a = self.n - self.nnan[k]
+        cnt = cnt_a + cnt_b
+        with _np.errstate(invalid='ignore', divide='ignore'):
+            delta = (_np.where(cnt_b > 0, sum_b / cnt_b, 0.0) -
+                        _np.where(cnt_a > 0, self.sum[k] / cnt_a, 0.0))
+            extra = _np.where(cnt > 0, delta**2 * cnt_a * cnt_b / cnt, 0.0)
+        self.m2[k] += m2_b + extra
+        self.sum[k] += sum_b
+        self.nnan[k] += nnan_b
+        self.wxsum[k] += wxsum_b
+
+    def nanmean(self):
+        """ Mean ignoring 'nan' values (as nanmean), shape (nbin, ncomp) """
+        cnt = self.n - self.nnan
+        with _np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum / cnt
+        mean[:, self.n == 0] = _np.nan
+        return mean.T
+
+    def wmean(self):
+        """ Weighted mean (as average), 'nan' if any 'nan' in bin """
+        with _np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.wxsum / self.wsum
+        mean[(self.nnan > 0) | (self.n == 0)] = _np.nan
+        return mean.T
+
+    def var(self, ddof=1):
+        """ Variance (as var), 'nan' if any 'nan' in bin """
+        with _np.errstate(invalid='ignore', divide='ignore'):
+            var = self.m2 / (self.n - ddof)
+        var[(self.nnan > 0) | (self.n == 0)] = _np.nan
+        return var.T
+
+def uv_bin_edges(uvdist, start='zero', binsize=10, nbins=50):
+    """
+    The bin edges used by uv_bin_vector and uv_bin_scalar.
+    start : 'zero' (uvdist = 0) or 'min' (min(uvdist))
+    """
+    if start in ['zero', 0, '0']:
+        uvmin = 0.0
+    elif start in ['min']:
+        uvmin = uvdist.min()
+    uvmax = uvmin + binsize * (int(nbins) + 0.5)
+    # Define the bins, from uvmin to uvmax
+    return _sp.arange(_sp.floor(uvmin), _sp.ceil(uvmax), binsize)
+
+def uv_bin_index(uvdist, wt, arr_bins):
+    """
+    The bin number of each visibility, i.e. the i for which
+    arr_bins[i] <= uvdist < arr_bins[i+1], -1 for points outside
+    the bins and for negative (or 'nan') weights.
+    """
+    ibin = _np.searchsorted(arr_bins, uvdist, side='right') - 1
+    ibin[(ibin >= len(arr_bins) - 1) | ~(wt >= 0.0)] = -1
+    return ibin
+
+def uv_bin_accumulate(chunks, arr_bins):
+    """
+    Accumulate the vector (re, im) and scalar (amp, pha) moments over
+    an iterable of (uvdist, re, im, wt) chunks, e.g. read from disk a
+    part at a time. Only one chunk is in memory at a time.
+
+    Returns the two UVBinMoments, see uv_bin_finalize.
+    """
+    vec = UVBinMoments(len(arr_bins) - 1)
+    sca = UVBinMoments(len(arr_bins) - 1)
+    for uvdist, re, im, wt in chunks:
+        ibin = uv_bin_index(uvdist, wt, arr_bins)
+        vec.add(ibin, [re, im], wt)
+        sca.add(ibin, [_sp.sqrt(re**2 + im**2), _sp.arctan2(im, re)], wt)
+    return vec, sca
+
+def uv_bin_finalize(vec, sca, arr_bins, weighted=False):
+    """
+    The Binned_Vector and Binned_Scalar objects (as from uv_bin_vector
+    and uv_bin_scalar) of accumulated moments.
+    """
+    return (_binned_vector(vec, arr_bins, weighted=weighted),
+            _binned_scalar(sca, arr_bins, weighted=weighted))
+
 def uv_bin_vector(uvdist, re, im, wt, start='zero', binsize=10, nbins=50, weighted=False):
     """
 
@@ -54,6 +210,8 @@ def uv_bin_vector(uvdist, re, im, wt, start='zero', binsize=10, nbins=50, weight
     variance of the real and imaginary parts
     A_sig = sqrt( ((RE*RE_sig/A)^2 + (IM*IM_sig/A)^2) / (Np - 2) )
     
+    The sums are accumulated in one pass over the data, see
+    UVBinMoments.
 
     NOTES
     =====
@@ -64,68 +222,36 @@ def uv_bin_vector(uvdist, re, im, wt, start='zero', binsize=10, nbins=50, weight
 
     
     """
+    arr_bins = uv_bin_edges(uvdist, start=start, binsize=binsize, nbins=nbins)
+    moments = UVBinMoments(len(arr_bins) - 1)
+    moments.add(uv_bin_index(uvdist, wt, arr_bins), [re, im], wt)
+    return _binned_vector(moments, arr_bins, weighted=weighted)
+
+def _binned_vector(moments, arr_bins, weighted=False):
+    """ Create the Binned_Vector object from the accumulated moments """
     class Binned_Vector(object):
             pass
     ##### CORE CALC START #####
-    if start in ['zero', 0, '0']:
-        uvmin = 0.0
-    elif start in ['min']:
-        uvmin = uvdist.min()
-    uvmax = uvmin + binsize * (int(nbins) + 0.5)
-    # Define the bins, from uvmin to uvmax
-    arr_bins = _sp.arange(_sp.floor(uvmin),
-                            _sp.ceil(uvmax),
-                            binsize)
     # mid-points of the bins
     arr_bins1 = 0.5*(arr_bins[1:] + arr_bins[:-1])
-    minmax = zip(arr_bins[:-1], arr_bins[1:])
-    # only choose data with positive weigths
-    pos_wt = wt>= 0.0
-    def filter_points(i,j):
-        # find the indices of data within the limits and
-        # with positive weigths
-        # i:lower boundary, j:upper boundary
-        return ( (uvdist>=i) * (uvdist<j) * pos_wt).nonzero()[0]
-    isubs = [filter_points(i,j) for i,j in minmax]
-    npoints = _sp.array([len(i) for i in isubs])       # points in each interval
+    npoints = moments.n       # points in each interval
     ###########################################################################
     # Real and Imaginary data binning
-    data = _sp.array([re[:], im[:]])
     # mean for Re and Im separately
     if not weighted:
-        # changed this
-        #~ data_mean = _sp.array([data[:,i].mean(axis=1) for i in isubs])
-        # to this instead, got some problems with not explicitly setting
-        # value to nan, do not rely on mean or average to take care of it
-        # here we use a masked array, which handles the nan much better
-        # removed masked arrays again!
         # print('method takes into account nan raw data values')
-        data_mean =  _sp.array([_sp.nanmean(data[:,i], axis=1) if j>0 else _sp.array([_sp.nan, _sp.nan]) for i,j in zip(isubs,npoints)])
-        #~ check = _sp.array([npoints==0, npoints==0]).T
-        #~ data_mean = _sp.ma.masked_array(data_mean, check, fill_value=_sp.nan)
-        #~ data_mean = _sp.ma.masked_array(data_mean,_sp.isnan(data_mean), fill_value=_sp.nan)
+        data_mean = moments.nanmean()
     elif weighted:
         print ('Calculating weighted average real and imaginary amplitudes')
         print ('method does not take into account nan raw data values')
-        # doesn't work if isubs is empty somewhere
-        #~ data_mean = _sp.array([_sp.average(data[:,i], axis=1, weights=wt[i]) for i in isubs])
-        data_mean = _sp.array([_sp.average(data[:,i], axis=1, weights=wt[i]) if j>0 else _sp.array([_sp.nan, _sp.nan]) for i,j in zip(isubs,npoints)], dtype='float')
-        #~ data_mean = _sp.ma.masked_array(data_mean,_sp.isnan(data_mean))
+        data_mean = moments.wmean()
     # Error of real and imaginary data
-    #~ data_var = _sp.array([_sp.var(data[:,i], ddof=1, axis=1) if j>0 else _sp.array([_sp.nan, _sp.nan]) for i,j in zip(isubs,npoints)])
     # ddof = j-1, the number of points in bin, minus the parameter determined
     # i.e. the mean.
-    data_var = _sp.array([_sp.var(data[:,i], ddof=1, axis=1) if j>0 else _sp.array([_sp.nan, _sp.nan]) for i,j in zip(isubs,npoints)])
-    #~ data_var = _sp.ma.masked_array(data_var,_sp.isnan(data_var), fill_value=_sp.nan)
-
-    #~ data_var[data_var==-0] = _sp.nan
-    #~ data_var = _sp.ma.masked_array(data_var, data_var==-0, fill_value=_sp.nan)
-
-    #~ data_std = _sp.ma.sqrt(data_var)
+    data_var = moments.var(ddof=1)
     data_std = data_var**0.5 # used sqrt here before, got floating point error
     # Amplitude binning
     amp_mean = ( (data_mean**2).sum(axis=1) )**0.5
-    #~ amp_mean = _sp.sqrt( (data_mean**2).sum(axis=1) )
     amp_tmp = amp_mean.reshape((len(amp_mean), 1))
     # calculate the variance of the amplitude
     # error propagation of the variance of the imaginary
@@ -133,7 +259,7 @@ def uv_bin_vector(uvdist, re, im, wt, start='zero', binsize=10, nbins=50, weight
     # if the amp_temp is close to zero, we can end up with
     # inf in variance.
     pars=2
-    dof = _sp.array([float(i-pars) if i>0 else 0.0 for i in npoints])
+    dof = _sp.where(npoints > 0, npoints - pars, 0).astype(float)
     amp_var = (( ( data_mean * data_var / amp_tmp )**2).sum(axis=1)
         / ( dof ) )**0.5
     amp_std = amp_var**0.5
@@ -184,6 +310,9 @@ def uv_bin_scalar(uvdist, re, im, wt, start='zero', binsize=10, nbins=50, weight
     """
     Scalar averaging amplitudes
     
+    The sums are accumulated in one pass over the data, see
+    UVBinMoments.
+
     NOTES
     =====
     Some parts divide with possible zeros.
@@ -192,65 +321,31 @@ def uv_bin_scalar(uvdist, re, im, wt, start='zero', binsize=10, nbins=50, weight
     therefore I've started using masked arrays.
     
     """
+    arr_bins = uv_bin_edges(uvdist, start=start, binsize=binsize, nbins=nbins)
+    ibin = uv_bin_index(uvdist, wt, arr_bins)
+    # AMPLITUDE and PHASE
+    amp = _sp.sqrt(re**2 + im**2)
+    pha = _sp.arctan2(im, re)
+    moments = UVBinMoments(len(arr_bins) - 1)
+    moments.add(ibin, [amp, pha], wt)
+    return _binned_scalar(moments, arr_bins, weighted=weighted)
+
+def _binned_scalar(moments, arr_bins, weighted=False):
+    """ Create the Binned_Scalar object from the accumulated moments """
     class Binned_Scalar(object):
             pass
     ##### CORE CALC START #####
-    if start in ['zero', 0, '0']:
-        uvmin = 0.0
-    elif start in ['min']:
-        uvmin = uvdist.min()
-    uvmax = uvmin + binsize * (int(nbins) + 0.5)
-    #~ binsize = int(round(((uvmax-uvmin)/nbins), 0 ))
-    # Define the bins, from uvmin to uvmax
-    #~ arr_bins = _sp.linspace(uvmin, uvmax, nbins)
-    arr_bins = _sp.arange(_sp.floor(uvmin),
-                            _sp.ceil(uvmax),
-                            binsize)
-    #~ print ('{0} bins with {1} binsize'.format(nbins, binsize))
-    #~ print len(arr_bins)
     # mid-points of the bins
     arr_bins1 = 0.5*(arr_bins[1:] + arr_bins[:-1])
-    minmax = zip(arr_bins[:-1], arr_bins[1:])
-    # only choose data with positive weigths
-    pos_wt = wt>= 0.0
-    def filter_points(i,j):
-        # find the indices of data within the limits and
-        # with positive weigths
-        # i:lower boundary, j:upper boundary
-        return ( (uvdist>=i) * (uvdist<j) * pos_wt).nonzero()[0]
-    isubs = [filter_points(i,j) for i,j in minmax]
-    npoints = _sp.array([len(i) for i in isubs])       # points in each interval
+    npoints = moments.n       # points in each interval
     ###########################################################################
-    # AMPLITUDE 
-    amp = _sp.sqrt(re**2 + im**2)
-    # PHASE
-    pha = _sp.arctan2(im, re)
-    pha_deg = pha / _sp.pi * 180.
-    # put amp and pha in an array
-    data = _sp.array([amp, pha])
-    # ERROR / SIGMA
-    #TODO : check
-    # following 1.0e6 is just for GILDAS, change if needed
-    #~ print('NB : Error calculated from weights assuming GILDAS '
-    #~ 'data (i.e. frequencies in MHz).')
-    #~ self.sigma = 1/sqrt(self.wt*1.0e6)
-    # Daniels way of calculating sigma
-    # test this first
-    sigma = _sp.sqrt(0.5 / ( wt * float(amp.shape[0]) ) )
-    
     if not weighted:
-        data_mean = _sp.array([_sp.nanmean(data[:,i], axis=1) if j>0 else _sp.array([_sp.nan, _sp.nan]) for i,j in zip(isubs,npoints)])
-        # above operation create some 'nan' entries which messes things up
-        # later on if we're not using a masked array
-        #~ data_mean = _sp.ma.masked_array(data_mean,_sp.isnan(data_mean))
+        data_mean = moments.nanmean()
     elif weighted:
         print ('Calculating weighted average amplitudes')
-        data_mean = _sp.array([_sp.average(data[:,i], axis=1, weights=wt[i]) if j>0 else _sp.array([_sp.nan, _sp.nan])  for i,j in zip(isubs,npoints)])
-        #~ data_mean = _sp.ma.masked_array(data_mean,_sp.isnan(data_mean), fill_value=_sp.nan)
+        data_mean = moments.wmean()
     # variance and standard deviation
-    data_var = _sp.array([_sp.var(data[:,i], ddof=1, axis=1) if j>0 else _sp.array([_sp.nan, _sp.nan]) for i,j in zip(isubs,npoints)])
-    #~ data_var[data_var==-0] = _sp.nan
-    #~ data_var = _sp.ma.masked_array(data_var, data_var == -0, fill_value=_sp.nan)
+    data_var = moments.var(ddof=1)
     data_std = data_var**0.5
     
     amp_mean, pha_mean = data_mean.T
@@ -1 +1,2 @@
 from . import intensity
+from . import sampler
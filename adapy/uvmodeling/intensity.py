@@ -1,5 +1,6 @@
 
 import scipy as _sp
+import numpy as _np
 
 #~ dan = uvfits.uvfitting.uvdata()
 #~ dan.read_fits('iras2a_cont.aipsfits')
@@ -100,83 +101,302 @@ def residual_fn(params, uv, vis, env, sigma):
     #~ return ((vis[0] - mod[0])**2 + (vis[1] - mod[1])**2) / (3 * sigma)**2
     return ((vis - mod)**2).sum(axis=0) / (3 * sigma)**2
 
-###FITTING
-def fit(offset=[0,0], ,
-        objects='gaussian,point',
-        model=0)
-    from lmfit import minimize, Parameters, report_fit
-    p_gp = Parameters()
-
-    p_gp.add('dRa',  value=0.02)
-    p_gp.add('dDec', value=-0.002)
-    p_gp.add('amp',  value=0.3)
-    p_gp.add('size',  value=1.8)
-    p_gp.add('PS',   value=0.1, min=0, vary=True)
-
-    #~ p_gp.add('inc',  value=14, vary=True)    # Elliptical Gaussian
-    #~ p_gp.add('PA',   value=-27, min=-90, max=90)
+########################################################################
+# FUSED MODEL AND DERIVATIVES
+PARNAMES = ['dRa', 'dDec', 'amp', 'size', 'inc', 'PA', 'PS']
 
-    #~ p_gp.add('inc',  value=0, vary=False)       # Circular Gaussian
-    #~ p_gp.add('PA',   value=0, min=-90, max=90, vary=False) # Circular Gaussian
+# uvgauss is amp * exp(-GFAC * (size * r)**2)
+GFAC = (_sp.pi**2 / (3600. * 180.))**2 / (4. * _sp.log(2.))
 
+class UVModel(object):
+    """
+    Gaussian + point source model (as model()) of a set of visibilities,
+    the model and its analytic derivatives are calculated in one pass
+    over the visibilities. The uv geometry and the data are stored once.
 
+    Parameters, a list/array in the order of PARNAMES:
+    p[0]    p[1]    p[2]    p[3]    p[4]    p[5]    p[6]
+    dRA     dDec    amp     size    inc     PA      PS
+    asec    asec    Jy      asec    deg     deg     Jy
 
+    inc = 0 (and PA fixed) gives a circular Gaussian.
+    The envelope (env_re, env_im) is subtracted from the data, and
+    the errors are 3 * sigma, as in residual_fn.
 
-    uv = _sp.array([iras2a.u_lam, iras2a.v_lam])
-    vis = _sp.array([iras2a.re, iras2a.im])
-    env = _sp.array([iras2a.Model.re, iras2a.Model.im])
-    vis -= env
-    env = 0
-    sigma = iras2a.sigma
+    Usage :
+    uvm = UVModel.from_uvfits(uvdata)
+    out = uvm.fit([0.02, -0.002, 0.3, 1.8, 0, 0, 0.1], fixed=[4, 5])
+    """
+    def __init__(self, u, v, re, im, sigma, env_re=0, env_im=0):
+        self.u = _sp.asarray(u, dtype=_sp.float64)
+        self.v = _sp.asarray(v, dtype=_sp.float64)
+        self.vis = _sp.array([re - env_re, im - env_im], dtype=_sp.float64)
+        self.err = 3 * _sp.asarray(sigma, dtype=_sp.float64)
+        # phase per asec of offset
+        self.ku = 2 * _sp.pi * self.u / asec2lam
+        self.kv = 2 * _sp.pi * self.v / asec2lam
+
+    @classmethod
+    def from_uvfits(cls, uvdata, envelope=True):
+        """
+        From a Uvfits object (u_lam, v_lam, re, im, sigma), the
+        loaded Model is used as envelope if envelope=True
+        """
+        if envelope and 'Model' in uvdata.__dict__:
+            env_re, env_im = uvdata.Model.re, uvdata.Model.im
+        else:
+            env_re = env_im = 0
+        return cls(uvdata.u_lam, uvdata.v_lam, uvdata.re, uvdata.im,
+                    uvdata.sigma, env_re, env_im)
+
+    def model(self, p, jac=False):
+        """
+        The model visibilities, array([re, im]), and if jac=True also
+        the derivatives with respect to the parameters,
+        shape (7, 2, nvis)
+        """
+        dra, ddec, amp, size, inc, pa, ps = [float(i) for i in p]
+        pha = self.ku * dra + self.kv * ddec
+        cp, sp = _sp.cos(pha), _sp.sin(pha)
+        ca, sa = _sp.cos(deg2rad(pa)), _sp.sin(deg2rad(pa))
+        ci, si = _sp.cos(deg2rad(inc)), _sp.sin(deg2rad(inc))
+        # rotated (rotate_field) and inclined (incline) uv distance
+        ur = self.u * ca + self.v * sa
+        vr = -self.u * sa + self.v * ca
+        r2 = ur**2 + (vr * ci)**2
+        e = _sp.exp(-GFAC * size**2 * r2)
+        gp = ps + amp * e
+        mod = _sp.array([gp * cp, gp * sp])
+        if not jac:
+            return mod
+        cs = _sp.array([cp, sp])
+        # derivative of the Gaussian with respect to r**2
+        dg = -GFAC * size**2 * amp * e
+        d = _sp.empty((7,) + mod.shape)
+        d[0] = _sp.array([-mod[1], mod[0]]) * self.ku
+        d[1] = _sp.array([-mod[1], mod[0]]) * self.kv
+        d[2] = e * cs
+        d[3] = (-2 * GFAC * size * r2 * amp * e) * cs
+        d[4] = (dg * -2 * vr**2 * ci * si * _sp.pi / 180.) * cs
+        d[5] = (dg * 2 * ur * vr * si**2 * _sp.pi / 180.) * cs
+        d[6] = cs
+        return mod, d
+
+    def uv_products(self):
+        """ array([u**2, v**2, u*v]), calculated once """
+        if not hasattr(self, '_uv2'):
+            self._uv2 = _sp.array([self.u**2, self.v**2, self.u * self.v])
+        return self._uv2
+
+    def _coef(self, inc, pa):
+        # r**2 = coef . uv_products() for the rotated (PA)
+        # and inclined (inc) uv distance, inc and pa are columns
+        ca, sa = _sp.cos(deg2rad(pa)), _sp.sin(deg2rad(pa))
+        ci2 = _sp.cos(deg2rad(inc))**2
+        return _sp.hstack([ca**2 + sa**2 * ci2, sa**2 + ca**2 * ci2,
+                            2 * ca * sa * (1 - ci2)])
+
+    def model_batch(self, P):
+        """
+        The model visibilities of many parameter sets at once,
+        P has shape (nsets, 7), returns shape (nsets, 2, nvis).
+        Memory scales with nsets * nvis, see chi2_batch.
+        """
+        P = _sp.atleast_2d(_sp.asarray(P, dtype=_sp.float64))
+        dra, ddec, amp, size, inc, pa, ps = [P[:, [i]] for i in range(7)]
+        r2 = _sp.dot(self._coef(inc, pa), self.uv_products())
+        pha = _sp.dot(P[:, :2], _sp.array([self.ku, self.kv]))
+        gp = ps + amp * _sp.exp(-GFAC * size**2 * r2)
+        return _sp.array([gp * _sp.cos(pha), gp * _sp.sin(pha)]).swapaxes(0, 1)
+
+    def chi2_batch(self, P, maxsize=2**22):
+        """
+        Chi-square of many parameter sets, P with shape (nsets, 7).
+
+        The chi-square is expanded in the Gaussian E = exp(-c size**2 r**2)
+            sum(|V - (PS + amp * E) * exp(i pha)|**2 / err**2)
+        so that the phase is calculated once per unique (dRa, dDec),
+        E once per unique (size, inc, PA), and amp and PS only enter
+        through a few sums (matrix products over the visibilities).
+        E is calculated in chunks of at most maxsize visibilities * sets,
+        to bound the memory use.
+        """
+        P = _sp.atleast_2d(_sp.asarray(P, dtype=_sp.float64))
+        step = max(1, int(maxsize // self.u.size))
+        w = 1. / self.err**2
+        sw = w.sum()
+        c0 = ((self.vis**2).sum(axis=0) * w).sum()
+        chi2 = _sp.empty(len(P))
+        pos, ipos = _np.unique(P[:, :2], axis=0, return_inverse=True)
+        for k, (dra, ddec) in enumerate(pos):
+            sets = (ipos == k).nonzero()[0]
+            pha = self.ku * dra + self.kv * ddec
+            a = (self.vis[0] * _sp.cos(pha) + self.vis[1] * _sp.sin(pha)) * w
+            sa = a.sum()
+            shapes, ishape = _np.unique(P[sets][:, [3, 4, 5]], axis=0, return_inverse=True)
+            ea, ew, e2w = [_sp.empty(len(shapes)) for i in range(3)]
+            for i in xrange(0, len(shapes), step):
+                size, inc, pa = [shapes[i:i+step, [j]] for j in range(3)]
+                r2 = _sp.dot(self._coef(inc, pa), self.uv_products())
+                E = _sp.exp(-GFAC * size**2 * r2)
+                ea[i:i+step] = _sp.dot(E, a)
+                ew[i:i+step] = _sp.dot(E, w)
+                e2w[i:i+step] = _sp.dot(E**2, w)
+            amp, ps = P[sets, 2], P[sets, 6]
+            ea, ew, e2w = ea[ishape], ew[ishape], e2w[ishape]
+            chi2[sets] = (c0 - 2 * (ps * sa + amp * ea) + ps**2 * sw +
+                            2 * ps * amp * ew + amp**2 * e2w)
+        return chi2
+
+    def chi2_grid(self, p, maxsize=2**22, **grid):
+        """
+        Chi-square cube over a grid of parameter values, the parameters
+        that are not given are kept at the values in p.
+
+        Usage :
+        cube, names = uvm.chi2_grid(p0, size=sizes, inc=incs, PA=pas)
+
+        The axes of the cube are in the order of PARNAMES, names lists
+        them.
+        """
+        names = [i for i in PARNAMES if i in grid]
+        if len(names) != len(grid):
+            raise ValueError('Unknown parameter(s), use {0}'.format(PARNAMES))
+        values = [_sp.atleast_1d(grid[i]) for i in names]
+        mesh = _sp.meshgrid(*values, indexing='ij')
+        P = _sp.tile(_sp.asarray(p, dtype=_sp.float64), (mesh[0].size, 1))
+        for name, m in zip(names, mesh):
+            P[:, PARNAMES.index(name)] = m.ravel()
+        return self.chi2_batch(P, maxsize=maxsize).reshape(mesh[0].shape), names
+
+    def residuals(self, p):
+        """ (data - model) / err, re and im after each other """
+        return ((self.vis - self.model(p)) / self.err).ravel()
+
+    def chi2(self, p):
+        return (self.residuals(p)**2).sum()
+
+    def _mpfit_fn(self, p, fjac=None):
+        # mpfit user function, with the derivatives if fjac is given
+        if fjac is None:
+            return [0, self.residuals(p)]
+        mod, d = self.model(p, jac=True)
+        resid = ((self.vis - mod) / self.err).ravel()
+        # derivatives of the (weighted) model, (ndata, npar)
+        pderiv = (d / self.err).reshape(len(p), -1).T
+        return [0, resid, pderiv]
+
+    def fit(self, p0, fixed=[], limits={}, quiet=True):
+        """
+        Least squares fit (mpfit, analytic derivatives)
+
+        p0 : start values, in the order of PARNAMES
+        fixed : the parameters (names or indices) that are kept fixed
+        limits : dictionary of name : (min, max), None for no limit
+
+        Returns an object with params, errors, chi2, dof, niter,
+        nfev and status.
+        """
+        from adapy.fitting.mpfit import mpfit
+        fixed = [PARNAMES.index(i) if i in PARNAMES else i for i in fixed]
+        parinfo = []
+        for i, name in enumerate(PARNAMES):
+            lo, hi = limits.get(name, (None, None))
+            parinfo.append(dict(value=float(p0[i]),
+                                fixed=i in fixed,
+                                parname=name,
+                                limited=[lo is not None, hi is not None],
+                                limits=[lo or 0., hi or 0.]))
+        out = mpfit(self._mpfit_fn, parinfo=parinfo, autoderivative=0,
+                    quiet=quiet)
+        if out.status <= 0:
+            raise StandardError(out.errmsg)
+        class Fit: pass
+        Fit.params = _sp.array(out.params)
+        Fit.errors = out.perror
+        Fit.chi2 = out.fnorm
+        Fit.dof = self.vis.size - (len(PARNAMES) - len(fixed))
+        Fit.niter = out.niter
+        Fit.nfev = out.nfev
+        Fit.status = out.status
+        Fit.parnames = PARNAMES
+        return Fit
 
-    fitout2 = minimize( residual_fn, p_gp, args=(uv, vis, env, sigma))
+###FITTING
+def fit(uvdata, p0=[0.02, -0.002, 0.3, 1.8, 0, 0, 0.1],
+        fixed=['inc', 'PA'], envelope=True, quiet=True):
+    """
+    Fit a Gaussian + point source (same position) to the visibilities
+    of a Uvfits object, with the loaded Model as envelope.
 
-    report_fit( fitout2.params )
+    p0 : start values, see UVModel
+    fixed : parameters that are not fitted, default circular Gaussian
+    The point source flux is limited to >= 0.
+    """
+    uvm = UVModel.from_uvfits(uvdata, envelope=envelope)
+    return uvm.fit(p0, fixed=fixed, limits={'PS' : (0, None)}, quiet=quiet)
 
-    return fitout2
+def chi2_grid(uvdata, p0, envelope=True, maxsize=2**22, **grid):
+    """
+    Chi-square cube of the Gaussian + point source model over a grid
+    of parameter values, see UVModel.chi2_grid
 
-import matplotlib.pyplot as plt
-plt.ion()
+    Usage :
+    cube, names = chi2_grid(uvdata, p0, size=_sp.linspace(1, 2, 50),
+                            inc=_sp.arange(0, 90, 5))
+    """
+    uvm = UVModel.from_uvfits(uvdata, envelope=envelope)
+    return uvm.chi2_grid(p0, maxsize=maxsize, **grid)
 
-plt.errorbar(iras2a.uvdist_klam, iras2a.amp, yerr=iras2a.sigma, color='b', marker=',', ls='None', label='Data')
+def plot_fit(uvdata, fitout):
+    """
+    Plot the amplitudes of the data, the envelope (Model) and
+    the fitted point source and Gaussian against the uv distance
+    """
+    import matplotlib.pyplot as plt
+    plt.ion()
+    iras2a = uvdata
+    amp, size, ps = [fitout.params[PARNAMES.index(i)] for i in ['amp', 'size', 'PS']]
 
-plt.plot(iras2a.uvdist_klam, iras2a.Model.amp,'.g', lw=1.5, label='Envelope')
+    plt.errorbar(iras2a.uvdist_klam, iras2a.amp, yerr=iras2a.sigma, color='b', marker=',', ls='None', label='Data')
 
-plt.plot([0,iras2a.uvdist_klam.max()], [fitout2.params['PS'].value, fitout2.params['PS'].value],'k', lw=1.5, label='Point Source')
+    plt.plot(iras2a.uvdist_klam, iras2a.Model.amp,'.g', lw=1.5, label='Envelope')
 
-r_array = _sp.arange(0, iras2a.uvdist_klam.max(), 1)
-plt.plot(r_array, uvgauss(fitout2.params['amp'].value, fitout2.params['size'].value, r_array*1e3), 'm-', lw=2, label='Gauss')
+    plt.plot([0,iras2a.uvdist_klam.max()], [ps, ps],'k', lw=1.5, label='Point Source')
 
+    r_array = _sp.arange(0, iras2a.uvdist_klam.max(), 1)
+    plt.plot(r_array, uvgauss(amp, size, r_array*1e3), 'm-', lw=2, label='Gauss')
 
-plt.plot(iras2a.uvdist_klam, uvgauss(fitout2.params['amp'].value, fitout2.params['size'].value, iras2a.uvdist_klam*1e3) + fitout2.params['PS'].value + iras2a.Model.amp, 'y.', lw=1.5, label='All')
-#~ plt.plot(iras2a.uvdist_klam, uvgauss(fitout2.params['amp'].value, fitout2.params['size'].value, iras2a.uvdist_klam*1e3) + fitout2.params['PS'].value*2 + iras2a.Model.amp, 'y.', lw=1.5, label='All')
 
-"""
-Chisq 110972.457742 113576.742451
-dra:  0.0219254467327 0.0038136654398
-ddec:  -0.0303820184215 0.00862342369389
-flux:  0.288737154888 0.00787698379379
-size:  1.47575122688 0.0482558647562
-inc:  22.253735034 4.07598166308
-pa:  90.6899346751 0.314087006013
-point flux [Jy]:  0.0410064387655 0.00349010149164
+    plt.plot(iras2a.uvdist_klam, uvgauss(amp, size, iras2a.uvdist_klam*1e3) + ps + iras2a.Model.amp, 'y.', lw=1.5, label='All')
+    #~ plt.plot(iras2a.uvdist_klam, uvgauss(fitout2.params['amp'].value, fitout2.params['size'].value, iras2a.uvdist_klam*1e3) + fitout2.params['PS'].value*2 + iras2a.Model.amp, 'y.', lw=1.5, label='All')
 
-"""
-plt.plot(iras2a.uvdist_klam, uvgauss(0.288737154888, 1.47575122688, iras2a.uvdist_klam*1e3) + 0.0410064387655 + iras2a.Model.amp, '0.35', marker='.', ls='None', lw=1.5, label='DMC')
+    """
+    Chisq 110972.457742 113576.742451
+    dra:  0.0219254467327 0.0038136654398
+    ddec:  -0.0303820184215 0.00862342369389
+    flux:  0.288737154888 0.00787698379379
+    size:  1.47575122688 0.0482558647562
+    inc:  22.253735034 4.07598166308
+    pa:  90.6899346751 0.314087006013
+    point flux [Jy]:  0.0410064387655 0.00349010149164
 
-""" 
- C_GAUSS  R.A.        =     0.02272 (  0.00879)  03:28:55.5718
- C_GAUSS  Dec.        =    -0.00491 (  0.00916)  31:14:37.0951
- C_GAUSS  Flux        =     0.25017 (  0.00306)
- C_GAUSS  F.W.H.P.    =     1.64774 (  0.01730)
- POINT    R.A.        =    -0.02941 (  0.00504)  03:28:55.5677
- POINT    DEC.        =    -0.08751 (  0.00421)  31:14:37.0125
- POINT    FLUX        =     0.04962 (  0.00100)
-"""
+    """
+    #~ plt.plot(iras2a.uvdist_klam, uvgauss(0.288737154888, 1.47575122688, iras2a.uvdist_klam*1e3) + 0.0410064387655 + iras2a.Model.amp, '0.35', marker='.', ls='None', lw=1.5, label='DMC')
+
+    """ 
+     C_GAUSS  R.A.        =     0.02272 (  0.00879)  03:28:55.5718
+     C_GAUSS  Dec.        =    -0.00491 (  0.00916)  31:14:37.0951
+     C_GAUSS  Flux        =     0.25017 (  0.00306)
+     C_GAUSS  F.W.H.P.    =     1.64774 (  0.01730)
+     POINT    R.A.        =    -0.02941 (  0.00504)  03:28:55.5677
+     POINT    DEC.        =    -0.08751 (  0.00421)  31:14:37.0125
+     POINT    FLUX        =     0.04962 (  0.00100)
+    """
 
-plt.plot(iras2a.uvdist_klam, uvgauss(0.25017, 1.64774, iras2a.uvdist_klam*1e3) + 0.04962 + iras2a.Model.amp, color='#9999AA', marker='.', ls='None', lw=1, label='Mapping')
+    #~ plt.plot(iras2a.uvdist_klam, uvgauss(0.25017, 1.64774, iras2a.uvdist_klam*1e3) + 0.04962 + iras2a.Model.amp, color='#9999AA', marker='.', ls='None', lw=1, label='Mapping')
 
 
-plt.legend()
+    plt.legend()
 
-plt.grid()
+    plt.grid()
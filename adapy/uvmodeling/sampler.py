@@ -0,0 +1,256 @@
+"""
+Affine invariant ensemble sampler (MCMC) for the uv models
+
+The stretch move of Goodman & Weare (2010), as in emcee, in pure numpy.
+The log-probability of half of the walkers is evaluated at a time,
+with sample_uvmodel it is split over a pool of processes. The
+visibility arrays are put in shared memory once, when the pool is
+started, and not pickled for every task. The chains can be saved to
+disk (npz) every few steps and a run continues from that file.
+
+Usage :
+    S = sample_uvmodel(uvdata, p0, free=['dRa', 'dDec', 'amp', 'size',
+                        'inc', 'PA', 'PS'], bounds={'inc' : (0, 90)},
+                        nwalkers=32, nsteps=2000, nprocs=8,
+                        checkpoint='iras2a_chain.npz')
+    S.chain         # (nwalkers, nsteps, nfree)
+    S.flatchain(burn=500)
+
+"""
+import os as _os
+from multiprocessing import Pool as _Pool
+from multiprocessing.sharedctypes import RawArray as _RawArray
+
+import numpy as _np
+
+from .intensity import UVModel, PARNAMES
+
+__all__ = ['EnsembleSampler', 'UVPosterior', 'sample_uvmodel']
+
+########################################################################
+# SAMPLER
+class EnsembleSampler(object):
+    """
+    Affine invariant ensemble sampler, stretch move
+
+    lnprob : function of an array of positions (n, ndim) that returns
+             the n log-probabilities (-inf outside the prior)
+    a : scale parameter of the stretch move
+    seed : for the random number generator
+    """
+    def __init__(self, lnprob, nwalkers, ndim, a=2.0, seed=None):
+        if nwalkers < 2 * ndim or nwalkers % 2:
+            raise ValueError('Need an even number of walkers, at least 2*ndim.')
+        self.lnprobfn = lnprob
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.a = a
+        self.rng = _np.random.RandomState(seed)
+        self.chain = _np.empty((nwalkers, 0, ndim))
+        self.lnprob = _np.empty((nwalkers, 0))
+        self.naccepted = _np.zeros(nwalkers, dtype=int)
+
+    @property
+    def nsteps(self):
+        return self.chain.shape[1]
+
+    @property
+    def acceptance_fraction(self):
+        return self.naccepted / float(max(self.nsteps, 1))
+
+    def flatchain(self, burn=0, thin=1):
+        """ All walkers after each other, dropping the first burn steps """
+        return self.chain[:, burn::thin].reshape(-1, self.ndim)
+
+    def _step(self, pos, lnp):
+        # one stretch move of each half of the ensemble, using the other
+        half = self.nwalkers // 2
+        for S, C in [(_np.arange(half), _np.arange(half, self.nwalkers)),
+                    (_np.arange(half, self.nwalkers), _np.arange(half))]:
+            z = ((self.a - 1.) * self.rng.rand(half) + 1)**2 / self.a
+            other = pos[C[self.rng.randint(half, size=half)]]
+            prop = other + z[:, None] * (pos[S] - other)
+            lnp_new = _np.asarray(self.lnprobfn(prop), dtype=_np.float64)
+            lnq = (self.ndim - 1.) * _np.log(z) + lnp_new - lnp[S]
+            accept = _np.log(self.rng.rand(half)) < lnq
+            pos[S[accept]] = prop[accept]
+            lnp[S[accept]] = lnp_new[accept]
+            self.naccepted[S[accept]] += 1
+        return pos, lnp
+
+    def run(self, p0, nsteps, checkpoint=None, every=100, verbose=True):
+        """
+        Run until the chain has nsteps steps
+
+        p0 : start positions (nwalkers, ndim), not used when the chain
+             is continued (from an earlier run or the checkpoint file)
+        checkpoint : npz file, if it exists the run continues from it,
+                     and it is written every 'every' steps and at the end
+        """
+        if checkpoint is not None and _os.path.exists(checkpoint) and not self.nsteps:
+            self.load(checkpoint)
+            if verbose:
+                print('Continuing from {0}, {1} steps'.format(checkpoint, self.nsteps))
+        if self.nsteps:
+            pos, lnp = self.chain[:, -1].copy(), self.lnprob[:, -1].copy()
+        else:
+            pos = _np.array(p0, dtype=_np.float64).reshape(self.nwalkers, self.ndim)
+            lnp = _np.asarray(self.lnprobfn(pos), dtype=_np.float64)
+            if not _np.isfinite(lnp).all():
+                raise ValueError('The start positions have to be inside the prior.')
+        start = self.nsteps
+        if nsteps <= start:
+            return self
+        # make room for the new steps
+        self.chain = _np.concatenate([self.chain,
+                        _np.empty((self.nwalkers, nsteps - start, self.ndim))], axis=1)
+        self.lnprob = _np.concatenate([self.lnprob,
+                        _np.empty((self.nwalkers, nsteps - start))], axis=1)
+        done = start
+        try:
+            for i in xrange(start, nsteps):
+                pos, lnp = self._step(pos, lnp)
+                self.chain[:, i] = pos
+                self.lnprob[:, i] = lnp
+                done = i + 1
+                if checkpoint is not None and done % every == 0:
+                    self.save(checkpoint, done)
+                if verbose and done % every == 0:
+                    print('Step {0}/{1}, acceptance {2:.2f}'.format(done, nsteps,
+                            self.naccepted.mean() / float(done)))
+        finally:
+            # if interrupted, keep the steps that were made
+            self.chain = self.chain[:, :done]
+            self.lnprob = self.lnprob[:, :done]
+        if checkpoint is not None:
+            self.save(checkpoint)
+        return self
+
+    def save(self, filename, nsteps=None):
+        """
+        Save the chain (the first nsteps steps) and the state of the
+        random numbers to a npz file. Written to a temporary file first,
+        so an interrupted save does not destroy the previous one.
+        """
+        if nsteps is None:
+            nsteps = self.nsteps
+        name, keys, pos, has_gauss, gauss = self.rng.get_state()
+        tmp = filename + '.tmp.npz'
+        _np.savez(tmp, chain=self.chain[:, :nsteps],
+                    lnprob=self.lnprob[:, :nsteps],
+                    naccepted=self.naccepted, a=self.a,
+                    rng_keys=keys, rng_pos=pos,
+                    rng_has_gauss=has_gauss, rng_gauss=gauss)
+        _os.rename(tmp, filename)
+
+    def load(self, filename):
+        """ Continue from a chain saved with save """
+        f = _np.load(filename)
+        if f['chain'].shape[0] != self.nwalkers or f['chain'].shape[2] != self.ndim:
+            raise ValueError('{0} has a different number of walkers or dimensions.'.format(filename))
+        self.chain = f['chain']
+        self.lnprob = f['lnprob']
+        self.naccepted = f['naccepted']
+        self.rng.set_state(('MT19937', f['rng_keys'], int(f['rng_pos']),
+                            int(f['rng_has_gauss']), float(f['rng_gauss'])))
+
+########################################################################
+# UV MODEL POSTERIOR, IN A POOL OF PROCESSES
+# the UVModel of each worker process, on the shared arrays
+_WORKER = {}
+
+def _share(uvm):
+    # the arrays of a UVModel copied to shared memory
+    uvm.uv_products()
+    shared = {}
+    for key in ['u', 'v', 'vis', 'err', 'ku', 'kv', '_uv2']:
+        arr = uvm.__dict__[key]
+        raw = _RawArray('d', int(arr.size))
+        _np.frombuffer(raw)[:] = arr.ravel()
+        shared[key] = (raw, arr.shape)
+    return shared
+
+def _init_worker(shared):
+    # a UVModel on the shared arrays, nothing is copied
+    uvm = UVModel.__new__(UVModel)
+    for key, (raw, shape) in shared.items():
+        uvm.__dict__[key] = _np.frombuffer(raw).reshape(shape)
+    _WORKER['model'] = uvm
+
+def _worker_chi2(P):
+    return _WORKER['model'].chi2_batch(P)
+
+class UVPosterior(object):
+    """
+    Log-probability of the Gaussian + point source model (UVModel),
+    -chi2/2 with residual_fn's errors, and a uniform prior (bounds).
+    The free parameters are given as names, the others are kept at p.
+    With nprocs > 1 the parameter sets are split over a pool of
+    processes, that share the visibility arrays.
+    """
+    def __init__(self, uvm, p, free, bounds={}, nprocs=1):
+        self.uvm = uvm
+        self.p = _np.asarray(p, dtype=_np.float64)
+        self.free = [PARNAMES.index(i) for i in free]
+        lims = [bounds.get(i, (-_np.inf, _np.inf)) for i in free]
+        self.lo = _np.array([-_np.inf if i[0] is None else i[0] for i in lims])
+        self.hi = _np.array([_np.inf if i[1] is None else i[1] for i in lims])
+        self.nprocs = nprocs
+        self.pool = None
+        if nprocs > 1:
+            self.pool = _Pool(nprocs, initializer=_init_worker,
+                                initargs=(_share(uvm),))
+
+    def __call__(self, X):
+        X = _np.atleast_2d(X)
+        lnp = _np.empty(len(X))
+        lnp.fill(-_np.inf)
+        inside = ((X >= self.lo) & (X <= self.hi)).all(axis=1).nonzero()[0]
+        if not len(inside):
+            return lnp
+        P = _np.tile(self.p, (len(inside), 1))
+        P[:, self.free] = X[inside]
+        if self.pool is None:
+            chi2 = self.uvm.chi2_batch(P)
+        else:
+            chunks = _np.array_split(P, min(self.nprocs, len(P)))
+            chi2 = _np.concatenate(self.pool.map(_worker_chi2, chunks))
+        lnp[inside] = -0.5 * chi2
+        return lnp
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def sample_uvmodel(uvdata, p0, free=PARNAMES, bounds={}, nwalkers=32,
+                    nsteps=1000, scatter=1e-3, nprocs=1, envelope=True,
+                    checkpoint=None, every=100, seed=None, verbose=True):
+    """
+    Sample the posterior of the Gaussian + point source model of a
+    Uvfits object (see uvmodeling.intensity.UVModel)
+
+    p0 : the start (and fixed) values of all the parameters, PARNAMES
+    free : the sampled parameters
+    bounds : dictionary of name : (min, max), uniform prior
+    scatter : the walkers start in a small ball, relative size
+              (absolute for parameters that are zero)
+    nprocs : number of processes evaluating the walkers
+    checkpoint, every : see EnsembleSampler.run
+
+    Returns the EnsembleSampler, with the names of the free parameters
+    in S.parnames.
+    """
+    uvm = UVModel.from_uvfits(uvdata, envelope=envelope)
+    post = UVPosterior(uvm, p0, free, bounds=bounds, nprocs=nprocs)
+    try:
+        S = EnsembleSampler(post, nwalkers, len(free), seed=seed)
+        x0 = _np.array([p0[PARNAMES.index(i)] for i in free], dtype=_np.float64)
+        start = x0 + scatter * _np.where(x0 != 0, abs(x0), 1) * S.rng.randn(nwalkers, len(free))
+        start = _np.clip(start, post.lo, post.hi)
+        S.run(start, nsteps, checkpoint=checkpoint, every=every, verbose=verbose)
+    finally:
+        post.close()
+    S.parnames = list(free)
+    return S